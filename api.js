@@ -174,6 +174,73 @@ function getOfflineResponse(endpoint, options = {}) {
     };
 }
 
+// ========== ПЕРЕВОДЫ С КЛЮЧОМ ИДЕМПОТЕНТНОСТИ ==========
+// Без офлайн-ответа: перевод нельзя "выполнить локально". Повторы идут с тем же
+// ключом - сервер вернет исходный перевод вместо повторного списания
+window.apiTransfer = async function(transfer) {
+    const idempotencyKey = (window.crypto && window.crypto.randomUUID)
+        ? window.crypto.randomUUID()
+        : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    const url = `${window.CONFIG.API_BASE_URL}/api/transfer`;
+    
+    for (let attempt = 0; attempt <= window.CONFIG.MAX_RETRIES; attempt++) {
+        if (attempt > 0) {
+            await new Promise(resolve => setTimeout(resolve, window.CONFIG.RETRY_DELAY * attempt));
+        }
+        
+        try {
+            const controller = new AbortController();
+            const timeoutId = setTimeout(() => controller.abort(), window.CONFIG.REQUEST_TIMEOUT);
+            
+            const response = await fetch(url, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': idempotencyKey
+                },
+                body: JSON.stringify({ ...transfer, idempotencyKey }),
+                mode: 'cors',
+                credentials: 'omit',
+                signal: controller.signal
+            });
+            clearTimeout(timeoutId);
+            
+            // Ответы 4xx окончательные (нет средств и т.п.), повторяем только 5xx
+            if (response.status < 500) {
+                return await response.json();
+            }
+        } catch (error) {
+            // Сеть или таймаут: исход неизвестен, повторяем с тем же ключом
+        }
+    }
+    
+    return { success: false, error: 'Сервер недоступен', offline: true };
+};
+
+// ========== ДЕЛЬТА-СИНХРОНИЗАЦИЯ ==========
+// Без офлайн-ответа: вызывающему нужен код ответа (409 - конфликт версий,
+// 404 - нужна полная синхронизация). null - сервер недоступен
+window.apiSyncDelta = async function(payload) {
+    try {
+        const controller = new AbortController();
+        const timeoutId = setTimeout(() => controller.abort(), window.CONFIG.REQUEST_TIMEOUT);
+        
+        const response = await fetch(`${window.CONFIG.API_BASE_URL}/api/sync/delta`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(payload),
+            mode: 'cors',
+            credentials: 'omit',
+            signal: controller.signal
+        });
+        clearTimeout(timeoutId);
+        
+        return { status: response.status, data: await response.json() };
+    } catch (error) {
+        return null;
+    }
+};
+
 // ========== ФУНКЦИИ ПРОВЕРКИ СОЕДИНЕНИЯ ==========
 window.checkApiConnection = async function() {
     try {
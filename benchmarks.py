@@ -0,0 +1,1185 @@
+# benchmarks.py - МИКРОБЕНЧМАРКИ ВЫСОКОПРОИЗВОДИТЕЛЬНОГО API SPARKCOIN
+#
+# Запуск:  python benchmarks.py <имя> [--iterations N]
+#          python benchmarks.py all
+import os
+import sys
+import json
+import random
+import sqlite3
+import itertools
+import asyncio
+import time
+import logging
+import tempfile
+import threading
+import argparse
+from typing import Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+
+# bot.py создает БД и фоновые потоки при импорте - работаем во временной папке
+WORK_DIR = tempfile.mkdtemp(prefix='sparkcoin_bench_')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORK_DIR)
+
+import bot  # noqa: E402
+
+# Предупреждения о блокировках и медленных запросах ожидаемы под нагрузкой
+bot.logger.setLevel(logging.ERROR)
+# Все запросы тестового клиента идут с одного адреса - лимиты допуска
+# замеряются отдельно (бенчмарк admission со своим контроллером)
+bot.PERFORMANCE_CONFIG['ADMISSION_ENABLED'] = False
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(name: str):
+    """Регистрация бенчмарка"""
+
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Перцентиль по отсортированной выборке"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def report(name: str, latencies: List[float], elapsed: float):
+    """Печать результата: запросов в секунду и задержки"""
+    rps = len(latencies) / elapsed if elapsed else 0
+    print(f"   • {name:<28} {rps:>10.0f} req/s   "
+          f"p50 {percentile(latencies, 50)*1000:7.3f}ms   "
+          f"p99 {percentile(latencies, 99)*1000:7.3f}ms")
+
+
+def fresh_database(name: str) -> 'bot.HighPerformanceDatabase':
+    """Отдельная БД для каждого бенчмарка"""
+    return bot.HighPerformanceDatabase(os.path.join(WORK_DIR, f'{name}.db'))
+
+
+# ============================================================================
+# СИНХРОНИЗАЦИЯ ИГРОКА: SELECT + UPDATE/INSERT + SELECT ПРОТИВ UPSERT
+# ============================================================================
+def _sync_three_queries(database, user_id: str, balance: int):
+    """Старый путь синхронизации: проверка, запись, повторное чтение"""
+
+    def job(conn):
+        exists = conn.execute(
+            "SELECT user_id FROM players_high_perf WHERE user_id = ?",
+            (user_id, )).fetchone()
+
+        if exists:
+            conn.execute(
+                '''
+                UPDATE players_high_perf SET
+                username = ?, balance = ?, total_earned = ?, total_clicks = ?,
+                last_activity = CURRENT_TIMESTAMP, last_device_id = ?, last_ip = ?
+                WHERE user_id = ?
+                ''', ('bench', balance, balance, 1, 'dev', '127.0.0.1', user_id))
+        else:
+            conn.execute(
+                '''
+                INSERT INTO players_high_perf
+                (user_id, username, telegram_id, balance, total_earned, total_clicks,
+                 referral_code, last_device_id, last_ip)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, 'bench', None, balance, balance, 1,
+                      f"REF-{os.urandom(4).hex().upper()}", 'dev', '127.0.0.1'))
+
+        return dict(
+            conn.execute(
+                '''
+                SELECT user_id, username, balance, total_earned, total_clicks,
+                       click_speed, mine_speed, total_speed, level, experience,
+                       referral_code, referrals_count, referral_earnings
+                FROM players_high_perf
+                WHERE user_id = ?
+                ''', (user_id, )).fetchone())
+
+    return database.write(job)
+
+
+@benchmark('sync-upsert')
+def bench_sync_upsert(args):
+    """Сравнение старого пути синхронизации и INSERT ... ON CONFLICT ... RETURNING"""
+    users = [f'bench_user_{i}' for i in range(args.users)]
+
+    paths = {
+        'select+update+select':
+        lambda database, user_id, balance: _sync_three_queries(
+            database, user_id, balance),
+        'upsert+returning':
+        lambda database, user_id, balance: database.upsert_player(
+            user_id, 'bench', None, balance, balance, 1, 'dev', '127.0.0.1'),
+    }
+
+    print(f"🔬 Синхронизация игрока: {args.iterations} запросов, "
+          f"{len(users)} игроков")
+    for name, sync in paths.items():
+        database = fresh_database(f'sync_{name.replace("+", "_")}')
+        latencies = []
+        started = time.perf_counter()
+        for i in range(args.iterations):
+            request_start = time.perf_counter()
+            sync(database, users[i % len(users)], i)
+            latencies.append(time.perf_counter() - request_start)
+        report(name, latencies, time.perf_counter() - started)
+
+
+# ============================================================================
+# ДЕЛЬТА-СИНХРОНИЗАЦИЯ: БАЙТЫ В СЕТИ И ЗАПИСАННЫЕ СТРОКИ ЗА МИНУТУ
+# ============================================================================
+@benchmark('sync-delta')
+def bench_sync_delta(args):
+    """Минута синхронизаций каждые 5s: полное состояние против дельт"""
+    clients = args.users
+    rounds = 12  # синхронизация раз в 5 секунд
+    active_share = 0.2  # доля синхронизаций, где игрок что-то накликал
+    client = bot.app.test_client()
+    upgrades = {f'upgrade_{n}': n % 5 for n in range(12)}
+
+    def full_body(i: int, clicks: int) -> Dict:
+        # Тело, которое сейчас шлет core.js
+        return {
+            'userId': f'delta_user_{i}',
+            'username': f'player_{i}',
+            'balance': 0.000000100 + clicks * 0.000000001,
+            'totalEarned': 0.000000100 + clicks * 0.000000001,
+            'totalClicks': clicks,
+            'upgrades': upgrades,
+            'lastUpdate': int(time.time() * 1000),
+            'telegramId': None,
+            'deviceId': f'delta_device_{i}',
+            'version': '2.0.0'
+        }
+
+    def run(mode: str) -> Dict:
+        rng = random.Random(42)
+        clicks = [0] * clients
+        bases: List[Dict] = [{}] * clients
+        totals = {'requests': 0, 'bytes_out': 0, 'bytes_in': 0}
+        latencies: List[float] = []
+
+        # Первая синхронизация - полное состояние в обоих режимах
+        for i in range(clients):
+            response = client.post('/api/sync/unified',
+                                   json=full_body(i, clicks[i])).get_json()
+            bases[i] = {
+                'version': response['version'],
+                'lease': response['sessionLease'],
+                'clicks': clicks[i]
+            }
+        bot.write_behind.flush()
+        rows_before = bot.write_behind.stats['flushed_rows']
+        started = time.perf_counter()
+
+        for _ in range(rounds):
+            for i in range(clients):
+                if rng.random() < active_share:
+                    clicks[i] += rng.randint(1, 50)
+
+                if mode == 'full':
+                    path, body = '/api/sync/unified', full_body(i, clicks[i])
+                else:
+                    changes = {}
+                    if clicks[i] != bases[i]['clicks']:
+                        value = 0.000000100 + clicks[i] * 0.000000001
+                        changes = {
+                            'balance': value,
+                            'totalEarned': value,
+                            'totalClicks': clicks[i]
+                        }
+                    path, body = '/api/sync/delta', {
+                        'userId': f'delta_user_{i}',
+                        'deviceId': f'delta_device_{i}',
+                        'baseVersion': bases[i]['version'],
+                        'changes': changes,
+                        'lease': bases[i]['lease']
+                    }
+
+                payload = json.dumps(body, separators=(',', ':')).encode()
+                request_start = time.perf_counter()
+                response = client.post(path,
+                                       data=payload,
+                                       content_type='application/json')
+                latencies.append(time.perf_counter() - request_start)
+                totals['requests'] += 1
+                totals['bytes_out'] += len(payload)
+                totals['bytes_in'] += len(response.data)
+
+                data = response.get_json()
+                if mode == 'delta':
+                    bases[i] = {
+                        'version': data['version'],
+                        'lease': data.get('sessionLease', bases[i]['lease']),
+                        'clicks': clicks[i]
+                    }
+            # Окно 5s длиннее периода групповых коммитов - сбрасываем буфер
+            bot.write_behind.flush()
+
+        totals['elapsed'] = time.perf_counter() - started
+        totals['latencies'] = latencies
+        totals['rows'] = bot.write_behind.stats['flushed_rows'] - rows_before
+        return totals
+
+    print(f"🔬 Синхронизация: {clients} клиентов, {rounds} синхронизаций "
+          f"в минуту, активны {active_share:.0%}")
+    for mode, name in (('full', 'полное состояние'), ('delta', 'дельты')):
+        totals = run(mode)
+        report(name, totals['latencies'], totals['elapsed'])
+        print(f"     в минуту: запросы {totals['bytes_out'] / 1024:.0f} KiB, "
+              f"ответы {totals['bytes_in'] / 1024:.0f} KiB, "
+              f"строк записано {totals['rows']}, "
+              f"байт на синхронизацию "
+              f"{(totals['bytes_out'] + totals['bytes_in']) / totals['requests']:.0f}")
+
+
+@benchmark('lazy-mining')
+def bench_lazy_mining(args):
+    """Минута майнинга: синхронизации с доходом, посчитанным клиентом"""
+    clients = args.users
+    rounds = 12  # синхронизация раз в 5 секунд
+    active_share = 0.1  # доля синхронизаций с новыми кликами
+    client = bot.app.test_client()
+    upgrades = {'gpu1': 3, 'gpu2': 2, 'cpu1': 1}
+    speed = bot.mining_speed(bot.normalize_upgrades(upgrades))
+    rng = random.Random(7)
+
+    state = [{'clicks': 0, 'balance': 1000} for _ in range(clients)]
+
+    def body(i: int) -> Dict:
+        return {
+            'userId': f'miner_{i}',
+            'username': f'miner_{i}',
+            'balance': state[i]['balance'] / bot.NANO,
+            'totalEarned': state[i]['balance'] / bot.NANO,
+            'totalClicks': state[i]['clicks'],
+            'upgrades': upgrades,
+            'deviceId': f'miner_device_{i}'
+        }
+
+    for i in range(clients):
+        client.post('/api/sync/unified', json=body(i))
+    bot.write_behind.flush()
+    rows_before = bot.write_behind.stats['flushed_rows']
+
+    latencies: List[float] = []
+    clicked = 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for i in range(clients):
+            # Клиент прибавляет майнинг за 5 секунд, иногда - клики
+            state[i]['balance'] += speed * 5
+            if rng.random() < active_share:
+                state[i]['clicks'] += 10
+                state[i]['balance'] += 10
+                clicked += 1
+            request_start = time.perf_counter()
+            client.post('/api/sync/unified', json=body(i))
+            latencies.append(time.perf_counter() - request_start)
+        bot.write_behind.flush()
+    elapsed = time.perf_counter() - started
+
+    rows = bot.write_behind.stats['flushed_rows'] - rows_before
+    print(f"🔬 Майнинг: {clients} игроков, {rounds} синхронизаций в минуту, "
+          f"кликают {active_share:.0%}")
+    report('полная синхронизация', latencies, elapsed)
+    print(f"     синхронизаций с новым балансом: {len(latencies)} "
+          f"(раньше - столько же строк), строк записано: {rows}, "
+          f"из них с кликами: {clicked}")
+
+
+# ============================================================================
+# SQLITE: ПУЛ ЧИТАТЕЛЕЙ И ОДИН ПИСАТЕЛЬ ПОД СМЕШАННОЙ НАГРУЗКОЙ
+# ============================================================================
+@benchmark('db-pool')
+def bench_db_pool(args):
+    """Чтения и записи из многих потоков: ошибки блокировок и ожидание пула"""
+    database = fresh_database('db_pool')
+    users = args.users
+    database.execute_many_fast(
+        "INSERT INTO players_high_perf (user_id, username, balance) VALUES (?, ?, ?)",
+        [(f'user_{i}', f'user_{i}', bot.to_nano(100)) for i in range(users)])
+
+    print(f"🔬 Пул SQLite: {args.iterations} запросов, 20% записей, "
+          f"{users} игроков")
+    for thread_count in (4, 16, 64):
+        per_thread = max(1, args.iterations // thread_count)
+        barrier = threading.Barrier(thread_count + 1)
+        latencies: List[float] = []
+        errors: List[str] = []
+        lock = threading.Lock()
+
+        def worker(seed: int):
+            local, failed = [], []
+            barrier.wait()
+            for i in range(per_thread):
+                user_id = f'user_{(seed * 7919 + i * 104729) % users}'
+                request_start = time.perf_counter()
+                try:
+                    if i % 5 == 0:
+                        database.execute_fast(
+                            "UPDATE players_high_perf SET balance = balance + 1 "
+                            "WHERE user_id = ?", (user_id, ))
+                    else:
+                        with database.reader() as conn:
+                            conn.execute(
+                                "SELECT balance FROM players_high_perf "
+                                "WHERE user_id = ?", (user_id, )).fetchone()
+                except Exception as e:
+                    failed.append(str(e))
+                local.append(time.perf_counter() - request_start)
+            with lock:
+                latencies.extend(local)
+                errors.extend(failed)
+
+        threads = [
+            threading.Thread(target=worker, args=(n, ))
+            for n in range(thread_count)
+        ]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        report(f'{thread_count} потоков', latencies,
+               time.perf_counter() - started)
+
+        pool = database.get_pool_stats()
+        print(f"     ошибок: {len(errors)}, "
+              f"ожидание читателя avg {pool['readers']['avg_wait_ms']:.3f}ms "
+              f"max {pool['readers']['max_wait_ms']:.1f}ms, "
+              f"очередь писателя avg {pool['writer']['avg_wait_ms']:.3f}ms")
+
+
+# ============================================================================
+# ПЕРЕВОДЫ: ТРАНЗАКЦИЯ НА ПЕРЕВОД ПРОТИВ ДВИЖКА С ГРУППАМИ ПРИ ГОРЯЧИХ СЧЕТАХ
+# ============================================================================
+def _transfer_per_request(database, from_user_id: str, to_user_id: str,
+                          amount: int):
+    """Прежний путь: проверка и запись каждого перевода своей транзакцией"""
+
+    def job(conn):
+        sender = conn.execute(
+            "SELECT balance FROM players_high_perf WHERE user_id = ?",
+            (from_user_id, )).fetchone()
+        if sender is None or sender['balance'] < amount:
+            return None
+        conn.execute(
+            "UPDATE players_high_perf SET balance = balance + ? WHERE user_id = ?",
+            (amount, to_user_id))
+        conn.execute(
+            "UPDATE players_high_perf SET balance = balance - ? WHERE user_id = ?",
+            (amount, from_user_id))
+        transaction_id = conn.execute(
+            "INSERT INTO transfers_high_perf (from_user_id, to_user_id, amount) "
+            "VALUES (?, ?, ?)", (from_user_id, to_user_id, amount)).lastrowid
+        rows = conn.execute(
+            f"SELECT {', '.join(bot.LeaderboardIndex.FIELDS)} "
+            "FROM players_high_perf WHERE user_id IN (?, ?)",
+            (from_user_id, to_user_id)).fetchall()
+        return transaction_id, [dict(row) for row in rows]
+
+    result = database.write(job, 'players_high_perf', 'transfers_high_perf')
+    if result is not None:
+        for row in result[1]:
+            bot.leaderboard_index.update_player(row)
+    return result
+
+
+@benchmark('transfers')
+def bench_transfers(args):
+    """Пропускная способность переводов, 80% из которых касаются 10 горячих счетов"""
+    users = args.users
+    hot = 10
+    thread_count = 32
+    per_thread = max(1, args.iterations // 10 // thread_count)
+
+    def pairs(seed: int):
+        rng = random.Random(seed)
+        for _ in range(per_thread):
+            if rng.random() < 0.8:
+                from_user = rng.randrange(hot)
+            else:
+                from_user = rng.randrange(hot, users)
+            to_user = rng.randrange(users)
+            if to_user == from_user:
+                to_user = (to_user + 1) % users
+            yield f'user_{from_user}', f'user_{to_user}'
+
+    print(f"🔬 Переводы: {per_thread * thread_count} переводов, "
+          f"{thread_count} потоков, {users} счетов, {hot} горячих")
+    for synchronous, name in itertools.product(
+        ('NORMAL', 'FULL'), ('транзакция на перевод', 'движок с группами')):
+        database = fresh_database(f'transfers_{synchronous}_{len(name)}')
+        # FULL: fsync на каждый коммит, как на диске без кэша записи
+        database.writer.execute(
+            lambda conn: conn.execute(f"PRAGMA synchronous = {synchronous}"))
+        database.execute_many_fast(
+            "INSERT INTO players_high_perf (user_id, username, balance) VALUES (?, ?, ?)",
+            [(f'user_{i}', f'user_{i}', bot.to_nano(1000)) for i in range(users)])
+        engine = None
+        if name == 'движок с группами':
+            engine = bot.TransferEngine(database, bot.WriteBehindBuffer(database))
+
+        barrier = threading.Barrier(thread_count + 1)
+        latencies: List[float] = []
+        lock = threading.Lock()
+
+        def worker(seed: int):
+            local = []
+            barrier.wait()
+            for from_user_id, to_user_id in pairs(seed):
+                request_start = time.perf_counter()
+                if engine is None:
+                    _transfer_per_request(database, from_user_id, to_user_id,
+                                          bot.NANO)
+                else:
+                    engine.submit(from_user_id, to_user_id, bot.NANO,
+                                  to_user_id).result()
+                local.append(time.perf_counter() - request_start)
+            with lock:
+                latencies.extend(local)
+
+        threads = [
+            threading.Thread(target=worker, args=(n, ))
+            for n in range(thread_count)
+        ]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        report(f'{name} ({synchronous})', latencies,
+               time.perf_counter() - started)
+
+        total = database.execute_fast(
+            "SELECT SUM(balance) AS total FROM players_high_perf")[0]['total']
+        commits = database.get_pool_stats()['writer']['jobs']
+        line = f"     коммитов писателя: {commits}, сумма балансов {bot.from_nano(total):.0f}"
+        if engine is not None:
+            stats = engine.get_stats()
+            line += (f", групп {stats['groups']}, "
+                     f"средний размер {stats['avg_group_size']:.1f}")
+            engine.shutdown()
+        print(line)
+
+
+# ============================================================================
+# КЭШ ОТВЕТОВ: ЛАВИНА ПЕРЕСЧЕТОВ ПРИ ИСТЕЧЕНИИ TTL
+# ============================================================================
+@benchmark('response-cache')
+def bench_response_cache(args):
+    """Один горячий ключ, дорогое вычисление и частое истечение TTL"""
+    thread_count = 32
+    duration = 2.0
+    ttl = 0.2
+    compute_sec = 0.02
+
+    def make_compute(counter: List[int]):
+
+        def compute():
+            counter.append(1)
+            time.sleep(compute_sec)  # ORDER BY по таблице, агрегаты и т.п.
+            return {'success': True, 'leaderboard': list(range(100))}
+
+        return compute
+
+    def naive_cache(counter: List[int]):
+        """Прежняя схема: запись с TTL без координации между потоками"""
+        cache: Dict[str, tuple] = {}
+        compute = make_compute(counter)
+
+        def fetch():
+            entry = cache.get('leaderboard')
+            if entry is None or time.monotonic() > entry[1]:
+                entry = (bot.ResponseSnapshot(compute()), time.monotonic() + ttl)
+                cache['leaderboard'] = entry
+            return entry[0]
+
+        return fetch
+
+    def flight_cache(stale: float):
+
+        def factory(counter: List[int]):
+            cache = bot.HTTPResponseCache(max_entries=16,
+                                          wait_timeout=1,
+                                          refresh_threads=1)
+            compute = make_compute(counter)
+            return lambda: cache.fetch(
+                'leaderboard', lambda: bot.ResponseSnapshot(compute()), ttl,
+                stale)
+
+        return factory
+
+    print(f"🔬 Кэш ответов: {thread_count} потоков, {duration:.0f}s, "
+          f"TTL {ttl*1000:.0f}ms, вычисление {compute_sec*1000:.0f}ms")
+    for name, factory in (('TTL без координации', naive_cache),
+                          ('single-flight', flight_cache(0)),
+                          ('single-flight + stale', flight_cache(1))):
+        computations: List[int] = []
+        fetch = factory(computations)
+        stop_at = time.perf_counter() + duration
+        latencies: List[float] = []
+        lock = threading.Lock()
+
+        def worker():
+            local = []
+            while time.perf_counter() < stop_at:
+                request_start = time.perf_counter()
+                fetch()
+                local.append(time.perf_counter() - request_start)
+                time.sleep(0.001)  # Остальная работа обработчика запроса
+            with lock:
+                latencies.extend(local)
+
+        threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report(name, latencies, time.perf_counter() - started)
+        # Медленные запросы - те, что ждали вычисления (свои или чужого)
+        slow = sum(1 for latency in latencies if latency >= compute_sec / 2)
+        print(f"     вычислений: {len(computations)} "
+              f"(истечений TTL ~{duration / ttl:.0f}), "
+              f"запросов ждали вычисления: {slow}")
+
+
+# ============================================================================
+# ФОРМАТЫ ОТВЕТОВ: РАЗМЕР И СТОИМОСТЬ КОДИРОВАНИЯ
+# ============================================================================
+@benchmark('wire-formats')
+def bench_wire_formats(args):
+    """Рейтинг на 100 мест и ответ синхронизации во всех форматах"""
+    import gzip
+    iterations = 2000
+    client = bot.app.test_client()
+
+    for i in range(100):
+        client.post('/api/sync/unified', json={
+            'userId': f'wire_user_{i}',
+            'username': f'player_{i}',
+            'balance': 0.000001 * (i + 1),
+            'totalEarned': 0.000002 * (i + 1),
+            'totalClicks': i * 37,
+            'deviceId': f'wire_device_{i}'
+        })
+    bot.write_behind.flush()
+    bot.response_cache.clear()
+
+    payloads = (
+        ('рейтинг', bot.LEADERBOARD_SCHEMA,
+         client.get('/api/leaderboard?limit=100').get_json()),
+        ('синхронизация', bot.SYNC_RESPONSE_SCHEMA,
+         client.post('/api/sync/unified', json={
+             'userId': 'wire_user_0',
+             'username': 'player_0',
+             'balance': 0.000001,
+             'totalEarned': 0.000002,
+             'totalClicks': 0,
+             'deviceId': 'wire_device_0'
+         }).get_json()),
+    )
+
+    decoders = {False: json.loads}
+    if bot.msgpack is not None:
+        decoders[True] = lambda body: bot.msgpack.unpackb(body, raw=False)
+
+    print(f"🔬 Форматы ответов: {len(bot.WIRE_FORMATS)} типов, "
+          f"{iterations} кодирований")
+    for payload_name, schema, data in payloads:
+        for media_type, wire_format in bot.WIRE_FORMATS.items():
+            if media_type == 'application/x-msgpack':
+                continue  # Синоним application/msgpack
+            latencies: List[float] = []
+            started = time.perf_counter()
+            for _ in range(iterations):
+                request_start = time.perf_counter()
+                body = wire_format.serialize(data, schema)
+                latencies.append(time.perf_counter() - request_start)
+            report(f"{payload_name}: {media_type}", latencies,
+                   time.perf_counter() - started)
+
+            decode = decoders['msgpack' in media_type]
+            decode_start = time.perf_counter()
+            for _ in range(iterations // 10):
+                decode(body)
+            decode_us = ((time.perf_counter() - decode_start) /
+                         (iterations // 10) * 1e6)
+            print(f"     байт: {len(body)}, gzip: {len(gzip.compress(body))}, "
+                  f"декодирование: {decode_us:.0f}us")
+
+
+# ============================================================================
+# КОНТРОЛЬ ДОПУСКА: ПЕРЕГРУЗКА СИНХРОНИЗАЦИЯМИ НА ФОНЕ ПЕРЕВОДОВ
+# ============================================================================
+def _run_overload(controller, workers: int, work: float, low_clients: int,
+                  critical_clients: int, duration: float) -> Dict:
+    """Сервис на workers обработчиков по work секунд под перегрузкой"""
+    # Пул с очередью FIFO - как очередь запросов перед обработчиками сервера
+    service = ThreadPoolExecutor(max_workers=workers)
+    results = {'low': [], 'critical': []}
+    shed = {'low': 0, 'critical': 0}
+    deadline = time.perf_counter() + duration
+
+    def client(route_class: str):
+        latencies = results[route_class]
+        while time.perf_counter() < deadline:
+            request_start = time.perf_counter()
+            if controller is not None:
+                admitted, _, _ = controller.admit(route_class, None, None)
+                if not admitted:
+                    shed[route_class] += 1
+                    time.sleep(0.01)  # Клиент уважает Retry-After
+                    continue
+            service.submit(time.sleep, work).result()
+            latency = time.perf_counter() - request_start
+            if controller is not None:
+                controller.release(route_class, latency)
+            latencies.append(latency)
+
+    threads = [
+        threading.Thread(target=client, args=('low', ))
+        for _ in range(low_clients)
+    ] + [
+        threading.Thread(target=client, args=('critical', ))
+        for _ in range(critical_clients)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    service.shutdown()
+    return {
+        'results': results,
+        'shed': shed,
+        'elapsed': time.perf_counter() - started
+    }
+
+
+@benchmark('admission')
+def bench_admission(args):
+    """Без контроля допуска против AIMD-лимита со сбросом низкого приоритета"""
+    workers, work, duration = 8, 0.005, 2.0
+    low_clients, critical_clients = 64, 4
+    target_ms = 20
+    print(f"🔬 Контроль допуска: {workers} обработчиков по {work*1000:.0f}ms, "
+          f"{low_clients} клиентов синхронизации + {critical_clients} "
+          f"переводов, цель p95 {target_ms}ms")
+
+    for label in ('без контроля', 'AIMD'):
+        controller = None
+        if label == 'AIMD':
+            controller = bot.AdmissionController()
+            controller.limiter = bot.AdaptiveConcurrencyLimit(
+                target_ms, 64, 4, 256, window=100, backoff=0.8)
+        result = _run_overload(controller, workers, work, low_clients,
+                               critical_clients, duration)
+        for route_class, latencies in result['results'].items():
+            report(f'{label}: {route_class}', latencies, result['elapsed'])
+        line = (f"     p95 допущенных low "
+                f"{percentile(result['results']['low'], 95)*1000:.1f}ms, "
+                f"сброшено low {result['shed']['low']}, "
+                f"critical {result['shed']['critical']}")
+        if controller is not None:
+            line += f", лимит {controller.limiter.get_stats()['limit']}"
+        print(line)
+
+
+# ============================================================================
+# МЕТРИКИ: СТОИМОСТЬ ЗАМЕРА НА ЗАПРОС И НА ЗАПРОС SQL
+# ============================================================================
+def _per_call_us(operation: Callable, iterations: int) -> float:
+    """Среднее время вызова в микросекундах"""
+    started = time.perf_counter()
+    for i in range(iterations):
+        operation(i)
+    return (time.perf_counter() - started) / iterations * 1000000
+
+
+@benchmark('metrics')
+def bench_metrics(args):
+    """Накладные расходы гистограмм: запись, SQL с замером и без, потоки"""
+    iterations = args.iterations * 10
+    registry = bot.MetricsRegistry(bot.PERFORMANCE_CONFIG['METRICS_MAX_SERIES'])
+    print(f"🔬 Метрики: {iterations} замеров")
+
+    record = _per_call_us(
+        lambda i: registry.observe_request('GET', '/api/leaderboard', 200,
+                                           0.0012), iterations)
+    print(f"   • observe_request              {record:7.2f}us")
+    statement = _per_call_us(
+        lambda i: registry.observe_statement(
+            bot.HighPerformanceDatabase.PLAYER_UPSERT_QUERY, 0.0003),
+        iterations)
+    print(f"   • observe_statement            {statement:7.2f}us")
+
+    database_path = os.path.join(WORK_DIR, 'metrics.db')
+    plain = bot.sqlite3.connect(database_path)
+    plain.execute('CREATE TABLE IF NOT EXISTS t (id INTEGER PRIMARY KEY, v)')
+    plain.executemany('INSERT OR REPLACE INTO t VALUES (?, ?)',
+                      [(i, i) for i in range(1000)])
+    plain.commit()
+    timed = bot.sqlite3.connect(database_path, factory=bot.TimedConnection)
+    query = 'SELECT v FROM t WHERE id = ?'
+    for label, conn in (('SELECT без замера', plain),
+                        ('SELECT с замером', timed)):
+        per_call = _per_call_us(
+            lambda i: conn.execute(query, (i % 1000, )).fetchone(), iterations)
+        print(f"   • {label:<28} {per_call:7.2f}us")
+
+    for thread_count in (1, 8):
+        per_thread = iterations // thread_count
+        threads = [
+            threading.Thread(target=_per_call_us,
+                             args=(lambda i: registry.observe_request(
+                                 'POST', '/api/sync/unified', 200, 0.004),
+                                   per_thread)) for _ in range(thread_count)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        print(f"   • observe_request, {thread_count} потоков    "
+              f"{elapsed / (per_thread * thread_count) * 1000000:7.2f}us "
+              f"(на вызов по всем потокам)")
+
+    render_started = time.perf_counter()
+    text = bot.metrics.render(bot._runtime_metric_families())
+    print(f"     /api/admin/metrics: {len(text.splitlines())} строк, "
+          f"{(time.perf_counter() - render_started)*1000:.2f}ms")
+
+
+# ============================================================================
+# ДЕДЛАЙНЫ: МЕДЛЕННЫЕ АГРЕГАТЫ И ОЧЕРЕДЬ ЗА ЧИТАТЕЛЯМИ
+# ============================================================================
+@benchmark('deadlines')
+def bench_deadlines(args):
+    """Редкие тяжелые чтения без бюджета и с прерыванием по дедлайну"""
+    database = fresh_database('deadlines')
+    slow_query = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 '
+                  'FROM c WHERE x < 300000) SELECT COUNT(*) FROM c')
+    fast_query = 'SELECT COUNT(*) FROM players_high_perf'
+    thread_count, per_thread, slow_share, budget_ms = 32, 50, 0.05, 50
+    print(f"🔬 Дедлайны: {thread_count} потоков, {slow_share:.0%} тяжелых "
+          f"чтений, пул {database.readers.max_size}, бюджет {budget_ms}ms")
+
+    for label, enabled in (('без дедлайнов', False), ('с дедлайнами', True)):
+        latencies: Dict[str, List[float]] = {'fast': [], 'slow': []}
+        interrupted = [0]
+        # Без бюджета тяжелые чтения держат пул - ожидание читателя истекает
+        exhausted = [0]
+
+        def worker(seed: int):
+            rng = random.Random(seed)
+            for _ in range(per_thread):
+                kind = 'slow' if rng.random() < slow_share else 'fast'
+                request_start = time.perf_counter()
+                try:
+                    if enabled:
+                        with bot.deadline_scope(budget_ms):
+                            with database.reader() as conn:
+                                conn.execute(slow_query if kind == 'slow' else
+                                             fast_query).fetchone()
+                    else:
+                        with database.reader() as conn:
+                            conn.execute(slow_query if kind == 'slow' else
+                                         fast_query).fetchone()
+                except bot.DeadlineExceeded:
+                    interrupted[0] += 1
+                except sqlite3.OperationalError:
+                    exhausted[0] += 1
+                latencies[kind].append(time.perf_counter() - request_start)
+
+        threads = [
+            threading.Thread(target=worker, args=(seed, ))
+            for seed in range(thread_count)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        report(f'{label}: легкие', latencies['fast'], elapsed)
+        report(f'{label}: тяжелые', latencies['slow'], elapsed)
+        print(f"     прервано: {interrupted[0]}, пул исчерпан: {exhausted[0]}, "
+              f"wall {elapsed:.2f}s")
+
+
+# ============================================================================
+# СЕССИИ: РЕГИСТРАЦИЯ, ПРОВЕРКА И ИСТЕЧЕНИЕ ПРИ 100K ОДНОВРЕМЕННЫХ СЕССИЙ
+# ============================================================================
+@benchmark('sessions')
+def bench_sessions(args):
+    """Операции менеджера сессий на фоне большого числа активных сессий"""
+    manager = bot.HighPerformanceSessionManager()
+    session_total = args.sessions
+
+    started = time.perf_counter()
+    for i in range(session_total):
+        manager.register_session(f'user_{i}', f'device_{i}', '127.0.0.1',
+                                 'bench')
+    fill_elapsed = time.perf_counter() - started
+    print(f"🔬 Сессии: {session_total} одновременных, заполнение "
+          f"{fill_elapsed:.2f}s")
+
+    operations = {
+        'register_session (повтор)':
+        lambda i: manager.register_session(f'user_{i}', f'device_{i}',
+                                           '127.0.0.1', 'bench'),
+        'register_session (блок)':
+        lambda i: manager.register_session(f'user_{i}', 'other_device',
+                                           '127.0.0.1', 'bench'),
+        'check_session':
+        lambda i: manager.check_session(f'user_{i}', f'device_{i}'),
+        'update_activity':
+        lambda i: manager.update_activity(f'user_{i}', f'device_{i}'),
+        'cleanup_expired_sessions':
+        lambda i: manager.cleanup_expired_sessions(),
+        'get_session_stats':
+        lambda i: manager.get_session_stats(),
+    }
+
+    for name, operation in operations.items():
+        iterations = args.iterations
+        if name == 'get_session_stats':
+            iterations = min(iterations, 100)
+        latencies = []
+        started = time.perf_counter()
+        for i in range(iterations):
+            request_start = time.perf_counter()
+            operation((i * 7919) % session_total)
+            latencies.append(time.perf_counter() - request_start)
+        report(name, latencies, time.perf_counter() - started)
+
+
+# ============================================================================
+# СЕССИИ: КОНКУРЕНЦИЯ ЗА БЛОКИРОВКИ ПРИ 1/4/16/64 ПОТОКАХ
+# ============================================================================
+@benchmark('session-contention')
+def bench_session_contention(args):
+    """Пропускная способность heartbeat-операций при разном числе потоков"""
+    users = args.users * 10
+
+    for shard_count in (1, bot.PERFORMANCE_CONFIG['SESSION_SHARDS']):
+        manager = bot.HighPerformanceSessionManager(shard_count=shard_count)
+        for i in range(users):
+            manager.register_session(f'user_{i}', f'device_{i}', '127.0.0.1',
+                                     'bench')
+
+        print(f"🔬 Конкуренция за сессии: шардов {shard_count}, "
+              f"{users} сессий")
+        for thread_count in (1, 4, 16, 64):
+            per_thread = max(1, args.iterations // thread_count)
+            barrier = threading.Barrier(thread_count + 1)
+            latencies: List[float] = []
+            latencies_lock = threading.Lock()
+
+            def worker(seed: int):
+                local = []
+                barrier.wait()
+                for i in range(per_thread):
+                    user = (seed * 7919 + i * 104729) % users
+                    request_start = time.perf_counter()
+                    # Heartbeat из multisession.js: проверка + обновление активности
+                    manager.check_session(f'user_{user}', f'device_{user}')
+                    manager.update_activity(f'user_{user}', f'device_{user}')
+                    local.append(time.perf_counter() - request_start)
+                with latencies_lock:
+                    latencies.extend(local)
+
+            threads = [
+                threading.Thread(target=worker, args=(n, ))
+                for n in range(thread_count)
+            ]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            report(f'{thread_count} потоков', latencies,
+                   time.perf_counter() - started)
+
+
+# ============================================================================
+# СЕССИИ: HEARTBEAT ПО ПОДПИСАННОЙ АРЕНДЕ ПРОТИВ ПРОВЕРКИ В ХРАНИЛИЩЕ
+# ============================================================================
+@benchmark('session-leases')
+def bench_session_leases(args):
+    """Обращения к блокировкам хранилища за минуту heartbeat-ов каждые 3 секунды"""
+    clients = args.users
+    manager = bot.HighPerformanceSessionManager()
+    leases = bot.SessionLeaseManager(manager, b'bench-secret')
+    for i in range(clients):
+        manager.register_session(f'user_{i}', f'device_{i}', '127.0.0.1',
+                                 'bench')
+
+    # Каждый из этих вызовов - один захват блокировки шарда
+    lock_ops = [0]
+
+    def counted(method):
+        def wrapper(*args, **kwargs):
+            lock_ops[0] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    for method in ('check_session', 'update_activity'):
+        setattr(manager, method, counted(getattr(manager, method)))
+
+    heartbeat_interval = 3  # секунд, как в multisession.js
+    steps = 60 // heartbeat_interval
+    started_at = time.time()
+
+    def without_lease(i, now, tokens):
+        manager.check_session(f'user_{i}', f'device_{i}')
+        manager.update_activity(f'user_{i}', f'device_{i}')
+
+    def with_lease(i, now, tokens):
+        _, _, tokens[i] = leases.heartbeat(f'user_{i}', f'device_{i}',
+                                           tokens[i], now)
+
+    print(f"🔬 Heartbeat: {clients} клиентов, {steps} проверок за минуту")
+    for name, heartbeat in (('хранилище', without_lease),
+                            ('подписанная аренда', with_lease)):
+        tokens: List = [None] * clients
+        lock_ops_before = lock_ops[0]
+        latencies = []
+        started = time.perf_counter()
+        for step in range(steps):
+            now = started_at + step * heartbeat_interval
+            for i in range(clients):
+                request_start = time.perf_counter()
+                heartbeat(i, now, tokens)
+                latencies.append(time.perf_counter() - request_start)
+        report(name, latencies, time.perf_counter() - started)
+        print(f"     захватов блокировки хранилища: "
+              f"{lock_ops[0] - lock_ops_before}")
+
+
+# ============================================================================
+# КЛАССИЧЕСКАЯ ЛОТЕРЕЯ: 10K СТАВОК ЗА РАУНД И ЗАДЕРЖКА СТАТУСА
+# ============================================================================
+@benchmark('classic-lottery')
+def bench_classic_lottery(args):
+    """Ставки раунда, статус по ходу наполнения, снимок и восстановление"""
+    database = fresh_database('classic_lottery')
+    ledger = bot.WriteBehindBuffer(database)
+    players = args.users
+    for i in range(players):
+        database.upsert_player(f'user_{i}', f'player_{i}', None,
+                               bot.to_nano(1000000), bot.to_nano(1000000), 0,
+                               'dev', '127.0.0.1')
+
+    engine = bot.ClassicLotteryEngine(database, ledger)
+    print(f"🔬 Классическая лотерея: {args.bets} ставок, {players} игроков")
+
+    bet_latencies = []
+    status_latencies = []
+    started = time.perf_counter()
+    for i in range(args.bets):
+        request_start = time.perf_counter()
+        engine.place_bet(f'user_{(i * 7919) % players}', bot.to_nano(0.000001))
+        bet_latencies.append(time.perf_counter() - request_start)
+
+        if i % 10 == 0:
+            # Статус, как его отдает эндпоинт: данные раунда + готовый снимок
+            request_start = time.perf_counter()
+            bot.ResponseSnapshot({'success': True, 'lottery': engine.status()})
+            status_latencies.append(time.perf_counter() - request_start)
+    print(f"     всего {time.perf_counter() - started:.2f}s")
+    # Запросы идут вперемешку - пропускная способность по чистому времени каждого
+    report('place_bet', bet_latencies, sum(bet_latencies))
+    report('status', status_latencies, sum(status_latencies))
+
+    engine.flush()
+    request_start = time.perf_counter()
+    engine.checkpoint()
+    print(f"     снимок раунда: {(time.perf_counter() - request_start)*1000:.2f}ms")
+
+    # Перезапуск посреди раунда: снимок + хвост журнала
+    engine.stop_event.set()
+    request_start = time.perf_counter()
+    recovered = bot.ClassicLotteryEngine(database, ledger)
+    recovered.stop_event.set()
+    print(f"     восстановление: {(time.perf_counter() - request_start)*1000:.2f}ms, "
+          f"ставок в раунде {recovered.current.bet_count}, "
+          f"дочитано из журнала {recovered.stats['replayed_bets']}")
+
+
+# ============================================================================
+# РЕЖИМЫ СЕРВЕРА: ПОТОК НА КЛИЕНТА ПРОТИВ ASYNCIO ПРИ 1K/5K/10K КЛИЕНТОВ
+# ============================================================================
+def _heartbeat_body(i: int, leases: List[str]) -> bytes:
+    return json.dumps({
+        'userId': f'serve_user_{i}',
+        'deviceId': f'serve_device_{i}',
+        'lease': leases[i]
+    }).encode()
+
+
+def _run_threaded_clients(clients: int, rounds: int, think: float,
+                          leases: List[str]) -> Dict:
+    """Поток на соединение, как у threaded-сервера Flask"""
+    client = bot.app.test_client()
+    latencies: List[float] = []
+    latencies_lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def worker(i: int):
+        local = []
+        barrier.wait()
+        for _ in range(rounds):
+            request_start = time.perf_counter()
+            client.post('/api/session/check',
+                        data=_heartbeat_body(i, leases),
+                        content_type='application/json')
+            local.append(time.perf_counter() - request_start)
+            time.sleep(think)  # Соединение простаивает, поток занят
+        with latencies_lock:
+            latencies.extend(local)
+
+    threads = []
+    try:
+        for i in range(clients):
+            thread = threading.Thread(target=worker, args=(i, ))
+            thread.start()
+            threads.append(thread)
+    except RuntimeError as e:
+        # Не хватило потоков - отпускаем уже запущенных и сообщаем
+        barrier.abort()
+        for thread in threads:
+            thread.join()
+        return {'error': str(e), 'started': len(threads)}
+
+    peak_threads = threading.active_count()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return {
+        'latencies': latencies,
+        'elapsed': time.perf_counter() - started,
+        'threads': peak_threads
+    }
+
+
+async def _asgi_heartbeat(i: int, leases: List[str]) -> int:
+    scope = {
+        'type': 'http',
+        'method': 'POST',
+        'path': '/api/session/check',
+        'query_string': b'',
+        'headers': [(b'content-type', b'application/json')],
+        'client': ('127.0.0.1', 0)
+    }
+    body = _heartbeat_body(i, leases)
+    status = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await bot.asgi_app(scope, receive, send)
+    return status[0]
+
+
+async def _run_async_clients(clients: int, rounds: int, think: float,
+                             leases: List[str]) -> Dict:
+    """Корутина на соединение в одном цикле событий"""
+    latencies: List[float] = []
+    start_event = asyncio.Event()
+
+    async def client(i: int):
+        await start_event.wait()
+        for _ in range(rounds):
+            request_start = time.perf_counter()
+            await _asgi_heartbeat(i, leases)
+            latencies.append(time.perf_counter() - request_start)
+            await asyncio.sleep(think)  # Простаивающее соединение - без потока
+
+    tasks = [asyncio.ensure_future(client(i)) for i in range(clients)]
+    await asyncio.sleep(0)
+    peak_threads = threading.active_count()
+    started = time.perf_counter()
+    start_event.set()
+    await asyncio.gather(*tasks)
+    return {
+        'latencies': latencies,
+        'elapsed': time.perf_counter() - started,
+        'threads': peak_threads
+    }
+
+
+@benchmark('serving-modes')
+def bench_serving_modes(args):
+    """Heartbeat-клиенты с паузами: threaded Flask против ASGI-режима"""
+    rounds = 3
+    think = 0.05
+    max_clients = max(args.clients)
+    leases = []
+    for i in range(max_clients):
+        bot.session_manager.register_session(f'serve_user_{i}',
+                                             f'serve_device_{i}', '127.0.0.1',
+                                             'bench')
+        leases.append(
+            bot.session_leases.issue(f'serve_user_{i}', f'serve_device_{i}'))
+
+    for clients in args.clients:
+        print(f"🔬 Режимы сервера: {clients} клиентов, {rounds} heartbeat "
+              f"с паузой {think*1000:.0f}ms")
+
+        result = _run_threaded_clients(clients, rounds, think, leases)
+        if 'error' in result:
+            print(f"   • threaded: не удалось запустить потоки после "
+                  f"{result['started']}: {result['error']}")
+        else:
+            report('threaded', result['latencies'], result['elapsed'])
+            print(f"     потоков: {result['threads']}, "
+                  f"wall {result['elapsed']:.2f}s")
+
+        result = asyncio.run(_run_async_clients(clients, rounds, think, leases))
+        report('asgi', result['latencies'], result['elapsed'])
+        print(f"     потоков: {result['threads']}, "
+              f"wall {result['elapsed']:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки Sparkcoin API')
+    parser.add_argument('name', choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--bets', type=int, default=10000)
+    parser.add_argument('--clients',
+                        type=lambda value: [int(n) for n in value.split(',')],
+                        default=[1000, 5000, 10000])
+    args = parser.parse_args()
+
+    names = sorted(BENCHMARKS) if args.name == 'all' else [args.name]
+    for name in names:
+        BENCHMARKS[name](args)
+        print()
+
+
+if __name__ == '__main__':
+    main()
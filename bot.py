@@ -1,21 +1,56 @@
 # high_performance_api.py - ВЫСОКОПРОИЗВОДИТЕЛЬНЫЙ API СЕРВЕР SPARKCOIN
+import io
 import os
+import re
+import sys
 import json
+import queue
+import atexit
 import logging
 import sqlite3
 import random
+import math
 import time
 import threading
 import asyncio
+import contextvars
 import aiosqlite
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, jsonify, request, make_response, g
-import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from flask import (Flask, Response, jsonify, request, make_response, g,
+                   has_request_context)
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+import hmac
 import hashlib
-from functools import wraps
+from functools import partial, wraps, lru_cache
+from urllib.parse import parse_qs, urlencode
 import cachetools
+from migrate_nano import NanoUnitMigration, SCHEMA_VERSION
+import gzip
+from sortedcontainers import SortedList
+
+try:
+    import brotli  # Необязательно: brotli-варианты снимков ответов
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack  # Необязательно: ответы в MessagePack по заголовку Accept
+except ImportError:
+    msgpack = None
+
+try:
+    import fcntl  # Необязательно (POSIX): блокировка "один процесс на БД"
+except ImportError:
+    fcntl = None
 
 # ============================================================================
 # НАСТРОЙКА ВЫСОКОЙ ПРОИЗВОДИТЕЛЬНОСТИ
@@ -31,7 +66,9 @@ PERFORMANCE_CONFIG = {
     'MAX_RESPONSE_TIME_MS': 120,  # Максимальное время ответа
     'SESSION_TIMEOUT_SEC': 15,  # Таймаут сессии
     'DB_TIMEOUT_MS': 50,  # Таймаут БД
-    'CACHE_TTL_SEC': 5,  # Время жизни кэша
+    'CACHE_TTL_SEC': 5,  # Время жизни кэша (маршруты без своего TTL)
+    'CACHE_FLIGHT_WAIT_SEC': 2,  # Ожидание чужого вычисления записи кэша
+    'CACHE_REFRESH_THREADS': 2,  # Потоков фонового обновления устаревших записей
     'MAX_CACHE_SIZE': 1000,  # Максимальный размер кэша
     'MAX_CONCURRENT_DB': 20,  # Максимальное количество соединений
     'USE_ASYNC_DB': True,  # Использовать асинхронную БД
@@ -39,15 +76,296 @@ PERFORMANCE_CONFIG = {
     'COMPRESS_RESPONSES': True,  # Сжатие ответов
     'MINIMIZE_LOGGING': True,  # Минимальное логирование
     'OPTIMIZE_JSON': True,  # Оптимизация JSON
+    'WRITE_BEHIND_ENABLED': True,  # Отложенная запись синхронизации
+    'WRITE_BEHIND_FLUSH_MS': 250,  # Максимальная задержка записи в БД
+    'WRITE_BEHIND_MAX_BATCH': 500,  # Строк в одном групповом коммите
+    'WRITE_BEHIND_STATE_SIZE': 100000,  # Игроков в памяти
+    'QUERY_CACHE_TTL_SEC': 30,  # Время жизни записи кэша запросов
+    'QUERY_CACHE_MAX_BYTES': 32 * 1024 * 1024,  # Лимит памяти кэша запросов
+    'SESSION_SHARDS': 16,  # Шарды хранилища сессий (у каждого своя блокировка)
+    # Хранилище сессий: 'memory' или 'sqlite' (сессии переживают перезапуск)
+    'SESSION_BACKEND': os.environ.get('SPARKCOIN_SESSION_BACKEND', 'memory'),
+    'SESSION_DB_PATH': 'sparkcoin_sessions.db',
+    'SESSION_LEASE_SEC': 15,  # Срок подписанной аренды (не больше таймаута сессии)
+    'SESSION_LEASE_RENEW_SEC': 6,  # Продлеваем аренду, когда осталось меньше
+    'LEADERBOARD_RELOAD_SEC': 60,  # Сверка индекса рейтингов с БД
+    'COMPRESS_MIN_BYTES': 1024,  # Сжимаем ответы не меньше этого размера
+    'LOTTERY_ROUND_SEC': 60,  # Длительность раунда командной лотереи
+    'LOTTERY_FLUSH_MS': 100,  # Максимальная задержка записи ставок в БД
+    'LOTTERY_MAX_BATCH': 1000,  # Ставок в одном групповом коммите
+    'CLASSIC_ROUND_SEC': 120,  # Длительность раунда классической лотереи
+    'CLASSIC_CHECKPOINT_SEC': 5,  # Период снимка состояния раунда в SQLite
+    'CLASSIC_HISTORY_SIZE': 10,  # Последних розыгрышей в статусе
+    'CLASSIC_RECENT_BETS': 20,  # Последних ставок раунда в статусе
+    'STREAM_PUBLISH_MS': 500,  # Период проверки изменений для SSE
+    'STREAM_HEARTBEAT_SEC': 15,  # Пинг подписчика при отсутствии событий
+    'STREAM_MAX_CLIENTS': 5000,  # Лимит одновременных SSE-подключений
+    # Режим сервера: 'threaded' (Flask, поток на запрос) или 'asgi' (asyncio)
+    'SERVING_MODE': os.environ.get('SPARKCOIN_SERVING_MODE', 'threaded'),
+    'ASYNC_DB_CONNECTIONS': 4,  # Соединений aiosqlite в ASGI-режиме
+    'ASGI_WSGI_THREADS': 32,  # Потоков для Flask-маршрутов в ASGI-режиме
+    'DB_WRITE_TIMEOUT_SEC': 5,  # Ожидание писателя и свободного читателя
+    'TRANSFER_MAX_BATCH': 500,  # Переводов в одном пакете движка
+    'TRANSFER_IDEMPOTENCY_CACHE': 100000,  # Ключей идемпотентности в памяти
+    'ADMISSION_ENABLED': True,  # Контроль допуска и сброс нагрузки
+    'RATE_LIMIT_IP': (50, 100),  # Запросов в секунду и запас с одного IP
+    'RATE_LIMIT_USER': (10, 30),  # Запросов в секунду и запас одного игрока
+    'RATE_LIMIT_KEYS': 100000,  # Корзин токенов в памяти (по каждому виду)
+    # Класс маршрута -> (потолок одновременных запросов класса, доля
+    # адаптивного лимита; None - класс адаптивным лимитом не ограничен)
+    'ADMISSION_CLASSES': {
+        'critical': (64, None),
+        'normal': (64, 0.9),
+        'low': (48, 0.7)
+    },
+    'ADMISSION_LIMIT': (64, 8, 256),  # Адаптивный лимит: начальный, мин, макс
+    'ADMISSION_WINDOW': 200,  # Ответов в окне замера p95
+    'ADMISSION_BACKOFF': 0.8,  # Множитель лимита, когда p95 выше цели
+    'ADMISSION_RETRY_AFTER_SEC': 1,  # Retry-After при сбросе нагрузки
+    'METRICS_ENABLED': True,  # Гистограммы задержек маршрутов и запросов БД
+    'METRICS_MAX_SERIES': 500,  # Гистограмм на вид, остальное - в "other"
+    'DEADLINES_ENABLED': True,  # Бюджет маршрута прерывает его чтения из БД
+    'DEADLINE_CHECK_OPS': 1000,  # Инструкций SQLite между проверками дедлайна
+    'DEADLINE_RETRY_AFTER_SEC': 1,  # Retry-After ответа по исчерпанному бюджету
+    'SLOW_QUERY_LOG_ENABLED': True,  # Журнал медленных запросов с планами
+    'SLOW_QUERY_MS': 50,  # Запрос медленнее этого попадает в журнал
+    'SLOW_QUERY_SAMPLE_RATE': 0.001,  # Доля всех запросов в журнале (0 - выкл.)
+    'SLOW_QUERY_LOG_SIZE': 1000,  # Последних записей в кольцевом буфере
+    'SLOW_QUERY_FINGERPRINTS': 500,  # Отпечатков со статистикой и планом
+}
+
+# ============================================================================
+# ДЕНЕЖНЫЕ ВЕЛИЧИНЫ: ЦЕЛЫЕ НАНО-ЕДИНИЦЫ
+# ============================================================================
+# Балансы, скорости, ставки и выигрыши хранятся и считаются как int64
+# в единицах 1e-9 S; в float переводятся только на границе JSON
+NANO = 1_000_000_000
+
+
+def to_nano(value) -> int:
+    """Сумма в S (из JSON) в нано-единицы с округлением до ближайшей"""
+    return int(round(float(value) * NANO))
+
+
+def from_nano(units: Optional[int]) -> float:
+    """Нано-единицы в S для ответа JSON"""
+    return (units or 0) / NANO
+
+
+# ============================================================================
+# ПАССИВНЫЙ ДОХОД: ЛЕНИВОЕ НАЧИСЛЕНИЕ МАЙНИНГА
+# ============================================================================
+# В строке игрока balance и total_earned - значения на момент accrued_since
+# (мс); текущие = значение + mine_speed * прошедшее время. Майнинг сам по себе
+# ничего не пишет: строка меняется только кликами, улучшениями и переводами
+ACCRUED_FIELDS = ('balance', 'total_earned')
+
+# Прирост майнинга за уровень улучшения, нано-единиц в секунду
+# (baseBonus улучшений типа mining в core.js)
+MINING_SPEED_PER_LEVEL = {
+    f'{kind}{tier}': 8**(tier - 1)
+    for kind in ('gpu', 'cpu') for tier in range(1, 9)
 }
 
-# КЭШ В ПАМЯТИ ДЛЯ БЫСТРЫХ ОТВЕТОВ
-response_cache = cachetools.TTLCache(
-    maxsize=PERFORMANCE_CONFIG['MAX_CACHE_SIZE'],
-    ttl=PERFORMANCE_CONFIG['CACHE_TTL_SEC'])
+MAX_UPGRADE_ENTRIES = 64
+MAX_UPGRADE_LEVEL = 10000
+
+
+def now_ms() -> int:
+    """Время начисления: мс Unix-времени"""
+    return int(time.time() * 1000)
+
+
+def normalize_upgrades(raw) -> Optional[str]:
+    """Уровни улучшений клиента -> канонический JSON; None - нет или с ошибкой.
+
+    Клиенты присылают и {id: уровень}, и {id: {level: уровень}}; нулевые
+    уровни отбрасываются, чтобы одинаковые наборы давали одну строку.
+    """
+    if not isinstance(raw, dict) or len(raw) > MAX_UPGRADE_ENTRIES:
+        return None
+
+    levels = {}
+    for upgrade_id, value in raw.items():
+        if isinstance(value, dict):
+            value = value.get('level', 0)
+        try:
+            level = int(value)
+        except (TypeError, ValueError):
+            return None
+        if not 0 <= level <= MAX_UPGRADE_LEVEL or len(str(upgrade_id)) > 32:
+            return None
+        if level:
+            levels[str(upgrade_id)] = level
+    return json.dumps(levels, sort_keys=True, separators=(',', ':'))
+
+
+def mining_speed(upgrades: Optional[str]) -> int:
+    """Скорость майнинга (нано/сек) по каноническому JSON улучшений"""
+    levels = json.loads(upgrades or '{}')
+    return sum(
+        MINING_SPEED_PER_LEVEL.get(upgrade_id, 0) * level
+        for upgrade_id, level in levels.items())
+
+
+def mined_since(player: Dict, now: int) -> int:
+    """Намайнено с accrued_since до now; доли нано-единицы отбрасываются"""
+    since = player.get('accrued_since') or now
+    if now <= since:
+        return 0
+    return (player.get('mine_speed') or 0) * (now - since) // 1000
+
+
+def accrue(player: Dict, now: int) -> Dict:
+    """Начисление майнинга на момент now в самой записи игрока.
+
+    Намайненное становится частью balance/total_earned, accrued_since
+    переходит на now. Для чтения без изменения записи -
+    accrue(dict(player), now).
+    """
+    mined = mined_since(player, now)
+    if mined:
+        player['balance'] += mined
+        player['total_earned'] += mined
+    player['accrued_since'] = max(player.get('accrued_since') or now, now)
+    return player
+
+
+# КЭШ ДЛЯ БАЗЫ ДАННЫХ С ИНВАЛИДАЦИЕЙ ПО ТАБЛИЦАМ
+class TableTaggedQueryCache:
+    """Кэш SELECT-запросов: записи помечены прочитанными таблицами и их версиями"""
+
+    TABLE_PATTERN = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+([A-Za-z_]\w*)',
+                               re.IGNORECASE)
+    # Следующая таблица списка через запятую: FROM a x, b AS y, c
+    TABLE_LIST_PATTERN = re.compile(
+        r'(?:\s+(?:AS\s+)?[A-Za-z_]\w*)?\s*,\s*([A-Za-z_]\w*)', re.IGNORECASE)
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.entries: 'OrderedDict[str, Tuple]' = OrderedDict()
+        self.table_versions: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'expirations': 0,
+            'evictions': 0
+        }
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def tables_of(query: str) -> Tuple[str, ...]:
+        """Таблицы, которые читает или пишет запрос (с неявными соединениями)"""
+        tables = set()
+        for match in TableTaggedQueryCache.TABLE_PATTERN.finditer(query):
+            tables.add(match.group(1).lower())
+            end = match.end()
+            while True:
+                item = TableTaggedQueryCache.TABLE_LIST_PATTERN.match(query, end)
+                if item is None:
+                    break
+                tables.add(item.group(1).lower())
+                end = item.end()
+        return tuple(sorted(tables))
+
+    @staticmethod
+    def _estimate_size(results: List[Dict]) -> int:
+        """Примерный размер результата в байтах"""
+        size = sys.getsizeof(results)
+        for row in results:
+            size += sys.getsizeof(row)
+            for value in row.values():
+                size += sys.getsizeof(value)
+        return size
+
+    def snapshot(self, query: str) -> Tuple:
+        """Версии таблиц запроса - снимаются ДО выполнения запроса"""
+        with self.lock:
+            return tuple((table, self.table_versions.get(table, 0))
+                         for table in self.tables_of(query))
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            results, versions, expires_at, size = entry
+            if time.monotonic() > expires_at:
+                self._drop(key, size)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+
+            for table, version in versions:
+                if self.table_versions.get(table, 0) != version:
+                    self._drop(key, size)
+                    self.stats['invalidations'] += 1
+                    self.stats['misses'] += 1
+                    return None
+
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return results
+
+    def put(self, key: str, results: List[Dict], versions: Tuple):
+        size = self._estimate_size(results)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[3]
+
+            self.entries[key] = (results, versions,
+                                 time.monotonic() + self.ttl, size)
+            self.total_bytes += size
+
+            # Вытесняем самые старые записи до укладывания в лимит байт
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted[3]
+                self.stats['evictions'] += 1
+
+    def _drop(self, key: str, size: int):
+        del self.entries[key]
+        self.total_bytes -= size
+
+    def invalidate_tables(self, *tables: str):
+        """Запись в таблицы - увеличиваем их версии"""
+        with self.lock:
+            for table in tables:
+                table = table.lower()
+                self.table_versions[table] = self.table_versions.get(table,
+                                                                     0) + 1
+
+    def invalidate_query(self, query: str):
+        self.invalidate_tables(*self.tables_of(query))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats, 'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hit_ratio': self.stats['hits'] / lookups if lookups else 0.0,
+                'table_versions': dict(self.table_versions)
+            }
+
 
-# КЭШ ДЛЯ БАЗЫ ДАННЫХ
-query_cache = cachetools.LRUCache(maxsize=500)
+query_cache = TableTaggedQueryCache(
+    max_bytes=PERFORMANCE_CONFIG['QUERY_CACHE_MAX_BYTES'],
+    ttl_seconds=PERFORMANCE_CONFIG['QUERY_CACHE_TTL_SEC'])
 
 # КОНФИГУРАЦИЯ CORS ДЛЯ МАКСИМАЛЬНОЙ СКОРОСТИ
 ALLOWED_ORIGINS = {
@@ -57,366 +375,4747 @@ ALLOWED_ORIGINS = {
 }
 
 
-# МЕНЕДЖЕР АКТИВНЫХ СЕССИЙ
-class HighPerformanceSessionManager:
-    """Менеджер сессий для блокировки мультисессии с минимальными задержками"""
+# МЕНЕДЖЕР АКТИВНЫХ СЕССИЙ
+class SessionRecord:
+    """Компактная запись сессии (без словаря на каждый объект)"""
+
+    __slots__ = ('user_id', 'device_id', 'ip_address', 'user_agent',
+                 'telegram_id', 'created_at', 'last_activity',
+                 'request_count', 'lease_until', 'nonce', 'wheel_tick')
+
+    def __init__(self, user_id: str, device_id: str, ip_address: str,
+                 user_agent: str, telegram_id: Optional[str],
+                 current_time: float, nonce: Optional[str] = None):
+        self.user_id = user_id
+        self.device_id = device_id
+        self.ip_address = ip_address
+        self.user_agent = user_agent
+        self.telegram_id = telegram_id
+        self.created_at = current_time
+        self.last_activity = current_time
+        self.request_count = 0
+        self.lease_until = 0.0
+        # Случайный идентификатор сессии: входит в подпись аренды, поэтому
+        # аренды освобожденной или перехваченной сессии недействительны
+        self.nonce = nonce or os.urandom(8).hex()
+        self.wheel_tick: Optional[int] = None
+
+
+class SessionTimingWheel:
+    """Хешированное колесо таймеров: сессии разложены по слотам момента истечения"""
+
+    def __init__(self, tick_seconds: float, horizon_seconds: float):
+        self.tick_seconds = tick_seconds
+        # Колесо покрывает весь горизонт истечения - записи не делают лишних оборотов
+        self.slot_count = int(horizon_seconds / tick_seconds) + 4
+        self.slots: List[set] = [set() for _ in range(self.slot_count)]
+        self.current_tick = self._tick_of(time.time())
+
+    def _tick_of(self, timestamp: float) -> int:
+        return int(timestamp / self.tick_seconds)
+
+    def schedule(self, record: SessionRecord, expires_at: float):
+        """Постановка (или перенос) записи на момент истечения - O(1)"""
+        tick = max(self._tick_of(expires_at), self.current_tick)
+        if record.wheel_tick == tick:
+            return
+        self.cancel(record)
+        self.slots[tick % self.slot_count].add(record)
+        record.wheel_tick = tick
+
+    def cancel(self, record: SessionRecord):
+        if record.wheel_tick is not None:
+            self.slots[record.wheel_tick % self.slot_count].discard(record)
+            record.wheel_tick = None
+
+    def advance(self, now: float) -> List[SessionRecord]:
+        """Прокрутка колеса до текущего момента - трогаем только наступившие слоты"""
+        now_tick = self._tick_of(now)
+        expired = []
+
+        first_tick = max(self.current_tick, now_tick - self.slot_count + 1)
+        for tick in range(first_tick, now_tick + 1):
+            slot = self.slots[tick % self.slot_count]
+            if not slot:
+                continue
+            due = [record for record in slot if record.wheel_tick <= now_tick]
+            for record in due:
+                slot.discard(record)
+                record.wheel_tick = None
+            expired.extend(due)
+
+        self.current_tick = max(self.current_tick, now_tick + 1)
+        return expired
+
+    def count_scheduled_after(self, timestamp: float) -> int:
+        """Число записей, истекающих позже указанного момента - O(слотов)"""
+        first_tick = max(self._tick_of(timestamp) + 1, self.current_tick)
+        last_tick = self.current_tick + self.slot_count - 1
+        return sum(
+            len(self.slots[tick % self.slot_count])
+            for tick in range(first_tick, last_tick + 1))
+
+
+class SessionShard:
+    """Шард хранилища сессий: свой индекс, колесо таймеров, блокировка и счетчики"""
+
+    def __init__(self, expire_after: float, tick_seconds: float):
+        # Индекс user_id -> {device_id -> сессия}
+        self.sessions: Dict[str, Dict[str, SessionRecord]] = {}
+        self.lock = threading.RLock()
+        self.expire_after = expire_after
+        self.wheel = SessionTimingWheel(tick_seconds, expire_after)
+
+        # Счетчики поддерживаются при каждом изменении
+        self.session_count = 0
+        self.total_requests = 0
+
+    def remove(self, record: SessionRecord):
+        """Удаление сессии из индекса и колеса (под блокировкой шарда)"""
+        devices = self.sessions.get(record.user_id)
+        if devices is None or devices.get(record.device_id) is not record:
+            return
+        del devices[record.device_id]
+        if not devices:
+            del self.sessions[record.user_id]
+        self.wheel.cancel(record)
+        self.session_count -= 1
+        self.total_requests -= record.request_count
+
+    def add(self, record: SessionRecord):
+        previous = self.sessions.get(record.user_id, {}).get(record.device_id)
+        if previous is not None:
+            self.remove(previous)
+        self.sessions.setdefault(record.user_id, {})[record.device_id] = record
+        self.session_count += 1
+        self.wheel.schedule(record, record.last_activity + self.expire_after)
+
+    def touch(self,
+              record: SessionRecord,
+              current_time: float,
+              lease_until: Optional[float] = None):
+        record.last_activity = current_time
+        if lease_until is not None:
+            record.lease_until = lease_until
+        record.request_count += 1
+        self.total_requests += 1
+        self.wheel.schedule(record, current_time + self.expire_after)
+
+    def expire(self, current_time: float) -> int:
+        """Удаление сессий из наступивших слотов колеса"""
+        removed = 0
+        for session in self.wheel.advance(current_time):
+            # Перестраховка: запись могла обновиться в пределах тика
+            if current_time - session.last_activity > self.expire_after:
+                self.remove(session)
+                removed += 1
+            else:
+                self.wheel.schedule(session,
+                                    session.last_activity + self.expire_after)
+        return removed
+
+    def count_active(self, current_time: float, timeout: float) -> int:
+        """Активные сессии: последняя активность позже now - timeout"""
+        return self.wheel.count_scheduled_after(current_time - timeout +
+                                                self.expire_after)
+
+
+class HighPerformanceSessionManager:
+    """Менеджер сессий для блокировки мультисессии с минимальными задержками"""
+
+    def __init__(self, shard_count: Optional[int] = None):
+        self.expire_after = PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC'] * 3
+        self.cleanup_interval = 1  # секунд (один тик колеса)
+
+        # Хранилище разбито на шарды по хэшу user_id - у каждого своя блокировка
+        self.shard_count = shard_count or PERFORMANCE_CONFIG['SESSION_SHARDS']
+        self.shards = [
+            SessionShard(self.expire_after, self.cleanup_interval)
+            for _ in range(self.shard_count)
+        ]
+
+        # Запускаем фоновую очистку
+        self._start_cleanup()
+
+    def _shard(self, user_id: str) -> SessionShard:
+        return self.shards[hash(user_id) % self.shard_count]
+
+    def _start_cleanup(self):
+        """Фоновая очистка старых сессий"""
+
+        def cleanup():
+            while True:
+                try:
+                    self.cleanup_expired_sessions()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки сессий: {e}")
+                time.sleep(self.cleanup_interval)
+
+        thread = threading.Thread(target=cleanup, daemon=True)
+        thread.start()
+
+    def register_session(
+            self,
+            user_id: str,
+            device_id: str,
+            ip_address: str,
+            user_agent: str,
+            telegram_id: Optional[str] = None) -> Tuple[bool, str]:
+        """
+        Регистрация новой сессии с блокировкой мультисессии
+        Возвращает: (успех, сообщение)
+        """
+        start_time = time.perf_counter()
+        timeout = PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC']
+        shard = self._shard(user_id)
+
+        with shard.lock:
+            current_time = time.time()
+
+            # Проверяем только сессии этого пользователя - O(устройств)
+            devices = shard.sessions.get(user_id, {})
+            previous = devices.get(device_id)
+            for session in list(devices.values()):
+                # Если сессия активна (менее 15 секунд или действует аренда)
+                # и с другого устройства
+                if ((current_time - session.last_activity < timeout
+                     or session.lease_until > current_time)
+                        and session.device_id != device_id):
+                    # БЛОКИРУЕМ мультисессию
+                    elapsed = time.perf_counter() - start_time
+                    logger.warning(
+                        f"🚫 Мультисессия заблокирована: {user_id} с {device_id}, активна на {session.device_id} (время: {elapsed*1000:.1f}ms)"
+                    )
+                    return False, "Активная сессия обнаружена на другом устройстве"
+
+            # Сессии других устройств неактивны - перехват их закрывает
+            for session in list(devices.values()):
+                if session.device_id != device_id:
+                    shard.remove(session)
+
+            # Регистрируем новую сессию; то же устройство сохраняет nonce
+            shard.add(
+                SessionRecord(user_id, device_id, ip_address,
+                              user_agent[:100], telegram_id, current_time,
+                              previous.nonce if previous is not None else None))
+
+        elapsed = time.perf_counter() - start_time
+        logger.info(
+            f"✅ Сессия зарегистрирована: {user_id} за {elapsed*1000:.1f}ms")
+        return True, "Сессия создана"
+
+    def update_activity(self,
+                        user_id: str,
+                        device_id: str,
+                        lease_until: Optional[float] = None) -> bool:
+        """Обновление времени активности сессии (и срока выданной аренды)"""
+        shard = self._shard(user_id)
+
+        with shard.lock:
+            session = shard.sessions.get(user_id, {}).get(device_id)
+            if session is not None:
+                shard.touch(session, time.time(), lease_until)
+                return True
+        return False
+
+    def session_nonce(self, user_id: str, device_id: str) -> Optional[str]:
+        """nonce текущей сессии устройства или None.
+
+        Без блокировки шарда: чтение словарей атомарно под GIL, а запись
+        сессии меняется целиком - heartbeat по аренде не ждет регистраций.
+        """
+        session = self._shard(user_id).sessions.get(user_id, {}).get(device_id)
+        return session.nonce if session is not None else None
+
+    def release_session(self, user_id: str, device_id: str) -> bool:
+        """Освобождение сессии при закрытии клиента"""
+        shard = self._shard(user_id)
+
+        with shard.lock:
+            session = shard.sessions.get(user_id, {}).get(device_id)
+            if session is None:
+                return False
+            shard.remove(session)
+            return True
+
+    def cleanup_expired_sessions(self):
+        """Очистка просроченных сессий - только слоты, срок которых наступил"""
+        removed = 0
+
+        for shard in self.shards:
+            with shard.lock:
+                removed += shard.expire(time.time())
+
+        if removed:
+            logger.info(f"🧹 Удалено {removed} просроченных сессий")
+
+    def get_session_stats(self) -> Dict:
+        """Статистика сессий из счетчиков шардов - без обхода сессий"""
+        timeout = PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC']
+        current_time = time.time()
+        total_sessions = 0
+        active = 0
+        total_requests = 0
+
+        for shard in self.shards:
+            with shard.lock:
+                total_sessions += shard.session_count
+                total_requests += shard.total_requests
+                active += shard.count_active(current_time, timeout)
+
+        return {
+            'total_sessions': total_sessions,
+            'active_sessions': active,
+            'total_requests': total_requests,
+            'session_timeout': timeout,
+            'shards': self.shard_count,
+            'backend': 'memory'
+        }
+
+    def check_session(self, user_id: str, device_id: str) -> Tuple[bool, str]:
+        """Проверка валидности сессии"""
+        shard = self._shard(user_id)
+
+        with shard.lock:
+            session = shard.sessions.get(user_id, {}).get(device_id)
+            if session is None:
+                return False, "Сессия не найдена"
+
+            current_time = time.time()
+
+            if current_time - session.last_activity > PERFORMANCE_CONFIG[
+                    'SESSION_TIMEOUT_SEC']:
+                return False, "Сессия истекла"
+
+            return True, "Сессия активна"
+
+
+class SQLiteSessionManager:
+    """Хранилище сессий в таблице SQLite (WAL): переживает перезапуск сервера.
+
+    Одна строка на пользователя с активным устройством; захват сессии другим
+    устройством - атомарный compare-and-set внутри одного UPSERT. Несколько
+    воркеров это не разрешает: игроки, лотереи и переводы живут в памяти
+    процесса (см. acquire_process_lock).
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.expire_after = PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC'] * 3
+        self.cleanup_interval = 10  # секунд
+        # user_id -> (device_id, nonce): проверка аренды без запроса к БД.
+        # Сессии меняет только этот процесс (см. acquire_process_lock)
+        self.nonces: Dict[str, Tuple[str, str]] = {}
+        self.nonces_lock = threading.Lock()
+
+        conn = self._get_connection()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS active_sessions (
+                user_id TEXT PRIMARY KEY,
+                device_id TEXT NOT NULL,
+                ip_address TEXT,
+                user_agent TEXT,
+                telegram_id TEXT,
+                created_at REAL NOT NULL,
+                last_activity REAL NOT NULL,
+                request_count INTEGER DEFAULT 0,
+                lease_until REAL DEFAULT 0,
+                nonce TEXT NOT NULL DEFAULT ''
+            ) WITHOUT ROWID;
+
+            CREATE INDEX IF NOT EXISTS idx_sessions_activity
+                ON active_sessions (last_activity);
+        ''')
+        columns = {
+            row[1]
+            for row in conn.execute("PRAGMA table_info(active_sessions)")
+        }
+        if 'nonce' not in columns:
+            conn.execute("ALTER TABLE active_sessions "
+                         "ADD COLUMN nonce TEXT NOT NULL DEFAULT ''")
+
+        self._start_cleanup()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path,
+                                   timeout=1.0,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _start_cleanup(self):
+        """Фоновая очистка старых сессий"""
+
+        def cleanup():
+            while True:
+                try:
+                    self.cleanup_expired_sessions()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки сессий: {e}")
+                time.sleep(self.cleanup_interval)
+
+        thread = threading.Thread(target=cleanup, daemon=True)
+        thread.start()
+
+    def register_session(
+            self,
+            user_id: str,
+            device_id: str,
+            ip_address: str,
+            user_agent: str,
+            telegram_id: Optional[str] = None) -> Tuple[bool, str]:
+        """
+        Регистрация сессии: CAS на активное устройство пользователя
+        Возвращает: (успех, сообщение)
+        """
+        start_time = time.perf_counter()
+        current_time = time.time()
+
+        # Строка обновляется, только если устройство то же самое
+        # или сессия другого устройства уже неактивна и без аренды.
+        # Перехват другим устройством меняет nonce, то же устройство его
+        # сохраняет
+        row = self._get_connection().execute(
+            '''
+            INSERT INTO active_sessions
+            (user_id, device_id, ip_address, user_agent, telegram_id,
+             created_at, last_activity, nonce)
+            VALUES (?, ?, ?, ?, ?, ?, ?, lower(hex(randomblob(8))))
+            ON CONFLICT(user_id) DO UPDATE SET
+                nonce = CASE
+                    WHEN active_sessions.device_id = excluded.device_id
+                         AND active_sessions.nonce != ''
+                    THEN active_sessions.nonce ELSE excluded.nonce END,
+                device_id = excluded.device_id,
+                ip_address = excluded.ip_address,
+                user_agent = excluded.user_agent,
+                telegram_id = excluded.telegram_id,
+                created_at = excluded.created_at,
+                last_activity = excluded.last_activity,
+                request_count = 0,
+                lease_until = 0
+            WHERE active_sessions.device_id = excluded.device_id
+               OR (active_sessions.last_activity <= ?
+                   AND active_sessions.lease_until <= ?)
+            RETURNING nonce
+            ''', (user_id, device_id, ip_address, user_agent[:100],
+                  telegram_id, current_time, current_time,
+                  current_time - PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC'],
+                  current_time)).fetchone()
+
+        elapsed = time.perf_counter() - start_time
+        if row is None:
+            logger.warning(
+                f"🚫 Мультисессия заблокирована: {user_id} с {device_id} (время: {elapsed*1000:.1f}ms)"
+            )
+            return False, "Активная сессия обнаружена на другом устройстве"
+
+        with self.nonces_lock:
+            self.nonces[user_id] = (device_id, row[0])
+        logger.info(
+            f"✅ Сессия зарегистрирована: {user_id} за {elapsed*1000:.1f}ms")
+        return True, "Сессия создана"
+
+    def update_activity(self,
+                        user_id: str,
+                        device_id: str,
+                        lease_until: Optional[float] = None) -> bool:
+        """Обновление времени активности сессии (и срока выданной аренды)"""
+        cursor = self._get_connection().execute(
+            '''
+            UPDATE active_sessions
+            SET last_activity = ?, request_count = request_count + 1,
+                lease_until = COALESCE(?, lease_until)
+            WHERE user_id = ? AND device_id = ?
+            ''', (time.time(), lease_until, user_id, device_id))
+        return cursor.rowcount > 0
+
+    def session_nonce(self, user_id: str, device_id: str) -> Optional[str]:
+        """nonce текущей сессии устройства или None (БД - только при промахе)"""
+        with self.nonces_lock:
+            entry = self.nonces.get(user_id)
+            if entry is None:
+                # Промах после перезапуска; под блокировкой, чтобы не
+                # вернуть в кэш строку, которую успели освободить
+                row = self._get_connection().execute(
+                    "SELECT device_id, nonce FROM active_sessions "
+                    "WHERE user_id = ?", (user_id, )).fetchone()
+                if row is None:
+                    return None
+                entry = self.nonces[user_id] = (row[0], row[1])
+        return entry[1] if entry[0] == device_id and entry[1] else None
+
+    def release_session(self, user_id: str, device_id: str) -> bool:
+        """Освобождение сессии при закрытии клиента"""
+        cursor = self._get_connection().execute(
+            "DELETE FROM active_sessions WHERE user_id = ? AND device_id = ?",
+            (user_id, device_id))
+        if cursor.rowcount > 0:
+            with self.nonces_lock:
+                self.nonces.pop(user_id, None)
+            return True
+        return False
+
+    def cleanup_expired_sessions(self):
+        """Очистка просроченных сессий по индексу last_activity"""
+        removed = [
+            row[0] for row in self._get_connection().execute(
+                "DELETE FROM active_sessions WHERE last_activity < ? "
+                "RETURNING user_id", (time.time() - self.expire_after, ))
+        ]
+
+        if removed:
+            with self.nonces_lock:
+                for user_id in removed:
+                    self.nonces.pop(user_id, None)
+            logger.info(f"🧹 Удалено {len(removed)} просроченных сессий")
+
+    def get_session_stats(self) -> Dict:
+        """Статистика сессий"""
+        timeout = PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC']
+        row = self._get_connection().execute(
+            '''
+            SELECT COUNT(*),
+                   SUM(last_activity >= ?),
+                   SUM(request_count)
+            FROM active_sessions
+            ''', (time.time() - timeout, )).fetchone()
+
+        return {
+            'total_sessions': row[0],
+            'active_sessions': row[1] or 0,
+            'total_requests': row[2] or 0,
+            'session_timeout': timeout,
+            'backend': 'sqlite'
+        }
+
+    def check_session(self, user_id: str, device_id: str) -> Tuple[bool, str]:
+        """Проверка валидности сессии"""
+        row = self._get_connection().execute(
+            "SELECT device_id, last_activity FROM active_sessions WHERE user_id = ?",
+            (user_id, )).fetchone()
+
+        if row is None or row[0] != device_id:
+            return False, "Сессия не найдена"
+
+        if time.time() - row[1] > PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC']:
+            return False, "Сессия истекла"
+
+        return True, "Сессия активна"
+
+
+def create_session_manager():
+    """Выбор хранилища сессий: память процесса или таблица SQLite, которая
+    переживает перезапуск (сервер по-прежнему один процесс на БД)"""
+    if PERFORMANCE_CONFIG['SESSION_BACKEND'] == 'sqlite':
+        return SQLiteSessionManager(PERFORMANCE_CONFIG['SESSION_DB_PATH'])
+    return HighPerformanceSessionManager()
+
+
+# ИНИЦИАЛИЗАЦИЯ МЕНЕДЖЕРА СЕССИЙ
+session_manager = create_session_manager()
+
+
+# ПОДПИСАННЫЕ АРЕНДЫ СЕССИЙ
+class SessionLeaseManager:
+    """Аренды сессий: HMAC над user_id, device_id, сроком и nonce сессии.
+
+    Пока аренда действительна, heartbeat проверяется без обращения к
+    хранилищу сессий - сверяется только nonce, который хранилище держит в
+    памяти. Освобождение и перехват сессии меняют nonce, поэтому старые
+    аренды перестают проходить проверку. Хранилище трогаем при выдаче и
+    продлении аренды: там запоминается ее срок, и до его окончания другое
+    устройство не может перехватить сессию. Поэтому срок аренды не длиннее таймаута
+    сессии: упавшее устройство держит аккаунт не дольше SESSION_TIMEOUT_SEC.
+    Закрывающийся клиент освобождает сессию явно через /api/session/release.
+    """
+
+    def __init__(self, manager, secret: bytes):
+        self.manager = manager
+        self.secret = secret
+        self.lease_seconds = min(PERFORMANCE_CONFIG['SESSION_LEASE_SEC'],
+                                 PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC'])
+        self.renew_before = PERFORMANCE_CONFIG['SESSION_LEASE_RENEW_SEC']
+        self.stats = {'lease_hits': 0, 'store_checks': 0, 'leases_issued': 0}
+        # Счетчики растят потоки запросов и цикл событий ASGI
+        self.stats_lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def _sign(self, user_id: str, device_id: str, expires: int,
+              nonce: str) -> str:
+        message = f"{len(user_id)}:{user_id}{device_id}:{expires}:{nonce}".encode()
+        return hmac.new(self.secret, message,
+                        hashlib.sha256).hexdigest()[:32]
+
+    def issue(self, user_id: str, device_id: str,
+              now: Optional[float] = None) -> str:
+        """Выдача аренды с записью ее срока в хранилище:
+        '<срок>.<nonce>.<подпись>'"""
+        expires = int((now or time.time()) + self.lease_seconds)
+        self.manager.update_activity(user_id, device_id, lease_until=expires)
+        # Сессию успели освободить - такая аренда проверку не пройдет
+        nonce = self.manager.session_nonce(user_id, device_id) or ''
+        self._count('leases_issued')
+        signature = self._sign(user_id, device_id, expires, nonce)
+        return f"{expires}.{nonce}.{signature}"
+
+    def verify(self, user_id: str, device_id: str, lease: Optional[str],
+               now: Optional[float] = None) -> Optional[int]:
+        """Срок действительной аренды или None"""
+        if not lease:
+            return None
+        try:
+            expires_text, nonce, signature = lease.split('.', 2)
+            expires = int(expires_text)
+        except ValueError:
+            return None
+
+        if expires <= (now or time.time()) or not nonce:
+            return None
+        if not hmac.compare_digest(
+                signature, self._sign(user_id, device_id, expires, nonce)):
+            return None
+        # Аренда освобожденной или перехваченной сессии
+        if self.manager.session_nonce(user_id, device_id) != nonce:
+            return None
+        return expires
+
+    def _lease_fresh(self, user_id: str, device_id: str,
+                     lease: Optional[str], now: float) -> bool:
+        """Аренда действительна и продлевать ее еще рано"""
+        expires = self.verify(user_id, device_id, lease, now)
+        return expires is not None and expires - now > self.renew_before
+
+    def is_fresh(self, user_id: str, device_id: str,
+                 lease: Optional[str]) -> bool:
+        """Проверка аренды без хранилища: False - пора регистрировать сессию"""
+        if self._lease_fresh(user_id, device_id, lease, time.time()):
+            self._count('lease_hits')
+            return True
+        return False
+
+    async def heartbeat_async(
+            self,
+            user_id: str,
+            device_id: str,
+            lease: Optional[str] = None) -> Tuple[bool, str, Optional[str]]:
+        """heartbeat для ASGI-режима: SQLite-хранилище опрашивается в пуле потоков"""
+        now = time.time()
+        if self._lease_fresh(user_id, device_id, lease, now):
+            self._count('lease_hits')
+            return True, "Сессия активна", lease
+
+        if isinstance(self.manager, SQLiteSessionManager):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.heartbeat, user_id, device_id, lease, now)
+        # Хранилище в памяти: короткая блокировка шарда, без ввода-вывода
+        return self.heartbeat(user_id, device_id, lease, now)
+
+    def heartbeat(self,
+                  user_id: str,
+                  device_id: str,
+                  lease: Optional[str] = None,
+                  now: Optional[float] = None
+                  ) -> Tuple[bool, str, Optional[str]]:
+        """Проверка сессии: по аренде без блокировок или через хранилище с продлением"""
+        now = now or time.time()
+        if self._lease_fresh(user_id, device_id, lease, now):
+            self._count('lease_hits')
+            return True, "Сессия активна", lease
+
+        self._count('store_checks')
+        valid, message = self.manager.check_session(user_id, device_id)
+        if not valid:
+            return False, message, None
+
+        return True, message, self.issue(user_id, device_id, now)
+
+    def get_stats(self) -> Dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        checks = stats['lease_hits'] + stats['store_checks']
+        return {
+            **stats, 'lease_seconds': self.lease_seconds,
+            'store_check_ratio':
+            stats['store_checks'] / checks if checks else 0.0
+        }
+
+
+# Секрет из окружения - выданные аренды переживают перезапуск сервера
+session_leases = SessionLeaseManager(
+    session_manager,
+    os.environ.get('SPARKCOIN_LEASE_SECRET', '').encode() or os.urandom(32))
+
+
+# ============================================================================
+# МЕТРИКИ: HDR-ГИСТОГРАММЫ ЗАДЕРЖЕК И ЭКСПОРТ В ФОРМАТЕ PROMETHEUS
+# ============================================================================
+class LatencyHistogram:
+    """Гистограмма задержек в микросекундах с лог-линейными корзинами (HDR).
+
+    Значения до 2**SUB_BITS хранятся точно, дальше каждая степень двойки
+    делится на HALF корзин - относительная ошибка квантиля не больше
+    1/HALF (~3%) при фиксированной памяти и записи за O(1).
+    """
+
+    SUB_BITS = 6
+    HALF = 1 << (SUB_BITS - 1)
+    MAX_MICROS = 1 << 36  # ~19 часов - больше не бывает
+
+    __slots__ = ('counts', 'count', 'total_micros', 'max_micros', 'statuses',
+                 'lock')
+
+    def __init__(self):
+        self.counts = [0] * (self._index(self.MAX_MICROS - 1) + 1)
+        self.count = 0
+        self.total_micros = 0
+        self.max_micros = 0
+        self.statuses: Dict[int, int] = {}  # Ответы по статусу (маршруты)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def _index(cls, micros: int) -> int:
+        shift = micros.bit_length() - cls.SUB_BITS
+        if shift <= 0:
+            return micros
+        return shift * cls.HALF + (micros >> shift)
+
+    @classmethod
+    def _upper_micros(cls, index: int) -> int:
+        """Наибольшее значение, попадающее в корзину"""
+        if index < 2 * cls.HALF:
+            return index
+        shift = index // cls.HALF - 1
+        return ((index - shift * cls.HALF + 1) << shift) - 1
+
+    def record(self, seconds: float, status: Optional[int] = None):
+        micros = int(seconds * 1000000)
+        if micros >= self.MAX_MICROS:
+            micros = self.MAX_MICROS - 1
+        shift = micros.bit_length() - self.SUB_BITS
+        index = micros if shift <= 0 else shift * self.HALF + (micros >> shift)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_micros += micros
+            if micros > self.max_micros:
+                self.max_micros = micros
+            if status is not None:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def snapshot(self, quantiles: Tuple[float, ...]) -> Dict:
+        """Квантили (в секундах), число и сумма замеров"""
+        with self.lock:
+            counts = list(self.counts)
+            count, total, peak = self.count, self.total_micros, self.max_micros
+            statuses = dict(self.statuses)
+
+        values = {}
+        targets = sorted(quantiles)
+        seen = 0
+        position = 0
+        for index, bucket in enumerate(counts):
+            if not bucket:
+                continue
+            seen += bucket
+            while position < len(targets) and seen >= targets[position] * count:
+                values[targets[position]] = min(self._upper_micros(index),
+                                                peak) / 1000000
+                position += 1
+            if position == len(targets):
+                break
+        for quantile in targets[position:]:
+            values[quantile] = peak / 1000000
+        return {
+            'quantiles': values,
+            'count': count,
+            'sum': total / 1000000,
+            'statuses': statuses
+        }
+
+
+# Нормализация SQL: строковые и числовые литералы и списки IN схлопываются,
+# чтобы запросы с подставленными значениями попадали в одну гистограмму
+SQL_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_LIST_PATTERN = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+SQL_SPACE_PATTERN = re.compile(r'\s+')
+SQL_FINGERPRINT_HEAD_CHARS = 110
+SQL_FINGERPRINT_TAIL_CHARS = 60
+
+
+@lru_cache(maxsize=1024)
+def sql_fingerprint(query: str) -> str:
+    """Отпечаток запроса: литералы -> ?, пробелы схлопнуты, длина ограничена.
+
+    У длинного запроса остаются начало и конец: запросы с общим списком
+    колонок различаются условиями WHERE/ORDER BY в хвосте.
+    """
+    query = SQL_LITERAL_PATTERN.sub('?', query)
+    query = SQL_LIST_PATTERN.sub('(?+)', query)
+    query = SQL_SPACE_PATTERN.sub(' ', query).strip()
+    if len(query) > SQL_FINGERPRINT_HEAD_CHARS + SQL_FINGERPRINT_TAIL_CHARS:
+        query = (f'{query[:SQL_FINGERPRINT_HEAD_CHARS]} … '
+                 f'{query[-SQL_FINGERPRINT_TAIL_CHARS:]}')
+    return query
+
+
+class MetricsRegistry:
+    """Гистограммы задержек маршрутов и запросов БД, счетчики ответов.
+
+    Запись - поиск готовой гистограммы в словаре и инкремент под ее
+    собственной блокировкой; общая блокировка берется только при создании
+    новой серии. Число серий ограничено: лишние попадают в серию "other".
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+    OVERFLOW_LABEL = 'other'
+
+    def __init__(self, max_series: int):
+        self.max_series = max_series
+        self.started_at = time.time()
+        self.requests: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.statements: Dict[str, LatencyHistogram] = {}
+        self.lock = threading.Lock()
+
+    def _series(self, table: Dict, key, overflow_key) -> LatencyHistogram:
+        histogram = table.get(key)
+        if histogram is None:
+            with self.lock:
+                if key not in table and len(table) >= self.max_series:
+                    key = overflow_key
+                histogram = table.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def observe_request(self, method: str, route: str, status: int,
+                        seconds: float):
+        """Замер ответа маршрута (route - шаблон пути, а не сам путь)"""
+        histogram = self.requests.get((method, route))
+        if histogram is None:
+            histogram = self._series(self.requests, (method, route),
+                                     (method, self.OVERFLOW_LABEL))
+        histogram.record(seconds, status)
+
+    def observe_statement(self, query: str, seconds: float):
+        """Замер выполнения запроса SQL по его отпечатку"""
+        fingerprint = sql_fingerprint(query)
+        histogram = self.statements.get(fingerprint)
+        if histogram is None:
+            histogram = self._series(self.statements, fingerprint,
+                                     self.OVERFLOW_LABEL)
+        histogram.record(seconds)
+
+    @staticmethod
+    def _label(value) -> str:
+        return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    @classmethod
+    def _labels(cls, labels: Dict) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{cls._label(value)}"'
+                              for name, value in labels.items()) + '}'
+
+    def _summary(self, lines: List[str], name: str, help_text: str,
+                 series: List[Tuple[Dict, Dict]]):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} summary')
+        for labels, snapshot in series:
+            for quantile, value in snapshot['quantiles'].items():
+                lines.append(f'{name}'
+                             f'{self._labels({**labels, "quantile": quantile})}'
+                             f' {value:.6f}')
+            lines.append(f'{name}_sum{self._labels(labels)} '
+                         f'{snapshot["sum"]:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} '
+                         f'{snapshot["count"]}')
+
+    def render(self, families: List[Tuple]) -> str:
+        """Текстовый формат Prometheus: гистограммы, счетчики и переданные
+        семейства (имя, тип, описание, [(метки, значение)])"""
+        with self.lock:
+            requests = list(self.requests.items())
+            statements = list(self.statements.items())
+        requests = [({'method': method, 'route': route},
+                     histogram.snapshot(self.QUANTILES))
+                    for (method, route), histogram in requests]
+        statements = [({'statement': statement},
+                       histogram.snapshot(self.QUANTILES))
+                      for statement, histogram in statements]
+
+        lines: List[str] = []
+        self._summary(lines, 'sparkcoin_http_request_duration_seconds',
+                      'Время обработки HTTP-запроса по маршруту', requests)
+        self._summary(lines, 'sparkcoin_db_statement_duration_seconds',
+                      'Время выполнения запроса SQL по отпечатку', statements)
+
+        families = [('sparkcoin_http_responses_total', 'counter',
+                     'Ответы по маршруту и статусу',
+                     [({**labels, 'status': status}, count)
+                      for labels, snapshot in requests
+                      for status, count in snapshot['statuses'].items()]),
+                    ('sparkcoin_uptime_seconds', 'gauge',
+                     'Время работы процесса',
+                     [({}, time.time() - self.started_at)])] + families
+        for name, metric_type, help_text, samples in families:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{name}{self._labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+# ИНИЦИАЛИЗАЦИЯ МЕТРИК
+metrics = MetricsRegistry(PERFORMANCE_CONFIG['METRICS_MAX_SERIES'])
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий каждый запрос в гистограмме его отпечатка.
+
+    Замеряется шаг выполнения до первой строки: для выборок с сортировкой
+    или агрегатами это почти все время запроса, построчная выдача - нет.
+    """
+
+    def execute(self, sql, parameters=()):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, parameters, time.perf_counter() - start_time)
+
+    def executemany(self, sql, seq_of_parameters):
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # Параметров пакета в журнале нет - только отпечаток и время
+            self._observe(sql, None, time.perf_counter() - start_time)
+
+    def _observe(self, sql: str, parameters, seconds: float):
+        if PERFORMANCE_CONFIG['METRICS_ENABLED']:
+            metrics.observe_statement(sql, seconds)
+        if PERFORMANCE_CONFIG['SLOW_QUERY_LOG_ENABLED']:
+            slow_queries.observe(self.connection, sql, parameters, seconds)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого - TimedCursor (factory для connect)"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory() -> type:
+    """Класс соединения SQLite: с замером запросов или обычный"""
+    if (PERFORMANCE_CONFIG['METRICS_ENABLED']
+            or PERFORMANCE_CONFIG['SLOW_QUERY_LOG_ENABLED']):
+        return TimedConnection
+    return sqlite3.Connection
+
+
+# ============================================================================
+# ЖУРНАЛ МЕДЛЕННЫХ ЗАПРОСОВ: ОТПЕЧАТКИ, ПЛАНЫ И ВЫБОРКА ВСЕХ ЗАПРОСОВ
+# ============================================================================
+class SlowQueryLog:
+    """Медленные и выборочные запросы SQL с планом на каждый отпечаток.
+
+    В кольцевой буфер попадает каждый запрос медленнее порога и случайная
+    доля sample_rate всех остальных - так видны и быстрые пока полные
+    просмотры таблиц. EXPLAIN QUERY PLAN снимается один раз на отпечаток
+    на том же соединении, где выполнялся запрос.
+    """
+
+    def __init__(self, threshold_ms: float, sample_rate: float, size: int,
+                 max_fingerprints: int):
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.max_fingerprints = max_fingerprints
+        self.recent: deque = deque(maxlen=size)
+        self.fingerprints: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'slow': 0,
+            'sampled': 0,
+            'plans_captured': 0,
+            'plan_errors': 0,
+            'untracked': 0
+        }
+
+    def observe(self, conn: sqlite3.Connection, query: str, parameters,
+                seconds: float):
+        """Замер запроса; дешевый выход для быстрых и не попавших в выборку"""
+        slow = seconds >= self.threshold
+        if not slow and not (self.sample_rate
+                             and random.random() < self.sample_rate):
+            return
+
+        fingerprint = sql_fingerprint(query)
+        entry = {
+            'fingerprint': fingerprint,
+            'ms': round(seconds * 1000, 3),
+            'slow': slow,
+            'params': self._params(parameters),
+            'at': datetime.utcnow().isoformat() + 'Z'
+        }
+        with self.lock:
+            self.recent.append(entry)
+            self.stats['slow' if slow else 'sampled'] += 1
+            info = self.fingerprints.get(fingerprint)
+            if info is None:
+                if len(self.fingerprints) >= self.max_fingerprints:
+                    self.stats['untracked'] += 1
+                    return
+                info = self.fingerprints[fingerprint] = {
+                    'slow_count': 0,
+                    'sampled_count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'plan': None
+                }
+            info['slow_count' if slow else 'sampled_count'] += 1
+            info['total_ms'] += seconds * 1000
+            info['max_ms'] = max(info['max_ms'], seconds * 1000)
+            need_plan = info['plan'] is None and parameters is not None
+
+        if slow:
+            logger.warning(
+                f"⚠️ Медленный запрос: {seconds*1000:.1f}ms - {fingerprint}")
+        if need_plan:
+            self._capture_plan(conn, query, parameters, info)
+
+    @staticmethod
+    def _params(parameters) -> Optional[List[str]]:
+        """Параметры без значений - только тип и длина: в журнал не попадают
+        идентификаторы игроков и устройств, telegram_id и адреса"""
+        if parameters is None:
+            return None
+        values = (parameters.values()
+                  if isinstance(parameters, dict) else parameters)
+        return [
+            f"{type(value).__name__}({len(value)})"
+            if isinstance(value, (str, bytes)) else type(value).__name__
+            for value in values
+        ]
+
+    def _capture_plan(self, conn: sqlite3.Connection, query: str, parameters,
+                      info: Dict):
+        """EXPLAIN QUERY PLAN в обход TimedConnection (без самозамера).
+
+        Ошибка (например, прерывание по дедлайну) - план снимем в другой раз.
+        """
+        try:
+            rows = sqlite3.Connection.execute(
+                conn, f'EXPLAIN QUERY PLAN {query}', parameters).fetchall()
+        except Exception:
+            with self.lock:
+                self.stats['plan_errors'] += 1
+            return
+
+        depths: Dict[int, int] = {}
+        plan = []
+        for node_id, parent, _, detail in rows:
+            depths[node_id] = depths.get(parent, -1) + 1
+            plan.append('  ' * depths[node_id] + detail)
+        with self.lock:
+            if info['plan'] is None:
+                info['plan'] = plan
+                self.stats['plans_captured'] += 1
+
+    @staticmethod
+    def full_scans(plan: Optional[List[str]]) -> List[str]:
+        """Таблицы, которые план читает целиком (SCAN без индекса)"""
+        scans = []
+        for line in plan or ():
+            detail = line.strip()
+            if (detail.startswith('SCAN ') and ' INDEX ' not in detail
+                    and detail != 'SCAN CONSTANT ROW'):
+                scans.append(detail.split()[1])
+        return scans
+
+    def report(self, limit: int) -> Dict:
+        """Отпечатки по суммарному времени и последние записи буфера"""
+        with self.lock:
+            fingerprints = [(fingerprint, dict(info))
+                            for fingerprint, info in self.fingerprints.items()]
+            recent = list(self.recent)[-limit:] if limit > 0 else []
+
+        summary = []
+        for fingerprint, info in fingerprints:
+            histogram = metrics.statements.get(fingerprint)
+            summary.append({
+                'fingerprint': fingerprint,
+                'slowCount': info['slow_count'],
+                'sampledCount': info['sampled_count'],
+                'executions': histogram.count if histogram else None,
+                'totalMs': round(info['total_ms'], 3),
+                'maxMs': round(info['max_ms'], 3),
+                'plan': info['plan'],
+                'fullScans': self.full_scans(info['plan'])
+            })
+        summary.sort(key=lambda item: item['totalMs'], reverse=True)
+        recent.reverse()
+        return {'fingerprints': summary, 'recent': recent}
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {
+                **self.stats, 'fingerprints': len(self.fingerprints),
+                'buffered': len(self.recent),
+                'threshold_ms': self.threshold * 1000,
+                'sample_rate': self.sample_rate
+            }
+
+
+# ИНИЦИАЛИЗАЦИЯ ЖУРНАЛА МЕДЛЕННЫХ ЗАПРОСОВ
+slow_queries = SlowQueryLog(PERFORMANCE_CONFIG['SLOW_QUERY_MS'],
+                            PERFORMANCE_CONFIG['SLOW_QUERY_SAMPLE_RATE'],
+                            PERFORMANCE_CONFIG['SLOW_QUERY_LOG_SIZE'],
+                            PERFORMANCE_CONFIG['SLOW_QUERY_FINGERPRINTS'])
+
+
+# ============================================================================
+# ДЕДЛАЙНЫ ЗАПРОСОВ: БЮДЖЕТ МАРШРУТА И ПРЕРЫВАНИЕ ЧТЕНИЙ SQLITE
+# ============================================================================
+# Бюджет задает time_limit маршрута; дедлайн проверяют только читатели -
+# задания писателя выполняются в его потоке и не прерываются никогда
+class DeadlineExceeded(Exception):
+    """Бюджет запроса исчерпан: чтение прервано, нужен деградированный ответ"""
+
+
+# Момент time.perf_counter(), после которого чтения текущего запроса прерываются
+request_deadline: contextvars.ContextVar = contextvars.ContextVar(
+    'request_deadline', default=None)
+
+
+@contextmanager
+def deadline_scope(budget_ms: float):
+    """Дедлайн на время блока; вложенный бюджет не продлевает внешний"""
+    deadline = time.perf_counter() + budget_ms / 1000
+    outer = request_deadline.get()
+    if outer is not None and outer < deadline:
+        deadline = outer
+    token = request_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        request_deadline.reset(token)
+
+
+def deadline_handler(deadline: float) -> Callable[[], bool]:
+    """Обработчик прогресса SQLite: True прерывает выполняемый запрос"""
+    clock = time.perf_counter
+    return lambda: clock() > deadline
+
+
+# ============================================================================
+# ВЫСОКОПРОИЗВОДИТЕЛЬНАЯ БАЗА ДАННЫХ
+# ============================================================================
+class ReaderPool:
+    """Ограниченный пул соединений только для чтения: выдача и возврат.
+
+    Соединение всегда принадлежит одному потоку между checkout и checkin -
+    пул не закрывает соединения, которыми кто-то пользуется.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection],
+                 max_size: int, checkout_timeout: float):
+        self.connect = connect
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.idle: queue.LifoQueue = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.waiting = 0
+
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'deadline_exceeded': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+
+    def _checkout(self, deadline: Optional[float]) -> sqlite3.Connection:
+        if deadline is not None and time.perf_counter() > deadline:
+            self.stats['deadline_exceeded'] += 1
+            raise DeadlineExceeded('бюджет исчерпан до чтения')
+        self.stats['checkouts'] += 1
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_create = self.created < self.max_size
+            if can_create:
+                self.created += 1
+        if can_create:
+            try:
+                return self.connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+
+        # Все соединения заняты - ждем возврата, но не дольше бюджета запроса
+        start_time = time.perf_counter()
+        timeout = self.checkout_timeout
+        if deadline is not None:
+            timeout = min(timeout, max(0.0, deadline - start_time))
+        with self.lock:
+            self.waiting += 1
+        try:
+            conn = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            if timeout < self.checkout_timeout:
+                self.stats['deadline_exceeded'] += 1
+                raise DeadlineExceeded('бюджет исчерпан в ожидании читателя')
+            self.stats['timeouts'] += 1
+            raise sqlite3.OperationalError('reader pool exhausted')
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+        waited = (time.perf_counter() - start_time) * 1000
+        self.stats['waits'] += 1
+        self.stats['total_wait_ms'] += waited
+        self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], waited)
+        return conn
+
+    def _checkin(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as conn: ... - соединение вернется в пул.
+
+        Внутри дедлайна запроса чтение, не уложившееся в бюджет, прерывается
+        обработчиком прогресса SQLite и поднимает DeadlineExceeded.
+        """
+        deadline = request_deadline.get()
+        conn = self._checkout(deadline)
+        if deadline is not None:
+            conn.set_progress_handler(deadline_handler(deadline),
+                                      PERFORMANCE_CONFIG['DEADLINE_CHECK_OPS'])
+        try:
+            yield conn
+        except sqlite3.OperationalError as e:
+            if deadline is not None and time.perf_counter() > deadline:
+                self.stats['deadline_exceeded'] += 1
+                raise DeadlineExceeded(f'чтение прервано: {e}') from e
+            raise
+        finally:
+            if deadline is not None:
+                conn.set_progress_handler(None, 0)
+            self._checkin(conn)
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            created, waiting = self.created, self.waiting
+        checkouts = self.stats['checkouts']
+        return {
+            **self.stats, 'size': created,
+            'max_size': self.max_size,
+            'idle': self.idle.qsize(),
+            'in_use': created - self.idle.qsize(),
+            'waiting': waiting,
+            'avg_wait_ms':
+            self.stats['total_wait_ms'] / checkouts if checkouts else 0.0
+        }
+
+
+class WriteOutcomeUnknown(Exception):
+    """Таймаут ожидания, а задание писателя уже выполняется: зафиксируется ли
+    оно - неизвестно. Повторять или откатывать его последствия нельзя"""
+
+
+class SQLiteWriter:
+    """Единственное пишущее соединение и поток, выполняющий задания по порядку.
+
+    Задание - функция от соединения; поток фиксирует транзакцию после
+    успешного задания и откатывает при ошибке. Конкурирующих писателей нет,
+    поэтому "database is locked" между своими потоками не возникает.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]):
+        self.conn = connect()
+        self.jobs: queue.Queue = queue.Queue()
+        self.stats = {
+            'jobs': 0,
+            'errors': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'total_exec_ms': 0.0
+        }
+        self.thread = threading.Thread(target=self._run,
+                                       name='sqlite-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def submit(self, job: Callable[[sqlite3.Connection], object]) -> Future:
+        """Постановка задания в очередь; результат - через Future"""
+        future = Future()
+        self.jobs.put((job, future, time.perf_counter()))
+        return future
+
+    def execute(self, job: Callable[[sqlite3.Connection], object]):
+        """Выполнение задания с ожиданием результата"""
+        if threading.current_thread() is self.thread:
+            return job(self.conn)  # Вложенный вызов из задания - уже в транзакции
+        future = self.submit(job)
+        try:
+            return future.result(
+                timeout=PERFORMANCE_CONFIG['DB_WRITE_TIMEOUT_SEC'])
+        except FutureTimeoutError:
+            return self.timed_out(future)
+
+    def wait(self, future: Future):
+        """Итог задания, которое нельзя бросить: по таймауту снимаем его с
+        очереди, а начатое ждем до конца - оно может зафиксироваться"""
+        try:
+            return future.result(
+                timeout=PERFORMANCE_CONFIG['DB_WRITE_TIMEOUT_SEC'])
+        except FutureTimeoutError:
+            try:
+                return self.timed_out(future)
+            except WriteOutcomeUnknown:
+                logger.warning(
+                    "⏳ Задание писателя выполняется дольше таймаута - ждем итог")
+                return future.result()
+
+    @staticmethod
+    def timed_out(future: Future):
+        """Таймаут ожидания задания: снимаем его с очереди, если оно не начато.
+
+        Снятое задание не выполнится - таймаут пробрасывается как обычная
+        ошибка. Начатое может еще зафиксироваться: WriteOutcomeUnknown.
+        """
+        if future.cancel():
+            raise FutureTimeoutError('задание писателя снято по таймауту')
+        if future.done():
+            return future.result()  # Успело завершиться
+        raise WriteOutcomeUnknown('задание писателя выполняется дольше таймаута')
+
+    def _run(self):
+        while True:
+            job, future, enqueued = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            start_time = time.perf_counter()
+            waited = (start_time - enqueued) * 1000
+            self.stats['total_wait_ms'] += waited
+            self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], waited)
+
+            try:
+                result = job(self.conn)
+                self.conn.commit()
+            except BaseException as e:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                self.stats['errors'] += 1
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                self.stats['jobs'] += 1
+                self.stats['total_exec_ms'] += (time.perf_counter() -
+                                                start_time) * 1000
+
+    def get_stats(self) -> Dict:
+        jobs = self.stats['jobs']
+        return {
+            **self.stats, 'queue_depth': self.jobs.qsize(),
+            'avg_wait_ms': self.stats['total_wait_ms'] / jobs if jobs else 0.0,
+            'avg_exec_ms': self.stats['total_exec_ms'] / jobs if jobs else 0.0
+        }
+
+
+class HighPerformanceDatabase:
+    """Оптимизированное подключение к SQLite для максимальной скорости"""
+
+    # Запись игрока одним запросом: вставка нового (с генерацией
+    # реферального кода внутри SQL) или обновление существующего
+    PLAYER_UPSERT_QUERY = '''
+        INSERT INTO players_high_perf
+        (user_id, username, telegram_id, balance, total_earned, total_clicks,
+         upgrades, mine_speed, accrued_since, referral_code, last_device_id,
+         last_ip, last_activity, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'REF-' || hex(randomblob(4)),
+                ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            balance = excluded.balance,
+            total_earned = excluded.total_earned,
+            total_clicks = excluded.total_clicks,
+            upgrades = excluded.upgrades,
+            mine_speed = excluded.mine_speed,
+            accrued_since = excluded.accrued_since,
+            last_device_id = excluded.last_device_id,
+            last_ip = excluded.last_ip,
+            last_activity = excluded.last_activity,
+            -- Версия из памяти буфера; запись без версии (0) просто растит ее
+            version = MAX(excluded.version, players_high_perf.version + 1)
+        -- Состояние не новее строки в БД устарело: его обогнали переводы
+        -- и выплаты, записанные в обход буфера
+        WHERE excluded.version = 0 OR excluded.version > players_high_perf.version
+    '''
+
+    PLAYER_UPSERT_RETURNING_QUERY = PLAYER_UPSERT_QUERY + '''
+        RETURNING user_id, username, telegram_id, balance, total_earned, total_clicks,
+                  upgrades, click_speed, mine_speed, total_speed, accrued_since,
+                  level, experience, referral_code, referrals_count,
+                  referral_earnings, version
+    '''
+
+    CONNECTION_PRAGMAS = (
+        "PRAGMA journal_mode = WAL",  # Write-Ahead Logging
+        "PRAGMA synchronous = NORMAL",  # Баланс скорости и надежности
+        "PRAGMA cache_size = -2000",  # 2MB кэша
+        "PRAGMA mmap_size = 268435456",  # 256MB mmap
+        "PRAGMA temp_store = MEMORY",  # Временные таблицы в памяти
+        "PRAGMA optimize",  # Автооптимизация
+    )
+
+    # Итоги игрока по розыгрышу: (ставки, выигрыш, проигрыш, user_id)
+    PLAYER_LOTTERY_RESULT_QUERY = '''
+        UPDATE players_high_perf SET
+            total_bet = total_bet + ?,
+            total_winnings = total_winnings + ?,
+            total_losses = total_losses + ?
+        WHERE user_id = ?
+    '''
+
+    def __init__(self, db_path='sparkcoin_high_perf.db'):
+        self.db_path = db_path
+
+        # База старой версии с REAL-суммами переводится только онлайн-миграцией
+        # (python migrate_nano.py): новый сервер на ней не стартует
+        migration = NanoUnitMigration(db_path)
+        try:
+            if migration.needed():
+                raise RuntimeError(
+                    f'БД {db_path} хранит суммы в старом формате (REAL) - '
+                    f'сначала выполните python migrate_nano.py {db_path}, '
+                    f'затем запустите новую версию сервера')
+        finally:
+            migration.close()
+
+        # Одно пишущее соединение в своем потоке и пул читающих
+        self.writer = SQLiteWriter(lambda: self._connect(read_only=False))
+        self.readers = ReaderPool(lambda: self._connect(read_only=True),
+                                  PERFORMANCE_CONFIG['MAX_CONCURRENT_DB'],
+                                  PERFORMANCE_CONFIG['DB_WRITE_TIMEOUT_SEC'])
+
+        # Инициализируем базу
+        self.writer.execute(self._init_database)
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        """Новое соединение с настройками производительности"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=PERFORMANCE_CONFIG['DB_TIMEOUT_MS'] / 1000,
+            check_same_thread=False,
+            factory=connection_factory())
+        conn.row_factory = sqlite3.Row
+
+        # Оптимизация для высокой производительности
+        for pragma in self.CONNECTION_PRAGMAS:
+            if read_only and 'journal_mode' in pragma:
+                continue  # Режим журнала хранится в файле, его задает писатель
+            conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def reader(self):
+        """Читающее соединение из пула: with db.reader() as conn: ..."""
+        return self.readers.connection()
+
+    def write(self, job: Callable[[sqlite3.Connection], object],
+              *tables: str):
+        """Задание писателю с ожиданием; затем сброс кэша указанных таблиц"""
+        try:
+            return self.writer.execute(job)
+        finally:
+            # И после ошибки: при WriteOutcomeUnknown запись еще может зафиксироваться
+            if tables:
+                query_cache.invalidate_tables(*tables)
+
+    def get_pool_stats(self) -> Dict:
+        return {
+            'readers': self.readers.get_stats(),
+            'writer': self.writer.get_stats()
+        }
+
+    def _init_database(self, conn: sqlite3.Connection):
+        """Оптимизированная инициализация структуры базы данных"""
+        cursor = conn.cursor()
+
+        try:
+            # ОПТИМИЗИРОВАННАЯ ТАБЛИЦА ИГРОКОВ
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS players_high_perf (
+                    user_id TEXT PRIMARY KEY,
+                    telegram_id TEXT UNIQUE,
+                    username TEXT NOT NULL,
+                    balance INTEGER DEFAULT 100 CHECK(balance >= 0),
+                    total_earned INTEGER DEFAULT 100,
+                    total_clicks INTEGER DEFAULT 0,
+                    upgrades TEXT DEFAULT '{}',
+                    click_speed INTEGER DEFAULT 1,
+                    mine_speed INTEGER DEFAULT 0,
+                    total_speed INTEGER GENERATED ALWAYS AS (click_speed + mine_speed) VIRTUAL,
+                    level INTEGER DEFAULT 1,
+                    experience INTEGER DEFAULT 0,
+                    referral_code TEXT UNIQUE,
+                    referred_by TEXT,
+                    referral_earnings INTEGER DEFAULT 0,
+                    referrals_count INTEGER DEFAULT 0,
+                    total_winnings INTEGER DEFAULT 0,
+                    total_losses INTEGER DEFAULT 0,
+                    total_bet INTEGER DEFAULT 0,
+                    transfers_sent INTEGER DEFAULT 0,
+                    transfers_received INTEGER DEFAULT 0,
+                    last_device_id TEXT,
+                    last_ip TEXT,
+                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    accrued_since INTEGER NOT NULL DEFAULT 0
+                ) WITHOUT ROWID
+            ''')
+
+            # Индексы для быстрого поиска
+            cursor.executescript('''
+                CREATE INDEX IF NOT EXISTS idx_telegram_id ON players_high_perf (telegram_id);
+                CREATE INDEX IF NOT EXISTS idx_balance ON players_high_perf (balance DESC);
+                CREATE INDEX IF NOT EXISTS idx_total_speed ON players_high_perf (total_speed DESC);
+                CREATE INDEX IF NOT EXISTS idx_last_activity ON players_high_perf (last_activity DESC);
+                CREATE INDEX IF NOT EXISTS idx_referral_code ON players_high_perf (referral_code);
+            ''')
+
+            # ОПТИМИЗИРОВАННАЯ ТАБЛИЦА СТАВОК
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lottery_bets_high_perf (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    team TEXT CHECK(team IN ('eagle', 'tails')),
+                    amount INTEGER NOT NULL CHECK(amount > 0),
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                    FOREIGN KEY (user_id) REFERENCES players_high_perf(user_id) ON DELETE CASCADE
+                )
+            ''')
+
+            cursor.executescript('''
+                CREATE INDEX IF NOT EXISTS idx_user_team ON lottery_bets_high_perf (user_id, team);
+                CREATE INDEX IF NOT EXISTS idx_timestamp ON lottery_bets_high_perf (timestamp DESC);
+            ''')
+
+            # РАССЧИТАННЫЕ РАУНДЫ КОМАНДНОЙ ЛОТЕРЕИ
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lottery_rounds_high_perf (
+                    round_id INTEGER PRIMARY KEY,
+                    winning_team TEXT CHECK(winning_team IN ('eagle', 'tails')),
+                    total_pot INTEGER NOT NULL,
+                    bets_count INTEGER NOT NULL,
+                    winners_count INTEGER NOT NULL,
+                    settled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # КЛАССИЧЕСКАЯ ЛОТЕРЕЯ: ЖУРНАЛ СТАВОК И СНИМКИ РАУНДОВ
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS classic_lottery_bets_high_perf (
+                    round_id INTEGER NOT NULL,
+                    seq INTEGER NOT NULL,
+                    user_id TEXT NOT NULL,
+                    amount INTEGER NOT NULL CHECK(amount > 0),
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                    PRIMARY KEY (round_id, seq)
+                ) WITHOUT ROWID
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS classic_lottery_rounds_high_perf (
+                    round_id INTEGER PRIMARY KEY,
+                    status TEXT NOT NULL CHECK(status IN ('open', 'settled')),
+                    state TEXT,
+                    last_seq INTEGER DEFAULT 0,
+                    total_pot INTEGER DEFAULT 0,
+                    bets_count INTEGER DEFAULT 0,
+                    participants INTEGER DEFAULT 0,
+                    winner_id TEXT,
+                    winner_name TEXT,
+                    prize INTEGER,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # ОПТИМИЗИРОВАННАЯ ТАБЛИЦА ПЕРЕВОДОВ
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS transfers_high_perf (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    from_user_id TEXT NOT NULL,
+                    to_user_id TEXT NOT NULL,
+                    amount INTEGER NOT NULL CHECK(amount > 0),
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    idempotency_key TEXT,
+
+                    FOREIGN KEY (from_user_id) REFERENCES players_high_perf(user_id),
+                    FOREIGN KEY (to_user_id) REFERENCES players_high_perf(user_id),
+                    CHECK (from_user_id != to_user_id)
+                )
+            ''')
+
+            cursor.executescript('''
+                CREATE INDEX IF NOT EXISTS idx_from_user ON transfers_high_perf (from_user_id);
+                CREATE INDEX IF NOT EXISTS idx_to_user ON transfers_high_perf (to_user_id);
+                CREATE INDEX IF NOT EXISTS idx_transfer_time ON transfers_high_perf (timestamp DESC);
+            ''')
+
+            # Версия строки игрока в базах, созданных до дельта-синхронизации
+            columns = {
+                row['name']
+                for row in cursor.execute("PRAGMA table_info(players_high_perf)")
+            }
+            if 'version' not in columns:
+                cursor.execute("ALTER TABLE players_high_perf "
+                               "ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            # Момент начисления майнинга; 0 - с первой записи (скорость там 0)
+            if 'accrued_since' not in columns:
+                cursor.execute(
+                    "ALTER TABLE players_high_perf "
+                    "ADD COLUMN accrued_since INTEGER NOT NULL DEFAULT 0")
+
+            # Ключ идемпотентности в базах, созданных до его появления
+            columns = {
+                row['name']
+                for row in cursor.execute(
+                    "PRAGMA table_info(transfers_high_perf)")
+            }
+            if 'idempotency_key' not in columns:
+                cursor.execute(
+                    "ALTER TABLE transfers_high_perf ADD COLUMN idempotency_key TEXT")
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_transfer_key
+                ON transfers_high_perf (from_user_id, idempotency_key)
+                WHERE idempotency_key IS NOT NULL
+            ''')
+
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+            conn.commit()
+            logger.info("✅ Высокопроизводительная БД инициализирована")
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка инициализации БД: {e}")
+            conn.rollback()
+        finally:
+            # Не закрываем соединение, возвращаем в пул
+            pass
+
+    def execute_fast(self, query: str, params: tuple = ()) -> List[Dict]:
+        """Выполнение запроса с кэшированием"""
+        start_time = time.perf_counter()
+
+        is_select = query.strip().upper().startswith('SELECT')
+        use_cache = is_select and PERFORMANCE_CONFIG['ENABLE_QUERY_CACHE']
+
+        # Проверка кэша
+        cache_key = f"{query}_{params}"
+        if use_cache:
+            cached = query_cache.get(cache_key)
+            if cached is not None:
+                elapsed = time.perf_counter() - start_time
+                logger.debug(f"📦 Запрос из кэша: {elapsed*1000:.1f}ms")
+                return cached
+            # Версии таблиц до чтения: запись во время запроса сделает результат устаревшим
+            versions = query_cache.snapshot(query)
+
+        try:
+            if is_select:
+                with self.reader() as conn:
+                    results = [
+                        dict(row) for row in conn.execute(query, params)
+                    ]
+                # Кэшируем результат
+                if use_cache:
+                    query_cache.put(cache_key, results, versions)
+            else:
+                affected = self.writer.execute(
+                    lambda conn: conn.execute(query, params).rowcount)
+                query_cache.invalidate_query(query)
+                results = {'affected_rows': affected}
+
+            return results
+
+        except DeadlineExceeded:
+            raise  # Не ошибка БД: ответ по бюджету формирует маршрут
+        except Exception as e:
+            logger.error(f"❌ Ошибка БД: {e} - {query[:50]}...")
+            raise
+
+    def execute_many_fast(self, query: str, params_list: List[tuple]) -> int:
+        """Массовое выполнение запросов"""
+        try:
+            affected = self.writer.execute(
+                lambda conn: conn.executemany(query, params_list).rowcount)
+            query_cache.invalidate_query(query)
+            return affected
+        except Exception as e:
+            logger.error(f"❌ Ошибка массового запроса: {e}")
+            raise
+
+    def execute_batch_fast(self,
+                           statements: List[Tuple[str, List[tuple]]]) -> int:
+        """Несколько массовых запросов в одной транзакции"""
+
+        def job(conn: sqlite3.Connection) -> int:
+            affected = 0
+            for query, params_list in statements:
+                if params_list:
+                    affected += conn.executemany(query, params_list).rowcount
+            return affected
+
+        try:
+            affected = self.writer.execute(job)
+            for query, _ in statements:
+                query_cache.invalidate_query(query)
+            return affected
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетной транзакции: {e}")
+            raise
+
+    @staticmethod
+    def player_params(user_id: str, username: str,
+                      telegram_id: Optional[str], balance: int,
+                      total_earned: int, total_clicks: int, device_id: str,
+                      ip_address: str, upgrades: str = '{}') -> tuple:
+        """Параметры PLAYER_UPSERT_QUERY для состояния, присланного клиентом:
+        скорость майнинга - по улучшениям, начисление - с текущего момента"""
+        return (user_id, username, telegram_id, balance, total_earned,
+                total_clicks, upgrades, mining_speed(upgrades), now_ms(),
+                device_id, ip_address,
+                datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), 0)
+
+    def upsert_player(self, user_id: str, username: str,
+                      telegram_id: Optional[str], balance: int,
+                      total_earned: int, total_clicks: int, device_id: str,
+                      ip_address: str, upgrades: str = '{}') -> Dict:
+        """Синхронизация игрока за один запрос: INSERT ... ON CONFLICT ... RETURNING"""
+        start_time = time.perf_counter()
+        params = self.player_params(user_id, username, telegram_id, balance,
+                                    total_earned, total_clicks, device_id,
+                                    ip_address, upgrades)
+
+        try:
+            row = self.write(
+                lambda conn: dict(
+                    conn.execute(self.PLAYER_UPSERT_RETURNING_QUERY, params).
+                    fetchone()), 'players_high_perf')
+
+            elapsed = time.perf_counter() - start_time
+            if elapsed > 0.05:
+                logger.warning(
+                    f"⚠️ Медленная синхронизация игрока: {elapsed*1000:.1f}ms")
+
+            return row
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи игрока {user_id}: {e}")
+            raise
+
+
+# ОДИН ПРОЦЕСС НА БАЗУ ДАННЫХ
+# Отложенная запись, движки лотерей и переводов держат состояние в памяти
+# процесса: второй процесс с той же БД перезаписал бы чужие переводы и
+# выплаты устаревшими строками. Несколько воркеров не поддерживаются.
+# Блокировку берет запуск сервера (python bot.py), а не импорт модуля:
+# benchmarks.py и служебные скрипты импортируют bot рядом с живым сервером.
+def acquire_process_lock(db_path: str):
+    """Эксклюзивная блокировка файла рядом с БД: второй сервер не стартует"""
+    if fcntl is None:
+        return None
+    lock_file = open(f'{db_path}.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise RuntimeError(f'БД {db_path} уже обслуживает другой процесс - '
+                           f'несколько воркеров не поддерживаются')
+    return lock_file
+
+
+def _mark_forked_worker():
+    """Копия после fork (gunicorn --preload) не наследует фоновые потоки
+    записи - такая копия запросы не обслуживает"""
+    global forked_worker
+    forked_worker = True
+
+
+forked_worker = False
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_mark_forked_worker)
+
+# ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ
+DATABASE_PATH = 'sparkcoin_high_perf.db'
+db = HighPerformanceDatabase(DATABASE_PATH)
+
+
+class AsyncHighPerformanceDatabase:
+    """Та же БД через aiosqlite для ASGI-режима: запросы не блокируют цикл событий.
+
+    Кэш запросов общий с синхронной версией, поэтому запись в любом режиме
+    сбрасывает устаревшие результаты в обоих. Соединения aiosqlite только
+    читают - запись уходит в общий поток-писатель синхронной БД.
+    """
+
+    def __init__(self, sync_db: HighPerformanceDatabase, pool_size: int):
+        self.sync_db = sync_db
+        self.db_path = sync_db.db_path
+        self.pool_size = pool_size
+        self.pool: Optional[asyncio.Queue] = None
+        self.connections: List[aiosqlite.Connection] = []
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            self.db_path,
+            timeout=PERFORMANCE_CONFIG['DB_TIMEOUT_MS'] / 1000,
+            factory=connection_factory())
+        conn.row_factory = sqlite3.Row
+        for pragma in HighPerformanceDatabase.CONNECTION_PRAGMAS:
+            if 'journal_mode' not in pragma:
+                await conn.execute(pragma)
+        await conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    async def _write(self, job: Callable[[sqlite3.Connection], object]):
+        """Задание писателю без блокировки цикла событий"""
+        future = self.sync_db.writer.submit(job)
+        try:
+            # shield: отмену по таймауту решает timed_out, а не wait_for
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)),
+                PERFORMANCE_CONFIG['DB_WRITE_TIMEOUT_SEC'])
+        except asyncio.TimeoutError:
+            return SQLiteWriter.timed_out(future)
+
+    async def write(self, job: Callable[[sqlite3.Connection], object],
+                    *tables: str):
+        """Задание писателю из цикла событий; затем сброс кэша таблиц"""
+        try:
+            return await self._write(job)
+        finally:
+            # И после ошибки: при WriteOutcomeUnknown запись еще может зафиксироваться
+            if tables:
+                query_cache.invalidate_tables(*tables)
+
+    async def _acquire(self) -> aiosqlite.Connection:
+        """Соединение из пула (пул привязан к текущему циклу событий)"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.pool = asyncio.Queue()
+            self.connections = []
+
+        if self.pool.empty() and len(self.connections) < self.pool_size:
+            conn = await self._connect()
+            self.connections.append(conn)
+            return conn
+        return await self.pool.get()
+
+    def _release(self, conn: aiosqlite.Connection):
+        if conn in self.connections:
+            self.pool.put_nowait(conn)
+
+    async def execute_fast(self, query: str, params: tuple = ()) -> List[Dict]:
+        """Асинхронный execute_fast с тем же кэшем запросов"""
+        is_select = query.strip().upper().startswith('SELECT')
+        use_cache = is_select and PERFORMANCE_CONFIG['ENABLE_QUERY_CACHE']
+
+        cache_key = f"{query}_{params}"
+        if use_cache:
+            cached = query_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            versions = query_cache.snapshot(query)
+
+        if not is_select:
+            try:
+                affected = await self._write(
+                    lambda conn: conn.execute(query, params).rowcount)
+            except Exception as e:
+                logger.error(
+                    f"❌ Ошибка асинхронной БД: {e} - {query[:50]}...")
+                raise
+            query_cache.invalidate_query(query)
+            return {'affected_rows': affected}
+
+        # Дедлайн задачи: прерывание в потоке aiosqlite по тому же бюджету
+        deadline = request_deadline.get()
+        if deadline is not None and time.perf_counter() > deadline:
+            raise DeadlineExceeded('бюджет исчерпан до чтения')
+        conn = await self._acquire()
+        try:
+            if deadline is not None:
+                await conn.set_progress_handler(
+                    deadline_handler(deadline),
+                    PERFORMANCE_CONFIG['DEADLINE_CHECK_OPS'])
+            cursor = await conn.execute(query, params)
+            results = [dict(row) for row in await cursor.fetchall()]
+            if use_cache:
+                query_cache.put(cache_key, results, versions)
+            return results
+        except sqlite3.OperationalError as e:
+            if deadline is not None and time.perf_counter() > deadline:
+                raise DeadlineExceeded(f'чтение прервано: {e}') from e
+            logger.error(f"❌ Ошибка асинхронной БД: {e} - {query[:50]}...")
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка асинхронной БД: {e} - {query[:50]}...")
+            raise
+        finally:
+            if deadline is not None:
+                await conn.set_progress_handler(None, 0)
+            self._release(conn)
+
+    async def execute_many_fast(self, query: str,
+                                params_list: List[tuple]) -> int:
+        try:
+            affected = await self._write(
+                lambda conn: conn.executemany(query, params_list).rowcount)
+        except Exception as e:
+            logger.error(f"❌ Ошибка асинхронного массового запроса: {e}")
+            raise
+        query_cache.invalidate_query(query)
+        return affected
+
+    async def upsert_player(self, user_id: str, username: str,
+                            telegram_id: Optional[str], balance: int,
+                            total_earned: int, total_clicks: int,
+                            device_id: str, ip_address: str,
+                            upgrades: str = '{}') -> Dict:
+        """Асинхронный upsert_player: один INSERT ... ON CONFLICT ... RETURNING"""
+        params = HighPerformanceDatabase.player_params(
+            user_id, username, telegram_id, balance, total_earned,
+            total_clicks, device_id, ip_address, upgrades)
+        try:
+            row = await self._write(lambda conn: dict(
+                conn.execute(
+                    HighPerformanceDatabase.PLAYER_UPSERT_RETURNING_QUERY,
+                    params).fetchone()))
+        except Exception as e:
+            logger.error(f"❌ Ошибка асинхронной записи игрока {user_id}: {e}")
+            raise
+        query_cache.invalidate_tables('players_high_perf')
+        return row
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+        self.connections = []
+        self.loop = None
+
+
+# ИНИЦИАЛИЗАЦИЯ АСИНХРОННОЙ БАЗЫ ДАННЫХ (ASGI-РЕЖИМ)
+async_db = AsyncHighPerformanceDatabase(
+    db, PERFORMANCE_CONFIG['ASYNC_DB_CONNECTIONS'])
+
+
+# ============================================================================
+# ОТЛОЖЕННАЯ ЗАПИСЬ (WRITE-BEHIND) ДЛЯ СИНХРОНИЗАЦИИ
+# ============================================================================
+class PinnedLRUCache(cachetools.LRUCache):
+    """LRU, которое не теряет закрепленные ключи: вытесненная запись, для
+    которой is_pinned(key) истинно, переезжает в pinned и возвращается в
+    кэш при следующем обращении"""
+
+    def __init__(self, maxsize: int, is_pinned: Callable[[str], bool]):
+        super().__init__(maxsize)
+        self.is_pinned = is_pinned
+        self.pinned: Dict[str, Dict] = {}
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self.is_pinned(key):
+            self.pinned[key] = value
+        return key, value
+
+    def __missing__(self, key):
+        value = self.pinned.pop(key)
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        self.pinned.pop(key, None)
+        return super().pop(key, *default)
+
+    def unpin(self, keep: Callable[[str], bool]):
+        """Сброс закрепленных записей, которые больше не нужно держать"""
+        self.pinned = {
+            key: value
+            for key, value in self.pinned.items() if keep(key)
+        }
+
+
+class WriteBehindBuffer:
+    """Последнее состояние игроков в памяти и групповые коммиты в фоне"""
+
+    PLAYER_FIELDS = ('user_id, username, telegram_id, balance, total_earned, '
+                     'total_clicks, upgrades, click_speed, mine_speed, '
+                     'total_speed, accrued_since, level, experience, '
+                     'referral_code, referrals_count, referral_earnings, '
+                     'last_device_id, last_ip, version')
+
+    # Колонки дельта-синхронизации: для каждой помним версию последнего изменения
+    VERSIONED_FIELDS = ('username', 'balance', 'total_earned', 'total_clicks')
+
+    def __init__(self, database: 'HighPerformanceDatabase'):
+        self.db = database
+        self.flush_interval = PERFORMANCE_CONFIG['WRITE_BEHIND_FLUSH_MS'] / 1000
+        self.max_batch = PERFORMANCE_CONFIG['WRITE_BEHIND_MAX_BATCH']
+
+        # Последнее известное состояние игроков (отдаем ответы из памяти).
+        # Игрока с ожидающей записью или вытесненного во время записи в БД
+        # нельзя терять: строка в БД еще старая, перечитанное из нее
+        # состояние затерло бы несохраненные изменения
+        self.state = PinnedLRUCache(
+            PERFORMANCE_CONFIG['WRITE_BEHIND_STATE_SIZE'],
+            lambda user_id: (user_id in self.pending or
+                             self.flush_lock.locked()))
+        # Ожидающие записи: user_id -> параметры UPSERT
+        self.pending: Dict[str, tuple] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
+
+        self.stats = {
+            'flushed_rows': 0,
+            'flush_batches': 0,
+            'flush_errors': 0,
+            'last_flush_ms': 0.0,
+            'max_lag_ms': 0.0
+        }
+        self.oldest_pending = 0.0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """Фоновый поток групповых коммитов"""
+        while not self.stop_event.is_set():
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка отложенной записи: {e}")
+
+    @staticmethod
+    def _to_params(player: Dict) -> tuple:
+        return (player['user_id'], player['username'], player.get('telegram_id'),
+                player['balance'], player['total_earned'],
+                player['total_clicks'], player.get('upgrades') or '{}',
+                player.get('mine_speed') or 0, player.get('accrued_since') or 0,
+                player.get('last_device_id'), player.get('last_ip'),
+                player['last_activity'], player.get('version', 0))
+
+    def get_player(self, user_id: str) -> Optional[Dict]:
+        """Последнее состояние игрока из памяти"""
+        with self.lock:
+            player = self.state.get(user_id)
+            return dict(player) if player is not None else None
+
+    @classmethod
+    def _track(cls, player: Dict) -> Dict:
+        """Версии полей строки, пришедшей из БД: изменены не позже ее версии"""
+        player.setdefault('version', 0)
+        player.setdefault('field_versions', {
+            field: player['version']
+            for field in cls.VERSIONED_FIELDS
+        })
+        return player
+
+    def _touch(self, player: Dict, changed: Tuple[str, ...]):
+        """Новая версия игрока под self.lock; changed - изменившиеся поля.
+
+        Версия растет от текущего состояния в памяти, даже если player -
+        снятая раньше копия, поэтому две записи не получат одну версию.
+        """
+        current = self.state.get(player['user_id'])
+        base = self._track(current if current is not None else player)
+        version = max(player.get('version', 0), base['version']) + 1
+        field_versions = dict(base['field_versions'])
+        for field in changed:
+            field_versions[field] = version
+        player['version'] = version
+        player['field_versions'] = field_versions
+
+    def _enqueue(self, player: Dict,
+                 changed: Tuple[str, ...] = VERSIONED_FIELDS) -> bool:
+        """Постановка в очередь под self.lock; True - пора сбрасывать пакет"""
+        player['last_activity'] = datetime.utcnow().strftime(
+            '%Y-%m-%d %H:%M:%S')
+        self._touch(player, changed)
+        self.state[player['user_id']] = player
+        if not self.pending:
+            self.oldest_pending = time.perf_counter()
+        self.pending[player['user_id']] = self._to_params(player)
+        return len(self.pending) >= self.max_batch
+
+    def submit(self,
+               player: Dict,
+               changed: Tuple[str, ...] = VERSIONED_FIELDS):
+        """Постановка состояния игрока в очередь записи (последнее побеждает)"""
+        with self.lock:
+            batch_ready = self._enqueue(player, changed)
+
+        if batch_ready:
+            self.flush_event.set()
+
+    def load_player(self, user_id: str) -> Optional[Dict]:
+        """Состояние игрока из памяти, при промахе - из БД"""
+        player = self.get_player(user_id)
+        if player is not None:
+            return player
+
+        with self.db.reader() as conn:
+            row = conn.execute(
+                f"SELECT {self.PLAYER_FIELDS} FROM players_high_perf WHERE user_id = ?",
+                (user_id, )).fetchone()
+        if row is None:
+            return None
+
+        player = self._track(dict(row))
+        with self.lock:
+            # Пока читали БД, состояние могло появиться - оно свежее
+            current = self.state.get(user_id)
+            if current is None:
+                self.state[user_id] = player
+                current = player
+            return dict(current)
+
+    def adjust_balance(self,
+                       user_id: str,
+                       delta: int,
+                       min_balance: Optional[int] = 0) -> Optional[Dict]:
+        """Атомарное изменение баланса в памяти с проверкой остатка.
+
+        Запись в БД идет обычным групповым коммитом. None - игрок не найден
+        или баланса не хватает; min_balance=None - без проверки остатка.
+        """
+        if self.load_player(user_id) is None:
+            return None
+
+        with self.lock:
+            player = self.state.get(user_id)
+            if player is None:
+                return None
+            # Остаток проверяем с намайненным, записываем вместе с ним
+            now = now_ms()
+            new_balance = accrue(dict(player), now)['balance'] + delta
+            if min_balance is not None and new_balance < min_balance:
+                return None
+            accrue(player, now)
+            player['balance'] = new_balance
+            batch_ready = self._enqueue(player, ('balance', ))
+            result = dict(player)
+
+        if batch_ready:
+            self.flush_event.set()
+        return result
+
+    @classmethod
+    def resolve_delta(cls, player: Dict, base_version: int,
+                      changes: Dict) -> Tuple[bool, Tuple[str, ...], Dict]:
+        """Сверка дельты клиента с состоянием игрока.
+
+        Возвращает (конфликт, изменяемые поля, поля сервера для ответа).
+        Конфликт - клиент меняет поле, изменившееся на сервере после
+        base_version, на другое значение; в ответе тогда все такие поля.
+        Иначе в ответе - изменения сервера, которые клиент не перезаписывает.
+        """
+        cls._track(player)
+        if base_version > player['version']:
+            # Клиент видел версию, которой сервер не знает - сверяем все поля
+            stale = cls.VERSIONED_FIELDS
+        else:
+            stale = tuple(field
+                          for field, version in player['field_versions'].items()
+                          if version > base_version)
+        conflict = any(field in changes and changes[field] != player[field]
+                       for field in stale)
+        changed = tuple(field for field, value in changes.items()
+                        if player[field] != value)
+        return conflict, changed, {
+            field: player[field]
+            for field in stale if conflict or field not in changes
+        }
+
+    @classmethod
+    def settle_sync(cls, player: Dict, base_version: Optional[int],
+                    changes: Dict, upgrades: Optional[str],
+                    now: int) -> Tuple[str, Tuple[str, ...], Dict]:
+        """Сверка синхронизации с состоянием, которое начислил сервер.
+
+        Майнинг начисляет сервер, поэтому баланс клиента принимается только
+        вместе с новыми кликами или сменой улучшений - иначе он отличается от
+        серверного лишь собственным подсчетом пассивного дохода. base_version
+        None - полная синхронизация, она перезаписывает без конфликтов.
+        Возвращает (итог, изменившиеся поля, поля сервера для ответа); при
+        'applied' player уже содержит начисление на момент now и изменения.
+        """
+        current = accrue(dict(player), now)
+        upgrades_changed = (upgrades is not None and
+                            upgrades != (current.get('upgrades') or '{}'))
+        if not upgrades_changed and changes.get(
+                'total_clicks',
+                current['total_clicks']) == current['total_clicks']:
+            changes = {
+                field: value
+                for field, value in changes.items()
+                if field not in ACCRUED_FIELDS
+            }
+
+        conflict, changed, server_fields = cls.resolve_delta(
+            current, current['version'] if base_version is None else
+            base_version, changes)
+        if current.get('mine_speed'):
+            # Намайненное с последней записи клиент узнает только из ответа
+            for field in ACCRUED_FIELDS:
+                if field not in changes:
+                    server_fields[field] = current[field]
+        if conflict:
+            return 'conflict', (), server_fields
+        if not changed and not upgrades_changed:
+            return 'unchanged', (), server_fields
+
+        accrue(player, now)
+        player.update(changes)
+        if upgrades_changed:
+            player['upgrades'] = upgrades
+            player['mine_speed'] = mining_speed(upgrades)
+            player['total_speed'] = (player.get('click_speed') or
+                                     0) + player['mine_speed']
+        return 'applied', changed, server_fields
+
+    def apply_delta(self,
+                    user_id: str,
+                    base_version: Optional[int],
+                    changes: Dict,
+                    device_id: str,
+                    ip_address: str,
+                    upgrades: Optional[str] = None
+                    ) -> Tuple[Optional[str], Optional[Dict], Dict]:
+        """Синхронизация в памяти: (итог, игрок, поля сервера).
+
+        Итог: 'applied', 'unchanged' (записывать нечего - без коммита),
+        'conflict' или None - игрок не найден. base_version None - полное
+        состояние клиента.
+        """
+        if self.load_player(user_id) is None:
+            return None, None, {}
+
+        with self.lock:
+            player = self.state.get(user_id)
+            if player is None:
+                return None, None, {}
+            outcome, changed, server_fields = self.settle_sync(
+                player, base_version, changes, upgrades, now_ms())
+            # Устройство и адрес уйдут в БД со следующей записью игрока
+            player['last_device_id'] = device_id
+            player['last_ip'] = ip_address
+            if outcome != 'applied':
+                return outcome, dict(player), server_fields
+
+            batch_ready = self._enqueue(player, changed)
+            result = dict(player)
+
+        if batch_ready:
+            self.flush_event.set()
+        return 'applied', result, server_fields
+
+    def remember(self, player: Dict):
+        """Сохранение уже записанного состояния игрока в памяти"""
+        with self.lock:
+            self.state[player['user_id']] = self._track(player)
+
+    def forget(self, user_id: str):
+        """Сброс состояния игрока из памяти (после изменений в обход буфера)"""
+        with self.lock:
+            self.state.pop(user_id, None)
+
+    def take_pending(self, user_ids) -> List[tuple]:
+        """Изъятие ожидающих записей игроков (под self.lock и flush_lock)"""
+        return [
+            self.pending.pop(user_id) for user_id in user_ids
+            if user_id in self.pending
+        ]
+
+    def reserve(self, user_id: str, amount: int,
+                now: int) -> Optional[bool]:
+        """Резерв списания в памяти (под self.lock) без постановки в очередь.
+
+        Списание запишет в БД вызывающий, там же версия вырастет на единицу,
+        а майнинг будет начислен на тот же момент now; None - игрока нет в
+        памяти.
+        """
+        player = self.state.get(user_id)
+        if player is None:
+            return None
+        if accrue(dict(player), now)['balance'] < amount:
+            return False
+        accrue(player, now)
+        player['balance'] -= amount
+        self._touch(player, ('balance', ))
+        return True
+
+    def release(self, user_id: str, amount: int):
+        """Возврат резерва, который не дошел до БД (под self.lock).
+
+        Версия в памяти уже ушла вперед - записываем ее обычным коммитом.
+        """
+        player = self.state.get(user_id)
+        if player is None:
+            return
+        player['balance'] += amount
+        if self._enqueue(player, ('balance', )):
+            self.flush_event.set()
+
+    def apply_committed(self, user_id: str, delta: int, now: int):
+        """Учет изменения баланса, уже записанного в БД (под self.lock).
+
+        Запись в БД увеличила версию строки на единицу - повторяем в памяти;
+        списание там же начислило майнинг на момент now.
+        """
+        player = self.state.get(user_id)
+        if player is None:
+            return
+        if delta < 0:
+            accrue(player, now)
+        player['balance'] += delta
+        self._touch(player, ('balance', ))
+        if user_id in self.pending:
+            self.pending[user_id] = self._to_params(player)
+
+    def flush_users(self,
+                    *user_ids: str,
+                    extra_statements: Optional[List[Tuple[str, List[tuple]]]] = None):
+        """Немедленная запись ожидающих состояний указанных игроков.
+
+        extra_statements выполняются в той же транзакции.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch = [
+                    self.pending.pop(user_id) for user_id in user_ids
+                    if user_id in self.pending
+                ]
+            if not batch and not extra_statements:
+                return
+            try:
+                self._write(batch, extra_statements)
+            except Exception:
+                with self.lock:
+                    for params in batch:
+                        self.pending.setdefault(params[0], params)
+                raise
+
+    def flush(self):
+        """Групповой коммит всех ожидающих состояний"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    # Все записи, начатые до нас, закончены под flush_lock
+                    self.state.unpin(lambda user_id: False)
+                    return
+                batch = self.pending
+                self.pending = {}
+                lag = time.perf_counter() - self.oldest_pending
+
+            rows = list(batch.values())
+            try:
+                for i in range(0, len(rows), self.max_batch):
+                    self._write(rows[i:i + self.max_batch])
+            except Exception:
+                # Возвращаем в очередь то, что не было перезаписано новыми данными
+                with self.lock:
+                    for user_id, params in batch.items():
+                        self.pending.setdefault(user_id, params)
+                    self.oldest_pending = time.perf_counter() - lag
+                raise
+
+            with self.lock:
+                self.state.unpin(lambda user_id: user_id in self.pending)
+            self.stats['max_lag_ms'] = max(self.stats['max_lag_ms'],
+                                           lag * 1000)
+
+    def _write(self,
+               rows: List[tuple],
+               extra_statements: Optional[List[Tuple[str, List[tuple]]]] = None):
+        start_time = time.perf_counter()
+        try:
+            if extra_statements:
+                self.db.execute_batch_fast(
+                    [(self.db.PLAYER_UPSERT_QUERY, rows)] + extra_statements)
+            else:
+                self.db.execute_many_fast(self.db.PLAYER_UPSERT_QUERY, rows)
+        except Exception:
+            self.stats['flush_errors'] += 1
+            raise
+
+        self.stats['flushed_rows'] += len(rows)
+        self.stats['flush_batches'] += 1
+        self.stats['last_flush_ms'] = (time.perf_counter() - start_time) * 1000
+
+    def shutdown(self):
+        """Остановка потока с полной выгрузкой буфера"""
+        self.stop_event.set()
+        self.flush_event.set()
+        self.thread.join(timeout=5)
+        self.flush()
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            pending = len(self.pending)
+            cached = len(self.state)
+            pinned = len(self.state.pinned)
+        return {
+            **self.stats, 'pending_rows': pending,
+            'cached_players': cached,
+            'pinned_players': pinned,
+            'flush_interval_ms': PERFORMANCE_CONFIG['WRITE_BEHIND_FLUSH_MS']
+        }
+
+
+# ИНИЦИАЛИЗАЦИЯ БУФЕРА ОТЛОЖЕННОЙ ЗАПИСИ
+write_behind = WriteBehindBuffer(db)
+atexit.register(write_behind.shutdown)
+
+
+# ============================================================================
+# ИНКРЕМЕНТАЛЬНЫЙ ИНДЕКС РЕЙТИНГОВ В ПАМЯТИ
+# ============================================================================
+class LeaderboardIndex:
+    """Упорядоченные индексы рейтингов: топ-K за O(K), место игрока за O(log n).
+
+    Балансы растут майнингом без записей, поэтому ключи баланса и заработка
+    считаются на момент последней перестройки (epoch), а у игроков,
+    записанных позже, - на момент их записи. Порядок уточняется следующей
+    перестройкой, значения в ответах - текущие.
+    """
+
+    # Тип рейтинга -> колонка сортировки
+    BOARDS = {
+        'balance': 'balance',
+        'speed': 'total_speed',
+        'earned': 'total_earned'
+    }
+
+    FIELDS = ('user_id', 'username', 'balance', 'total_earned', 'total_clicks',
+              'click_speed', 'mine_speed', 'total_speed', 'accrued_since',
+              'level')
+
+    def __init__(self, database: 'HighPerformanceDatabase'):
+        self.db = database
+        self.lock = threading.RLock()
+        self.players: Dict[str, Dict] = {}
+        self.boards = {board: SortedList() for board in self.BOARDS}
+        self.epoch = now_ms()
+        # Игроки, обновленные во время перезагрузки из БД
+        self.dirty: Optional[set] = None
+
+        self.reload()
+        self._start_reload()
+
+    @classmethod
+    def board_of(cls, leaderboard_type: str) -> str:
+        """Неизвестные типы, как и раньше, сортируются по total_earned"""
+        return leaderboard_type if leaderboard_type in cls.BOARDS else 'earned'
+
+    def _key(self, board: str, player: Dict) -> Tuple[float, str]:
+        column = self.BOARDS[board]
+        if column in ACCRUED_FIELDS:
+            return (-(player[column] + mined_since(player, self.epoch)),
+                    player['user_id'])
+        return (-(player[column] or 0), player['user_id'])
+
+    def _row(self, player: Dict) -> Dict:
+        row = {field: player.get(field) for field in self.FIELDS}
+        row['click_speed'] = row['click_speed'] or 0
+        row['mine_speed'] = row['mine_speed'] or 0
+        if row['total_speed'] is None:
+            row['total_speed'] = row['click_speed'] + row['mine_speed']
+        row['total_clicks'] = row['total_clicks'] or 0
+        row['balance'] = row['balance'] or 0
+        row['total_earned'] = row['total_earned'] or 0
+        row['level'] = row['level'] or 1
+        return row
+
+    def _start_reload(self):
+        """Периодическая сверка с БД (изменения фоновых задач и миграций)"""
+
+        def reload_loop():
+            while True:
+                time.sleep(PERFORMANCE_CONFIG['LEADERBOARD_RELOAD_SEC'])
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(f"Ошибка перезагрузки рейтинга: {e}")
+
+        thread = threading.Thread(target=reload_loop, daemon=True)
+        thread.start()
+
+    def reload(self):
+        """Полная перестройка индексов из БД без блокировки читателей"""
+        with self.lock:
+            self.dirty = set()
+        epoch = now_ms()
+
+        with self.db.reader() as conn:
+            cursor = conn.execute(f'''
+                SELECT {', '.join(self.FIELDS)}
+                FROM players_high_perf
+            ''')
+            players = {row['user_id']: self._row(dict(row)) for row in cursor}
+
+        with self.lock:
+            # Игроки, обновленные во время чтения, новее строк из БД
+            for user_id in self.dirty:
+                if user_id in self.players:
+                    players[user_id] = self.players[user_id]
+            self.dirty = None
+
+            self.players = players
+            self.epoch = epoch
+            self.boards = {
+                board: SortedList(
+                    self._key(board, player) for player in players.values())
+                for board in self.BOARDS
+            }
+
+    def update_player(self, player: Dict):
+        """Инкрементальное обновление позиции игрока во всех рейтингах"""
+        row = self._row(player)
+        user_id = row['user_id']
+
+        with self.lock:
+            old = self.players.get(user_id)
+            if old is not None:
+                for board, keys in self.boards.items():
+                    keys.discard(self._key(board, old))
+
+            self.players[user_id] = row
+            for board, keys in self.boards.items():
+                keys.add(self._key(board, row))
+            if self.dirty is not None:
+                self.dirty.add(user_id)
+
+    def top(self, leaderboard_type: str, limit: int) -> List[Tuple[int, Dict]]:
+        """Первые limit игроков рейтинга: [(место, игрок)]"""
+        board = self.board_of(leaderboard_type)
+        with self.lock:
+            return [(rank, self.players[user_id])
+                    for rank, (_, user_id) in enumerate(
+                        self.boards[board].islice(0, max(0, limit)), 1)]
+
+    def rank(self, leaderboard_type: str, user_id: str,
+             neighbors: int) -> Optional[Tuple[int, int, List[Tuple[int, Dict]]]]:
+        """Место игрока, размер рейтинга и соседи сверху/снизу"""
+        board = self.board_of(leaderboard_type)
+        with self.lock:
+            player = self.players.get(user_id)
+            if player is None:
+                return None
+
+            keys = self.boards[board]
+            index = keys.index(self._key(board, player))
+            first = max(0, index - neighbors)
+            around = [(first + offset + 1, self.players[uid])
+                      for offset, (_, uid) in enumerate(
+                          keys.islice(first, index + neighbors + 1))]
+            return index + 1, len(keys), around
+
+    def __len__(self) -> int:
+        return len(self.players)
+
+
+# ИНИЦИАЛИЗАЦИЯ ИНДЕКСА РЕЙТИНГОВ
+leaderboard_index = LeaderboardIndex(db)
+
+
+# ============================================================================
+# СКОЛЬЗЯЩЕЕ ОКНО СТАВОК КОМАНДНОЙ ЛОТЕРЕИ
+# ============================================================================
+class TeamBetWindow:
+    """Кольцо посекундных корзин одной команды и итоги по всему окну"""
+
+    __slots__ = ('window', 'bucket_second', 'bucket_count', 'bucket_total',
+                 'bucket_players', 'head', 'count', 'total', 'players')
+
+    def __init__(self, window_seconds: int, now_second: int):
+        self.window = window_seconds
+        self.bucket_second = [-1] * window_seconds
+        self.bucket_count = [0] * window_seconds
+        self.bucket_total = [0] * window_seconds
+        self.bucket_players: List[Optional[Dict[str, int]]] = [None] * window_seconds
+        self.head = now_second
+
+        # Итоги окна: ставки, сумма, ставки каждого игрока (для уникальных)
+        self.count = 0
+        self.total = 0
+        self.players: Dict[str, int] = {}
+
+    def _evict(self, index: int):
+        if self.bucket_second[index] < 0:
+            return
+        self.count -= self.bucket_count[index]
+        self.total -= self.bucket_total[index]
+        for user_id, bets in self.bucket_players[index].items():
+            remaining = self.players[user_id] - bets
+            if remaining:
+                self.players[user_id] = remaining
+            else:
+                del self.players[user_id]
+        self.bucket_second[index] = -1
+        self.bucket_count[index] = 0
+        self.bucket_total[index] = 0
+        self.bucket_players[index] = None
+
+    def advance(self, now_second: int):
+        """Сдвиг окна: выбрасываем корзины, вышедшие за его границу"""
+        if now_second <= self.head:
+            return
+        if now_second - self.head >= self.window:
+            for index in range(self.window):
+                self._evict(index)
+        else:
+            for second in range(self.head + 1, now_second + 1):
+                self._evict(second % self.window)
+        self.head = now_second
+
+    def add(self, user_id: str, amount: int, second: int):
+        index = second % self.window
+        if self.bucket_second[index] != second:
+            self._evict(index)
+            self.bucket_second[index] = second
+            self.bucket_players[index] = {}
+
+        self.bucket_count[index] += 1
+        self.bucket_total[index] += amount
+        bucket_players = self.bucket_players[index]
+        bucket_players[user_id] = bucket_players.get(user_id, 0) + 1
+
+        self.count += 1
+        self.total += amount
+        self.players[user_id] = self.players.get(user_id, 0) + 1
+
+
+class LotteryWindowAggregator:
+    """Статистика ставок по командам за последние N секунд - чтение за O(1)"""
+
+    TEAMS = ('eagle', 'tails')
+
+    def __init__(self, window_seconds: int = 300):
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        now_second = int(time.time())
+        self.teams = {
+            team: TeamBetWindow(window_seconds, now_second)
+            for team in self.TEAMS
+        }
+
+    def record_bet(self,
+                   team: str,
+                   user_id: str,
+                   amount: int,
+                   timestamp: Optional[float] = None):
+        """Учет ставки в момент ее записи"""
+        now_second = int(time.time())
+        second = int(timestamp) if timestamp is not None else now_second
+        if second <= now_second - self.window_seconds or second > now_second:
+            return
+
+        with self.lock:
+            window = self.teams[team]
+            window.advance(now_second)
+            window.add(user_id, amount, second)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Итоги окна по командам: ставки, сумма, уникальные игроки"""
+        now_second = int(time.time())
+        with self.lock:
+            result = {}
+            for team, window in self.teams.items():
+                window.advance(now_second)
+                result[team] = {
+                    'bet_count': window.count,
+                    'total_amount': window.total,
+                    'unique_players': len(window.players)
+                }
+            return result
+
+    def rebuild(self, database: 'HighPerformanceDatabase'):
+        """Восстановление окна из SQLite при старте"""
+        with database.reader() as conn:
+            rows = conn.execute(
+                f'''
+                SELECT team, user_id, amount,
+                       CAST(strftime('%s', timestamp) AS INTEGER) AS ts
+                FROM lottery_bets_high_perf
+                WHERE timestamp > datetime('now', '-{self.window_seconds} seconds')
+                ORDER BY timestamp
+                ''').fetchall()
+
+        for row in rows:
+            if row['team'] in self.teams:
+                self.record_bet(row['team'], row['user_id'], row['amount'],
+                                row['ts'])
+
+        logger.info(f"🎲 Окно ставок восстановлено: {len(rows)} ставок")
+
+
+# ИНИЦИАЛИЗАЦИЯ ОКНА СТАВОК ЛОТЕРЕИ
+lottery_window = LotteryWindowAggregator(window_seconds=300)
+lottery_window.rebuild(db)
+
+
+# ============================================================================
+# ПРИЕМ СТАВОК КОМАНДНОЙ ЛОТЕРЕИ И РАСЧЕТ РАУНДОВ
+# ============================================================================
+class TeamLotteryEngine:
+    """Ставки: проверка баланса в памяти, очередь и групповые коммиты.
+
+    На границе раунда одна транзакция писателя захватывает строку раунда,
+    читает его ставки из lottery_bets_high_perf и начисляет выплаты. Раунд
+    рассчитывает только тот, чья вставка строки раунда прошла.
+    """
+
+    TEAMS = ('eagle', 'tails')
+
+    BET_INSERT_QUERY = '''
+        INSERT INTO lottery_bets_high_perf (user_id, team, amount, timestamp)
+        VALUES (?, ?, ?, ?)
+    '''
+    # Захват раунда: rowcount 0 - раунд уже рассчитан
+    ROUND_CLAIM_QUERY = '''
+        INSERT INTO lottery_rounds_high_perf
+        (round_id, winning_team, total_pot, bets_count, winners_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(round_id) DO NOTHING
+    '''
+    # Ставки раунда: (начало, конец) в секундах эпохи
+    ROUND_BETS_QUERY = '''
+        SELECT b.user_id, COALESCE(p.username, b.user_id) AS username,
+               b.team, b.amount
+        FROM lottery_bets_high_perf b
+        LEFT JOIN players_high_perf p ON p.user_id = b.user_id
+        WHERE b.timestamp >= datetime(?, 'unixepoch')
+          AND b.timestamp < datetime(?, 'unixepoch')
+        ORDER BY b.id
+    '''
+    PAYOUT_QUERY = '''
+        UPDATE players_high_perf SET balance = balance + ?, version = version + 1
+        WHERE user_id = ?
+    '''
+
+    def __init__(self, database: 'HighPerformanceDatabase',
+                 ledger: WriteBehindBuffer,
+                 window: LotteryWindowAggregator):
+        self.db = database
+        self.ledger = ledger
+        self.window = window
+        self.round_seconds = PERFORMANCE_CONFIG['LOTTERY_ROUND_SEC']
+        self.flush_interval = PERFORMANCE_CONFIG['LOTTERY_FLUSH_MS'] / 1000
+        self.max_batch = PERFORMANCE_CONFIG['LOTTERY_MAX_BATCH']
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
+
+        # Ожидающие записи ставки: (user_id, team, amount, timestamp)
+        self.queue: List[tuple] = []
+        # Открытые раунды: round_id -> число ставок (сами ставки - в БД)
+        self.rounds: Dict[int, int] = {}
+        self.last_result: Optional[Dict] = None
+
+        self.stats = {
+            'bets_accepted': 0,
+            'bets_rejected': 0,
+            'bets_flushed': 0,
+            'flush_batches': 0,
+            'rounds_settled': 0,
+            'rounds_skipped': 0,
+            'last_settle_ms': 0.0
+        }
+
+        self._recover()
+
+        self.flusher = threading.Thread(target=self._run_flusher, daemon=True)
+        self.flusher.start()
+        self.settler = threading.Thread(target=self._run_settler, daemon=True)
+        self.settler.start()
+
+    def round_of(self, timestamp: float) -> int:
+        return int(timestamp // self.round_seconds)
+
+    def _recover(self):
+        """Ставки нерассчитанных раундов из SQLite после перезапуска"""
+        with self.db.reader() as conn:
+            last_settled = conn.execute(
+                "SELECT MAX(round_id) FROM lottery_rounds_high_perf").fetchone()[0]
+            if last_settled is None:
+                first_round = self.round_of(time.time())
+            else:
+                first_round = last_settled + 1
+
+            for row in conn.execute(
+                    '''
+                    SELECT CAST(strftime('%s', timestamp) AS INTEGER) / ?
+                           AS round_id, COUNT(*) AS bets
+                    FROM lottery_bets_high_perf
+                    WHERE timestamp >= datetime(?, 'unixepoch')
+                    GROUP BY 1
+                    ''', (self.round_seconds,
+                           first_round * self.round_seconds)):
+                self.rounds[row['round_id']] = row['bets']
+
+            if self.rounds:
+                logger.info(f"🎲 Восстановлено {sum(self.rounds.values())} "
+                            f"ставок {len(self.rounds)} нерассчитанных раундов")
+
+    def place_bet(self, user_id: str, team: str,
+                  amount: int) -> Tuple[bool, str, Optional[Dict]]:
+        """Прием ставки без обращения к БД на горячем пути"""
+        if team not in self.TEAMS:
+            return False, 'Неизвестная команда', None
+
+        player = self.ledger.adjust_balance(user_id, -amount)
+        if player is None:
+            self.stats['bets_rejected'] += 1
+            return False, 'Недостаточно средств', None
+
+        with self.lock:
+            # Номер раунда под блокировкой: расчет забирает раунды под ней же
+            now = time.time()
+            round_id = self.round_of(now)
+            self.rounds[round_id] = self.rounds.get(round_id, 0) + 1
+            self.queue.append(
+                (user_id, team, amount,
+                 datetime.utcfromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')))
+            batch_ready = len(self.queue) >= self.max_batch
+            self.stats['bets_accepted'] += 1
+
+        self.window.record_bet(team, user_id, amount, now)
+        if batch_ready:
+            self.flush_event.set()
+
+        return True, 'Ставка принята', {
+            'roundId': round_id,
+            'newBalance': player['balance']
+        }
+
+    def _run_flusher(self):
+        """Фоновый поток групповых коммитов ставок"""
+        while not self.stop_event.is_set():
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи ставок: {e}")
+
+    def flush(self):
+        """Групповой коммит накопленных ставок"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.queue:
+                    return
+                batch = self.queue
+                self.queue = []
+
+            written = 0
+            try:
+                for i in range(0, len(batch), self.max_batch):
+                    chunk = batch[i:i + self.max_batch]
+                    self.db.execute_many_fast(self.BET_INSERT_QUERY, chunk)
+                    written += len(chunk)
+                    self.stats['bets_flushed'] += len(chunk)
+                    self.stats['flush_batches'] += 1
+            except Exception:
+                # Незаписанные ставки возвращаем в начало очереди
+                with self.lock:
+                    self.queue = batch[written:] + self.queue
+                raise
+
+    def _run_settler(self):
+        """Поток расчета: просыпается на границе каждого раунда"""
+        while not self.stop_event.is_set():
+            try:
+                self.settle_due_rounds()
+            except Exception as e:
+                logger.error(f"❌ Ошибка расчета раунда лотереи: {e}")
+            delay = self.round_seconds - (time.time() % self.round_seconds)
+            self.stop_event.wait(delay + 0.05)
+
+    def settle_due_rounds(self):
+        """Расчет всех завершившихся раундов"""
+        with self.lock:
+            current = self.round_of(time.time())
+            due = sorted(round_id for round_id in self.rounds
+                         if round_id < current)
+            for round_id in due:
+                del self.rounds[round_id]
+
+        if not due:
+            return
+
+        settled = 0
+        try:
+            # Ставки должны лечь в БД раньше результата раунда
+            self.flush()
+            for round_id in due:
+                self._settle(round_id)
+                settled += 1
+        except Exception:
+            # Захват раунда не даст рассчитать его дважды - повторим позже
+            with self.lock:
+                for round_id in due[settled:]:
+                    self.rounds.setdefault(round_id, 0)
+            raise
+
+    @classmethod
+    def pari_mutuel_payouts(cls, stakes: Dict[str, Dict[str, int]],
+                            winning_team: str, pot: int) -> Dict[str, int]:
+        """Доли банка в целых нано-единицах пропорционально ставкам на
+        победившую команду; остаток от деления получает крупнейшая ставка,
+        чтобы банк распределялся без потерь"""
+        winning_total = sum(player_stakes[winning_team]
+                            for player_stakes in stakes.values())
+        payouts = {
+            user_id: player_stakes[winning_team] * pot // winning_total
+            for user_id, player_stakes in stakes.items()
+            if player_stakes[winning_team] > 0
+        }
+        top_stake = max(payouts,
+                        key=lambda user_id: stakes[user_id][winning_team])
+        payouts[top_stake] += pot - sum(payouts.values())
+        return payouts
+
+    def _settle_round(self, conn: sqlite3.Connection, round_id: int):
+        """Задание писателя: захват строки раунда, ставки из БД и выплаты
+        одной транзакцией; None - ставок нет или раунд уже рассчитан"""
+        start = round_id * self.round_seconds
+        bets = conn.execute(self.ROUND_BETS_QUERY,
+                            (start, start + self.round_seconds)).fetchall()
+        if not bets:
+            return None
+
+        # Один проход: суммы команд и ставки каждого игрока
+        team_totals = dict.fromkeys(self.TEAMS, 0)
+        stakes: Dict[str, Dict[str, int]] = {}
+        usernames: Dict[str, str] = {}
+        for bet in bets:
+            team_totals[bet['team']] += bet['amount']
+            player_stakes = stakes.setdefault(bet['user_id'],
+                                              dict.fromkeys(self.TEAMS, 0))
+            player_stakes[bet['team']] += bet['amount']
+            usernames[bet['user_id']] = bet['username']
+
+        pot = sum(team_totals.values())
+        # Шанс команды пропорционален ее сумме ставок (как показывает клиент)
+        winning_team = random.choices(
+            self.TEAMS, weights=[team_totals[team] for team in self.TEAMS])[0]
+        payouts = self.pari_mutuel_payouts(stakes, winning_team, pot)
+
+        claimed = conn.execute(self.ROUND_CLAIM_QUERY,
+                               (round_id, winning_team, pot, len(bets),
+                                len(payouts))).rowcount
+        if not claimed:
+            return None
+
+        results = []
+        for user_id, player_stakes in stakes.items():
+            staked = sum(player_stakes.values())
+            won = payouts.get(user_id, 0)
+            results.append((staked, max(won - staked, 0),
+                            max(staked - won, 0), user_id))
+        conn.executemany(self.PAYOUT_QUERY,
+                         [(payout, user_id)
+                          for user_id, payout in payouts.items()])
+        conn.executemany(self.db.PLAYER_LOTTERY_RESULT_QUERY, results)
+
+        placeholders = ', '.join('?' * len(payouts))
+        players = {
+            row['user_id']: dict(row) for row in conn.execute(
+                f"SELECT {', '.join(LeaderboardIndex.FIELDS)} "
+                f"FROM players_high_perf WHERE user_id IN ({placeholders})",
+                list(payouts))
+        }
+        return winning_team, pot, len(bets), payouts, usernames, players
+
+    def _settle(self, round_id: int):
+        start_time = time.perf_counter()
+        ledger = self.ledger
+
+        # Пока держим flush_lock, буфер не перезапишет начисленные балансы
+        with ledger.flush_lock:
+            # Начатый расчет дожидаемся: иначе выплаты не попадут в память
+            settled = self.db.writer.wait(
+                self.db.writer.submit(
+                    partial(self._settle_round, round_id=round_id)))
+            if settled is None:
+                self.stats['rounds_skipped'] += 1
+                return
+            winning_team, pot, bets_count, payouts, usernames, players = settled
+
+            # Выплаты уже в БД - переносим их в память буфера
+            with ledger.lock:
+                for user_id, payout in payouts.items():
+                    ledger.apply_committed(user_id, payout, now_ms())
+                    current = ledger.state.get(user_id)
+                    if current is not None:
+                        players[user_id] = dict(current)
+
+        query_cache.invalidate_tables('players_high_perf',
+                                      'lottery_rounds_high_perf')
+        for player in players.values():
+            leaderboard_index.update_player(player)
+
+        top_winner = max(payouts, key=payouts.get)
+        self.last_result = {
+            'round_id': round_id,
+            'team': winning_team,
+            'username': usernames[top_winner],
+            'prize': from_nano(payouts[top_winner]),
+            'total_pot': from_nano(pot),
+            'winners_count': len(payouts),
+            'timestamp': datetime.utcfromtimestamp(
+                (round_id + 1) * self.round_seconds).isoformat() + 'Z'
+        }
+
+        elapsed = (time.perf_counter() - start_time) * 1000
+        self.stats['rounds_settled'] += 1
+        self.stats['last_settle_ms'] = elapsed
+        logger.info(f"🏆 Раунд {round_id}: победила команда {winning_team}, "
+                    f"{bets_count} ставок, {len(payouts)} выплат "
+                    f"за {elapsed:.1f}ms")
+
+    def shutdown(self):
+        """Остановка потоков с выгрузкой очереди ставок"""
+        self.stop_event.set()
+        self.flush_event.set()
+        self.flusher.join(timeout=5)
+        self.flush()
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            queued = len(self.queue)
+            open_bets = sum(self.rounds.values())
+        return {**self.stats, 'queued_bets': queued, 'open_bets': open_bets}
 
-    def __init__(self):
-        self.active_sessions: Dict[str, Dict] = {}
-        self.session_lock = threading.RLock()
-        self.cleanup_interval = 10  # секунд
 
-        # Запускаем фоновую очистку
-        self._start_cleanup()
+# ИНИЦИАЛИЗАЦИЯ ДВИЖКА СТАВОК ЛОТЕРЕИ
+lottery_engine = TeamLotteryEngine(db, write_behind, lottery_window)
+atexit.register(lottery_engine.shutdown)
 
-    def _start_cleanup(self):
-        """Фоновая очистка старых сессий"""
 
-        def cleanup():
-            while True:
-                try:
-                    self.cleanup_expired_sessions()
-                except Exception as e:
-                    logger.error(f"Ошибка очистки сессий: {e}")
-                time.sleep(self.cleanup_interval)
+# ============================================================================
+# КЛАССИЧЕСКАЯ ЛОТЕРЕЯ: РАУНДЫ В ПАМЯТИ СО СНИМКАМИ В SQLITE
+# ============================================================================
+class ClassicRound:
+    """Ставки раунда в плотных массивах: индекс игрока -> имя и сумма ставок"""
+
+    __slots__ = ('round_id', 'index', 'user_ids', 'usernames', 'stakes', 'pot',
+                 'bet_count', 'seq', 'recent')
+
+    def __init__(self, round_id: int, recent_size: int):
+        self.round_id = round_id
+        self.index: Dict[str, int] = {}
+        self.user_ids: List[str] = []
+        self.usernames: List[str] = []
+        self.stakes = array('q')
+        self.pot = 0
+        self.bet_count = 0
+        self.seq = 0  # Номер последней учтенной ставки
+        # Последние ставки для статуса: (username, amount, timestamp)
+        self.recent = deque(maxlen=recent_size)
+
+    def add(self, user_id: str, username: str, amount: int,
+            timestamp: float, seq: int):
+        position = self.index.get(user_id)
+        if position is None:
+            position = len(self.user_ids)
+            self.index[user_id] = position
+            self.user_ids.append(user_id)
+            self.usernames.append(username)
+            self.stakes.append(0)
+
+        self.stakes[position] += amount
+        self.usernames[position] = username
+        self.pot += amount
+        self.bet_count += 1
+        self.seq = seq
+        self.recent.append((username, amount, timestamp))
+
+    def draw(self) -> int:
+        """Позиция победителя: шанс пропорционален сумме ставок игрока"""
+        cumulative = list(accumulate(self.stakes))
+        return bisect_right(cumulative, random.randrange(cumulative[-1]))
+
+    def checkpoint_state(self) -> Dict:
+        """Копия состояния для снимка (сериализуется вне блокировки)"""
+        return {
+            'user_ids': list(self.user_ids),
+            'usernames': list(self.usernames),
+            'stakes': self.stakes.tolist(),
+            'bet_count': self.bet_count,
+            'seq': self.seq,
+            'recent': list(self.recent)
+        }
 
-        thread = threading.Thread(target=cleanup, daemon=True)
-        thread.start()
+    @classmethod
+    def from_checkpoint(cls, round_id: int, state: Dict,
+                        recent_size: int) -> 'ClassicRound':
+        round_state = cls(round_id, recent_size)
+        round_state.user_ids = state['user_ids']
+        round_state.usernames = state['usernames']
+        round_state.stakes = array('q', state['stakes'])
+        round_state.index = {
+            user_id: position
+            for position, user_id in enumerate(round_state.user_ids)
+        }
+        round_state.pot = sum(round_state.stakes)
+        round_state.bet_count = state['bet_count']
+        round_state.seq = state['seq']
+        round_state.recent.extend(tuple(bet) for bet in state['recent'])
+        return round_state
+
+
+class ClassicLotteryEngine:
+    """Раунды классической лотереи: статус из памяти, журнал ставок и снимки.
+
+    Ставки пишутся в журнал групповыми коммитами, состояние раунда
+    периодически и при закрытии сохраняется снимком. После перезапуска
+    раунд поднимается из снимка и дочитывает только ставки после него.
+    """
+
+    # Номер ставки выдает БД (по префиксу первичного ключа): ставка не может
+    # совпасть с уже записанной и тихо пропасть. (round_id, user_id, amount,
+    # timestamp, round_id)
+    JOURNAL_INSERT_QUERY = '''
+        INSERT INTO classic_lottery_bets_high_perf
+        (round_id, seq, user_id, amount, timestamp)
+        SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?
+        FROM classic_lottery_bets_high_perf WHERE round_id = ?
+    '''
+    LAST_SEQ_QUERY = '''
+        SELECT MAX(seq) FROM classic_lottery_bets_high_perf WHERE round_id = ?
+    '''
+    CHECKPOINT_QUERY = '''
+        INSERT INTO classic_lottery_rounds_high_perf
+        (round_id, status, state, last_seq, total_pot, bets_count, participants)
+        VALUES (?, 'open', ?, ?, ?, ?, ?)
+        ON CONFLICT(round_id) DO UPDATE SET
+            state = excluded.state,
+            last_seq = excluded.last_seq,
+            total_pot = excluded.total_pot,
+            bets_count = excluded.bets_count,
+            participants = excluded.participants,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE status = 'open' AND last_seq < excluded.last_seq
+    '''
+    SETTLE_QUERY = '''
+        INSERT INTO classic_lottery_rounds_high_perf
+        (round_id, status, state, last_seq, total_pot, bets_count, participants,
+         winner_id, winner_name, prize)
+        VALUES (?, 'settled', NULL, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(round_id) DO UPDATE SET
+            status = 'settled',
+            state = NULL,
+            last_seq = excluded.last_seq,
+            total_pot = excluded.total_pot,
+            bets_count = excluded.bets_count,
+            participants = excluded.participants,
+            winner_id = excluded.winner_id,
+            winner_name = excluded.winner_name,
+            prize = excluded.prize,
+            updated_at = CURRENT_TIMESTAMP
+        -- Захват раунда: рассчитанный второй раз не разыгрывается
+        WHERE status = 'open'
+    '''
+    PRIZE_QUERY = '''
+        UPDATE players_high_perf SET balance = balance + ?, version = version + 1
+        WHERE user_id = ?
+    '''
+
+    def __init__(self, database: 'HighPerformanceDatabase',
+                 ledger: WriteBehindBuffer):
+        self.db = database
+        self.ledger = ledger
+        self.round_seconds = PERFORMANCE_CONFIG['CLASSIC_ROUND_SEC']
+        self.checkpoint_interval = PERFORMANCE_CONFIG['CLASSIC_CHECKPOINT_SEC']
+        self.flush_interval = PERFORMANCE_CONFIG['LOTTERY_FLUSH_MS'] / 1000
+        self.recent_size = PERFORMANCE_CONFIG['CLASSIC_RECENT_BETS']
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        self.current = ClassicRound(self.round_of(time.time()),
+                                    self.recent_size)
+        self.closed: List[ClassicRound] = []  # Ожидают розыгрыша
+        # Ожидающие записи в журнал: (round_id, seq, user_id, amount, timestamp)
+        self.journal: List[tuple] = []
+        self.history = deque(maxlen=PERFORMANCE_CONFIG['CLASSIC_HISTORY_SIZE'])
+        self.checkpointed = (self.current.round_id, 0)
+        self.last_checkpoint = time.time()
+
+        self.stats = {
+            'bets_accepted': 0,
+            'bets_rejected': 0,
+            'journal_rows': 0,
+            'checkpoints': 0,
+            'last_checkpoint_ms': 0.0,
+            'rounds_settled': 0,
+            'rounds_skipped': 0,
+            'replayed_bets': 0,
+            'journal_mismatches': 0
+        }
 
-    def register_session(
-            self,
-            user_id: str,
-            device_id: str,
-            ip_address: str,
-            user_agent: str,
-            telegram_id: Optional[str] = None) -> Tuple[bool, str]:
-        """
-        Регистрация новой сессии с блокировкой мультисессии
-        Возвращает: (успех, сообщение)
+        self._recover()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def round_of(self, timestamp: float) -> int:
+        return int(timestamp // self.round_seconds)
+
+    def _recover(self):
+        """Незавершенные раунды: снимок + ставки журнала после него"""
+        with self.db.reader() as conn:
+
+            for row in conn.execute('''
+                    SELECT round_id, winner_name, prize, participants, updated_at
+                    FROM classic_lottery_rounds_high_perf
+                    WHERE status = 'settled'
+                    ORDER BY round_id DESC LIMIT ?
+                    ''', (self.history.maxlen, )).fetchall()[::-1]:
+                self.history.appendleft(self._history_entry(
+                    row['round_id'], row['winner_name'], row['prize'],
+                    row['participants']))
+
+            last_settled = conn.execute('''
+                SELECT MAX(round_id) FROM classic_lottery_rounds_high_perf
+                WHERE status = 'settled'
+                ''').fetchone()[0]
+            round_ids = [
+                row[0] for row in conn.execute(
+                    '''
+                    SELECT round_id FROM classic_lottery_rounds_high_perf
+                    WHERE status = 'open'
+                    UNION
+                    SELECT DISTINCT round_id FROM classic_lottery_bets_high_perf
+                    WHERE round_id > ?
+                    ORDER BY round_id
+                    ''', (last_settled if last_settled is not None else -1, ))
+            ]
+
+            current_round = self.round_of(time.time())
+            for round_id in round_ids:
+                row = conn.execute(
+                    '''
+                    SELECT state FROM classic_lottery_rounds_high_perf
+                    WHERE round_id = ? AND status = 'open'
+                    ''', (round_id, )).fetchone()
+                if row is not None and row['state']:
+                    round_state = ClassicRound.from_checkpoint(
+                        round_id, json.loads(row['state']), self.recent_size)
+                else:
+                    round_state = ClassicRound(round_id, self.recent_size)
+                checkpoint_seq = round_state.seq
+
+                for bet in conn.execute(
+                        '''
+                        SELECT b.seq, b.user_id, b.amount,
+                               COALESCE(p.username, b.user_id) AS username,
+                               CAST(strftime('%s', b.timestamp) AS INTEGER) AS ts
+                        FROM classic_lottery_bets_high_perf b
+                        LEFT JOIN players_high_perf p ON p.user_id = b.user_id
+                        WHERE b.round_id = ? AND b.seq > ?
+                        ORDER BY b.seq
+                        ''', (round_id, checkpoint_seq)):
+                    round_state.add(bet['user_id'], bet['username'], bet['amount'],
+                                    bet['ts'], bet['seq'])
+                    self.stats['replayed_bets'] += 1
+
+                if round_id == current_round:
+                    self.current = round_state
+                    self.checkpointed = (round_id, checkpoint_seq)
+                elif round_id < current_round and round_state.bet_count:
+                    self.closed.append(round_state)
+
+            if round_ids:
+                logger.info(f"🎰 Классическая лотерея: восстановлено раундов "
+                            f"{len(round_ids)}, дочитано ставок "
+                            f"{self.stats['replayed_bets']}")
+
+    def _roll(self, now: float):
+        """Закрытие текущего раунда на границе (под self.lock)"""
+        round_id = self.round_of(now)
+        if round_id == self.current.round_id:
+            return
+        if self.current.bet_count:
+            self.closed.append(self.current)
+        self.current = ClassicRound(round_id, self.recent_size)
+
+    def place_bet(self, user_id: str,
+                  amount: int) -> Tuple[bool, str, Optional[Dict]]:
+        """Прием ставки: баланс и раунд в памяти, запись в журнал в фоне"""
+        player = self.ledger.adjust_balance(user_id, -amount)
+        if player is None:
+            self.stats['bets_rejected'] += 1
+            return False, 'Недостаточно средств', None
+
+        with self.lock:
+            now = time.time()
+            self._roll(now)
+            round_state = self.current
+            seq = round_state.seq + 1
+            round_state.add(user_id, player['username'], amount, now, seq)
+            self.journal.append(
+                (round_state.round_id, seq, user_id, amount,
+                 datetime.utcfromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')))
+            self.stats['bets_accepted'] += 1
+            pot = round_state.pot
+
+        return True, 'Ставка принята', {
+            'roundId': round_state.round_id,
+            'newBalance': player['balance'],
+            'totalPot': pot
+        }
+
+    def status(self) -> Dict:
+        """Статус раунда прямо из памяти"""
+        now = time.time()
+        with self.lock:
+            self._roll(now)
+            round_state = self.current
+            return {
+                'round_id': round_state.round_id,
+                'bets': [{
+                    'username': username,
+                    'amount': from_nano(amount),
+                    'timestamp': datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+                } for username, amount, timestamp in reversed(round_state.recent)],
+                'total_pot': from_nano(round_state.pot),
+                'bets_count': round_state.bet_count,
+                'participants_count': len(round_state.user_ids),
+                'timer': self.round_seconds - int(now % self.round_seconds),
+                'ends_at': (round_state.round_id + 1) * self.round_seconds,
+                'history': list(self.history)
+            }
+
+    def _run(self):
+        """Фоновый поток: журнал, снимки и розыгрыш закрытых раундов"""
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.settle_closed()
+                if time.time() - self.last_checkpoint >= self.checkpoint_interval:
+                    self.checkpoint()
+            except Exception as e:
+                logger.error(f"❌ Ошибка классической лотереи: {e}")
+
+    def flush(self):
+        """Групповой коммит журнала ставок"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.journal:
+                    return
+                batch = self.journal
+                self.journal = []
+            try:
+                self.db.write(partial(self._write_journal, batch=batch),
+                              'classic_lottery_bets_high_perf')
+            except Exception:
+                with self.lock:
+                    self.journal = batch + self.journal
+                raise
+            self.stats['journal_rows'] += len(batch)
+
+    def _write_journal(self, conn: sqlite3.Connection, batch: List[tuple]):
+        """Задание писателя: ставки журнала и сверка номеров с памятью.
+
+        Номера из памяти нужны снимку и восстановлению; в одном процессе они
+        совпадают с номерами БД, расхождение значит чужую запись в журнал.
         """
+        conn.executemany(self.JOURNAL_INSERT_QUERY,
+                         [(round_id, user_id, amount, timestamp, round_id)
+                          for round_id, _, user_id, amount, timestamp in batch])
+        last_seqs = {round_id: seq for round_id, seq, *_ in batch}
+        for round_id, seq in last_seqs.items():
+            stored = conn.execute(self.LAST_SEQ_QUERY, (round_id, )).fetchone()[0]
+            if stored != seq:
+                self.stats['journal_mismatches'] += 1
+                logger.error(f"❗ Журнал раунда {round_id}: последняя ставка "
+                             f"в БД {stored}, в памяти {seq}")
+
+    def checkpoint(self):
+        """Снимок текущего раунда (только если появились новые ставки)"""
+        self.last_checkpoint = time.time()
+        with self.lock:
+            round_state = self.current
+            if (round_state.round_id, round_state.seq) == self.checkpointed:
+                return
+            state = round_state.checkpoint_state()
+            round_id, seq = round_state.round_id, round_state.seq
+            totals = (round_state.pot, round_state.bet_count,
+                      len(round_state.user_ids))
+
         start_time = time.perf_counter()
+        serialized = json.dumps(state, separators=(',', ':'))
+        self.db.execute_fast(self.CHECKPOINT_QUERY,
+                             (round_id, serialized, seq) + totals)
+        self.checkpointed = (round_id, seq)
+        self.stats['checkpoints'] += 1
+        self.stats['last_checkpoint_ms'] = (time.perf_counter() -
+                                            start_time) * 1000
+
+    def settle_closed(self):
+        """Розыгрыш всех закрытых раундов; неразыгранные остаются в очереди"""
+        with self.lock:
+            self._roll(time.time())
+            if not self.closed:
+                return
+            closed = self.closed
+            self.closed = []
 
-        with self.session_lock:
-            current_time = time.time()
-            session_key = f"{user_id}_{device_id}"
-
-            # Проверяем существующие сессии для этого пользователя
-            sessions_to_remove = []
-
-            for existing_key, session in list(self.active_sessions.items()):
-                if existing_key.startswith(user_id + "_"):
-                    # Если сессия активна (менее 15 секунд) и с другого устройства
-                    if (current_time - session['last_activity']
-                            < PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC']
-                            and session['device_id'] != device_id):
-                        # БЛОКИРУЕМ мультисессию
-                        elapsed = time.perf_counter() - start_time
-                        logger.warning(
-                            f"🚫 Мультисессия заблокирована: {user_id} с {device_id}, активна на {session['device_id']} (время: {elapsed*1000:.1f}ms)"
-                        )
-                        return False, "Активная сессия обнаружена на другом устройстве"
-
-                    # Отмечаем старые сессии для удаления
-                    if current_time - session[
-                            'last_activity'] > PERFORMANCE_CONFIG[
-                                'SESSION_TIMEOUT_SEC'] * 3:
-                        sessions_to_remove.append(existing_key)
-
-            # Удаляем старые сессии
-            for key in sessions_to_remove:
-                self.active_sessions.pop(key, None)
-
-            # Регистрируем новую сессию
-            self.active_sessions[session_key] = {
-                'user_id': user_id,
-                'device_id': device_id,
-                'ip_address': ip_address,
-                'user_agent': user_agent[:100],
-                'telegram_id': telegram_id,
-                'created_at': current_time,
-                'last_activity': current_time,
-                'request_count': 0
+        try:
+            # Журнал раунда должен лечь в БД раньше результата
+            self.flush()
+        except Exception:
+            self._requeue(closed)
+            raise
+
+        failed = []
+        for round_state in closed:
+            try:
+                self._settle(round_state)
+            except Exception as e:
+                logger.error(f"❌ Розыгрыш раунда {round_state.round_id} "
+                             f"не удался, повторим: {e}")
+                failed.append(round_state)
+        self._requeue(failed)
+
+    def _requeue(self, rounds: List[ClassicRound]):
+        """Возврат раундов в очередь розыгрыша (перед закрытыми позже)"""
+        if rounds:
+            with self.lock:
+                self.closed = rounds + self.closed
+
+    def _settle_round(self, conn: sqlite3.Connection,
+                      round_state: ClassicRound, winner: int,
+                      results: List[tuple]) -> Optional[Dict]:
+        """Задание писателя: захват раунда, приз и итоги одной транзакцией;
+        None - раунд уже рассчитан"""
+        winner_id = round_state.user_ids[winner]
+        prize = round_state.pot
+        claimed = conn.execute(
+            self.SETTLE_QUERY,
+            (round_state.round_id, round_state.seq, prize,
+             round_state.bet_count, len(round_state.user_ids), winner_id,
+             round_state.usernames[winner], prize)).rowcount
+        if not claimed:
+            return None
+
+        conn.execute(self.PRIZE_QUERY, (prize, winner_id))
+        conn.executemany(self.db.PLAYER_LOTTERY_RESULT_QUERY, results)
+        row = conn.execute(
+            f"SELECT {', '.join(LeaderboardIndex.FIELDS)} "
+            f"FROM players_high_perf WHERE user_id = ?", (winner_id, )).fetchone()
+        return dict(row) if row is not None else {}
+
+    def _settle(self, round_state: ClassicRound):
+        winner = round_state.draw()
+        winner_id = round_state.user_ids[winner]
+        winner_name = round_state.usernames[winner]
+        prize = round_state.pot
+
+        results = [(stake, prize - stake if position == winner else 0,
+                    0 if position == winner else stake, user_id)
+                   for position, (user_id, stake) in enumerate(
+                       zip(round_state.user_ids, round_state.stakes))]
+
+        ledger = self.ledger
+        # Пока держим flush_lock, буфер не перезапишет начисленный приз
+        with ledger.flush_lock:
+            # Начатый расчет дожидаемся: иначе приз не попадет в память
+            player = self.db.writer.wait(
+                self.db.writer.submit(
+                    partial(self._settle_round,
+                            round_state=round_state,
+                            winner=winner,
+                            results=results)))
+            if player is None:
+                self.stats['rounds_skipped'] += 1
+                return
+
+            # Приз уже в БД - переносим его в память буфера
+            with ledger.lock:
+                ledger.apply_committed(winner_id, prize, now_ms())
+                current = ledger.state.get(winner_id)
+                if current is not None:
+                    player = dict(current)
+
+        query_cache.invalidate_tables('players_high_perf',
+                                      'classic_lottery_rounds_high_perf')
+        if player:
+            leaderboard_index.update_player(player)
+
+        with self.lock:
+            self.history.appendleft(self._history_entry(
+                round_state.round_id, winner_name, prize,
+                len(round_state.user_ids)))
+        self.stats['rounds_settled'] += 1
+        logger.info(f"🎰 Раунд {round_state.round_id}: победитель "
+                    f"{winner_name}, приз {from_nano(prize):.9f}")
+
+    def _history_entry(self, round_id: int, winner: str, prize: int,
+                       participants: int) -> Dict:
+        return {
+            'round_id': round_id,
+            'winner': winner,
+            'prize': from_nano(prize),
+            'participants': participants,
+            'timestamp': datetime.utcfromtimestamp(
+                (round_id + 1) * self.round_seconds).isoformat() + 'Z'
+        }
+
+    def shutdown(self):
+        """Остановка потока: журнал и финальный снимок"""
+        self.stop_event.set()
+        self.thread.join(timeout=5)
+        self.flush()
+        self.checkpoint()
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {
+                **self.stats, 'round_id': self.current.round_id,
+                'round_bets': self.current.bet_count,
+                'round_pot': self.current.pot,
+                'pending_journal': len(self.journal),
+                'pending_rounds': len(self.closed)
             }
 
-        elapsed = time.perf_counter() - start_time
-        logger.info(
-            f"✅ Сессия зарегистрирована: {user_id} за {elapsed*1000:.1f}ms")
-        return True, "Сессия создана"
 
-    def update_activity(self, user_id: str, device_id: str) -> bool:
-        """Обновление времени активности сессии"""
-        session_key = f"{user_id}_{device_id}"
+# ИНИЦИАЛИЗАЦИЯ КЛАССИЧЕСКОЙ ЛОТЕРЕИ
+classic_lottery = ClassicLotteryEngine(db, write_behind)
+atexit.register(classic_lottery.shutdown)
 
-        with self.session_lock:
-            if session_key in self.active_sessions:
-                self.active_sessions[session_key]['last_activity'] = time.time(
-                )
-                self.active_sessions[session_key]['request_count'] += 1
-                return True
-        return False
 
-    def cleanup_expired_sessions(self):
-        """Очистка просроченных сессий"""
-        with self.session_lock:
-            current_time = time.time()
-            expired_keys = []
+# ============================================================================
+# ПЕРЕВОДЫ: ОЧЕРЕДЬ, ГРУППЫ НЕПЕРЕСЕКАЮЩИХСЯ СЧЕТОВ И КЛЮЧИ ИДЕМПОТЕНТНОСТИ
+# ============================================================================
+class TransferRequest:
+    """Перевод в очереди движка; результат - через future"""
+
+    __slots__ = ('from_user_id', 'to_user_id', 'amount', 'to_username', 'key',
+                 'reserved', 'future')
+
+    def __init__(self, from_user_id: str, to_user_id: str, amount: int,
+                 to_username: str, key: Optional[str]):
+        self.from_user_id = from_user_id
+        self.to_user_id = to_user_id
+        self.amount = amount
+        self.to_username = to_username
+        self.key = key
+        self.reserved = False
+        self.future = Future()
+
+
+class TransferEngine:
+    """Переводы из очереди: пакет делится на группы с непересекающимися счетами.
+
+    Внутри группы у переводов нет общих счетов, поэтому решение по каждому
+    принимается по балансам на начало транзакции и записывается executemany -
+    одна транзакция писателя на группу. Переводы одного счета попадают в
+    группы в порядке поступления, блокировки по счетам не нужны.
+    """
+
+    # Начисление майнинга отправителю перед списанием: (now, now, now, user_id, now)
+    ACCRUE_QUERY = '''
+        UPDATE players_high_perf SET
+            balance = balance + mine_speed * (? - accrued_since) / 1000,
+            total_earned = total_earned + mine_speed * (? - accrued_since) / 1000,
+            accrued_since = ?
+        WHERE user_id = ? AND mine_speed > 0 AND accrued_since < ?
+    '''
+    DEBIT_QUERY = '''
+        UPDATE players_high_perf SET balance = balance - ?, version = version + 1
+        WHERE user_id = ? AND balance >= ?
+    '''
+    CREDIT_QUERY = '''
+        INSERT INTO players_high_perf (user_id, username, balance)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            balance = balance + excluded.balance, version = version + 1
+    '''
+    TRANSFER_INSERT_QUERY = '''
+        INSERT INTO transfers_high_perf
+        (id, from_user_id, to_user_id, amount, idempotency_key)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+    KEY_LOOKUP_QUERY = '''
+        SELECT id, to_user_id, amount FROM transfers_high_perf
+        WHERE from_user_id = ? AND idempotency_key = ?
+    '''
+
+    def __init__(self, database: 'HighPerformanceDatabase',
+                 ledger: WriteBehindBuffer):
+        self.db = database
+        self.ledger = ledger
+        self.max_batch = PERFORMANCE_CONFIG['TRANSFER_MAX_BATCH']
+
+        self.requests: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        # Ключи идемпотентности: (from_user_id, key) -> future / итог перевода
+        self.inflight: Dict[Tuple[str, str], Future] = {}
+        self.completed = cachetools.LRUCache(
+            maxsize=PERFORMANCE_CONFIG['TRANSFER_IDEMPOTENCY_CACHE'])
+
+        self.stats = {
+            'submitted': 0,
+            'applied': 0,
+            'rejected': 0,
+            'replayed': 0,
+            'failed': 0,
+            'batches': 0,
+            'groups': 0,
+            'last_batch_ms': 0.0
+        }
+
+        self.thread = threading.Thread(target=self._run,
+                                       name='transfer-engine',
+                                       daemon=True)
+        self.thread.start()
 
-            for key, session in list(self.active_sessions.items()):
-                if current_time - session['last_activity'] > PERFORMANCE_CONFIG[
-                        'SESSION_TIMEOUT_SEC'] * 3:
-                    expired_keys.append(key)
+    @staticmethod
+    def _error(message: str, status: int) -> Dict:
+        return {'ok': False, 'error': message, 'status': status}
+
+    def submit(self,
+               from_user_id: str,
+               to_user_id: str,
+               amount: int,
+               to_username: str,
+               key: Optional[str] = None) -> Future:
+        """Постановка перевода в очередь; повтор ключа не списывает дважды"""
+        request_key = (from_user_id, key) if key else None
+        with self.lock:
+            self.stats['submitted'] += 1
+            if request_key is not None:
+                done = self.completed.get(request_key)
+                if done is not None:
+                    future = Future()
+                    future.set_result(
+                        self._replay(done, to_user_id, amount))
+                    return future
+                future = self.inflight.get(request_key)
+                if future is not None:
+                    return future
+
+            item = TransferRequest(from_user_id, to_user_id, amount,
+                                   to_username, key)
+            if request_key is not None:
+                self.inflight[request_key] = item.future
+
+        self.requests.put(item)
+        return item.future
+
+    def _replay(self, done: Dict, to_user_id: str, amount: int) -> Dict:
+        """Ответ на повтор ключа: тот же перевод или конфликт параметров"""
+        if done['toUserId'] != to_user_id or done['amount'] != amount:
+            return self._error('Ключ идемпотентности уже использован', 409)
+        self.stats['replayed'] += 1
+        return {**done, 'replayed': True}
 
-            for key in expired_keys:
-                self.active_sessions.pop(key, None)
+    @staticmethod
+    def conflict_groups(batch: List[TransferRequest]) -> List[List[TransferRequest]]:
+        """Группы без общих счетов; перевод идет в группу после последней
+        группы, где встречались его счета"""
+        levels: Dict[str, int] = {}
+        groups: List[List[TransferRequest]] = []
+        for item in batch:
+            index = max(levels.get(item.from_user_id, -1),
+                        levels.get(item.to_user_id, -1)) + 1
+            if index == len(groups):
+                groups.append([])
+            groups[index].append(item)
+            levels[item.from_user_id] = levels[item.to_user_id] = index
+        return groups
+
+    def _run(self):
+        """Фоновый поток: пакет - все, что накопилось в очереди"""
+        while not self.stop_event.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            batch.extend(self._drain(self.max_batch - 1))
+            self.process(batch)
+
+    def _drain(self, limit: int) -> List[TransferRequest]:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def process(self, batch: List[TransferRequest]):
+        """Применение пакета: задания всех групп уходят писателю сразу"""
+        start_time = time.perf_counter()
+        ledger = self.ledger
+        groups = self.conflict_groups(batch)
+        finished: List[Tuple[TransferRequest, Dict]] = []
+        players: Dict[str, Dict] = {}
+        # Один момент начисления майнинга для резервов в памяти и для SQL
+        now = now_ms()
+
+        # Пока держим flush_lock, буфер не перезапишет балансы пакета
+        with ledger.flush_lock:
+            with ledger.lock:
+                prepared = [
+                    self._prepare(group, finished, now) for group in groups
+                ]
+            jobs = [(accepted, rows,
+                     self.db.writer.submit(
+                         partial(self._apply_group,
+                                 group=accepted,
+                                 rows=rows,
+                                 now=now)) if accepted else None)
+                    for accepted, rows in prepared]
+
+            for accepted, rows, future in jobs:
+                if future is None:
+                    continue
+                try:
+                    outcomes, group_players = self.db.writer.wait(future)
+                except Exception as e:
+                    # Транзакция группы откатана или снята с очереди до начала
+                    logger.error(f"❌ Ошибка группы переводов: {e}")
+                    self.stats['failed'] += len(accepted)
+                    with ledger.lock:
+                        for params in rows:
+                            ledger.pending.setdefault(params[0], params)
+                        for item in accepted:
+                            if item.reserved:
+                                ledger.release(item.from_user_id, item.amount)
+                    finished.extend((item, self._error('TRANSFER_ERROR', 500))
+                                    for item in accepted)
+                    continue
+
+                # Балансы уже в БД - переносим изменения в память буфера
+                with ledger.lock:
+                    for item, outcome in zip(accepted, outcomes):
+                        if outcome[0] == 'applied':
+                            ledger.apply_committed(item.to_user_id,
+                                                   item.amount, now)
+                            if not item.reserved:
+                                ledger.apply_committed(item.from_user_id,
+                                                       -item.amount, now)
+                        elif item.reserved:
+                            ledger.release(item.from_user_id, item.amount)
+                    for user_id, player in group_players.items():
+                        current = ledger.state.get(user_id)
+                        players[user_id] = (dict(current) if current
+                                            is not None else player)
+
+                for item, outcome in zip(accepted, outcomes):
+                    if outcome[0] == 'error':
+                        self.stats['rejected'] += 1
+                        finished.append(
+                            (item, self._error(outcome[1], outcome[2])))
+                        continue
+                    self.stats['replayed' if outcome[0] ==
+                               'replayed' else 'applied'] += 1
+                    finished.append((item, {
+                        'ok': True,
+                        'transactionId': outcome[1],
+                        'newBalance':
+                        group_players[item.from_user_id]['balance'],
+                        'toUserId': item.to_user_id,
+                        'amount': item.amount,
+                        'replayed': outcome[0] == 'replayed'
+                    }))
+
+        query_cache.invalidate_tables('players_high_perf', 'transfers_high_perf')
+        for player in players.values():
+            leaderboard_index.update_player(player)
+        for item, result in finished:
+            if result['ok']:
+                result['newBalance'] = players[item.from_user_id]['balance']
+            self._finish(item, result)
+
+        self.stats['batches'] += 1
+        self.stats['groups'] += len(groups)
+        self.stats['last_batch_ms'] = (time.perf_counter() - start_time) * 1000
+
+    def _prepare(self, group: List[TransferRequest],
+                 finished: List[Tuple[TransferRequest, Dict]], now: int):
+        """Резерв списаний в памяти и изъятие отложенных записей счетов
+        группы (под ledger.lock и ledger.flush_lock)"""
+        accepted = []
+        for item in group:
+            reserved = self.ledger.reserve(item.from_user_id, item.amount,
+                                           now)
+            # Повтор по ключу решает БД: исходный перевод уже списан
+            if reserved is False and item.key is None:
+                self.stats['rejected'] += 1
+                finished.append((item, self._error('Недостаточно средств',
+                                                   400)))
+                continue
+            item.reserved = bool(reserved)
+            accepted.append(item)
+        rows = self.ledger.take_pending({
+            user_id for item in accepted
+            for user_id in (item.from_user_id, item.to_user_id)
+        })
+        return accepted, rows
+
+    def _apply_group(self, conn: sqlite3.Connection,
+                     group: List[TransferRequest], rows: List[tuple],
+                     now: int):
+        """Задание писателя: одна транзакция на группу непересекающихся счетов"""
+        if rows:
+            conn.executemany(self.db.PLAYER_UPSERT_QUERY, rows)
+        conn.executemany(self.ACCRUE_QUERY,
+                         [(now, now, now, user_id, now)
+                          for user_id in {item.from_user_id
+                                          for item in group}])
+
+        outcomes: List[Optional[tuple]] = [None] * len(group)
+        for i, item in enumerate(group):
+            if item.key is None:
+                continue
+            row = conn.execute(self.KEY_LOOKUP_QUERY,
+                               (item.from_user_id, item.key)).fetchone()
+            if row is None:
+                continue
+            if row['to_user_id'] != item.to_user_id or row['amount'] != item.amount:
+                outcomes[i] = ('error', 'Ключ идемпотентности уже использован',
+                               409)
+            else:
+                outcomes[i] = ('replayed', row['id'])
 
-            if expired_keys:
-                logger.info(
-                    f"🧹 Удалено {len(expired_keys)} просроченных сессий")
+        accounts = list({
+            user_id for item in group
+            for user_id in (item.from_user_id, item.to_user_id)
+        })
+        placeholders = ', '.join('?' * len(accounts))
+        balances = {
+            row['user_id']: row['balance'] for row in conn.execute(
+                f"SELECT user_id, balance FROM players_high_perf "
+                f"WHERE user_id IN ({placeholders})", accounts)
+        }
 
-    def get_session_stats(self) -> Dict:
-        """Статистика сессий"""
-        with self.session_lock:
-            current_time = time.time()
-            active = 0
-            total_requests = 0
+        applied = []
+        for i, item in enumerate(group):
+            if outcomes[i] is not None:
+                continue
+            balance = balances.get(item.from_user_id)
+            if balance is None:
+                outcomes[i] = ('error', 'Отправитель не найден', 404)
+            elif balance < item.amount:
+                outcomes[i] = ('error', 'Недостаточно средств', 400)
+            else:
+                applied.append(i)
+
+        if applied:
+            # Проверка остатка повторяется в SQL: строк должно быть ровно столько
+            debited = conn.executemany(
+                self.DEBIT_QUERY,
+                [(group[i].amount, group[i].from_user_id, group[i].amount)
+                 for i in applied]).rowcount
+            if debited != len(applied):
+                raise sqlite3.IntegrityError('transfer balance check failed')
+            conn.executemany(self.CREDIT_QUERY,
+                             [(group[i].to_user_id, group[i].to_username,
+                               group[i].amount) for i in applied])
+
+            # Писатель один, поэтому идентификаторы назначаем сами
+            next_id = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM transfers_high_perf"
+            ).fetchone()[0] + 1
+            conn.executemany(self.TRANSFER_INSERT_QUERY, [
+                (next_id + n, group[i].from_user_id, group[i].to_user_id,
+                 group[i].amount, group[i].key) for n, i in enumerate(applied)
+            ])
+            for n, i in enumerate(applied):
+                outcomes[i] = ('applied', next_id + n)
+
+        players = {
+            row['user_id']: dict(row) for row in conn.execute(
+                f"SELECT {', '.join(LeaderboardIndex.FIELDS)} "
+                f"FROM players_high_perf WHERE user_id IN ({placeholders})",
+                accounts)
+        }
+        return outcomes, players
+
+    def _finish(self, item: TransferRequest, result: Dict):
+        if item.key:
+            request_key = (item.from_user_id, item.key)
+            with self.lock:
+                self.inflight.pop(request_key, None)
+                if result['ok']:
+                    self.completed[request_key] = result
+        item.future.set_result(result)
+
+    def shutdown(self):
+        """Остановка потока с применением оставшейся очереди"""
+        self.stop_event.set()
+        self.thread.join(timeout=5)
+        batch = self._drain(self.requests.qsize())
+        if batch:
+            self.process(batch)
+
+    def get_stats(self) -> Dict:
+        groups = self.stats['groups']
+        return {
+            **self.stats, 'queued': self.requests.qsize(),
+            'avg_group_size':
+            (self.stats['applied'] + self.stats['rejected'] +
+             self.stats['replayed']) / groups if groups else 0.0
+        }
+
+
+# ИНИЦИАЛИЗАЦИЯ ДВИЖКА ПЕРЕВОДОВ
+transfer_engine = TransferEngine(db, write_behind)
+atexit.register(transfer_engine.shutdown)
+
+
+# ============================================================================
+# SERVER-SENT EVENTS: РАССЫЛКА ОБНОВЛЕНИЙ ВСЕМ ПОДПИСЧИКАМ
+# ============================================================================
+class StreamHub:
+    """Хаб SSE: одна сериализация на обновление, общая для всех подписчиков.
+
+    Для каждого типа события хранится только последний готовый кадр -
+    события несут полное состояние, поэтому отставший или переподключенный
+    клиент получает сразу актуальный кадр вместо всей пропущенной истории.
+    """
+
+    def __init__(self, heartbeat_seconds: float, max_clients: int):
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_clients = max_clients
+        self.condition = threading.Condition()
+        # Идентификаторы растут и между перезапусками (старт от времени в мс)
+        self.sequence = int(time.time() * 1000)
+        self.latest: Dict[str, Tuple[int, bytes]] = {}
+        self.last_payload: Dict[str, str] = {}
+        self.subscribers = 0
+        # Общее событие пробуждения асинхронных подписчиков каждого цикла
+        self.loop_events: Dict[asyncio.AbstractEventLoop, asyncio.Event] = {}
+
+        self.sources: Dict[str, Callable[[], Dict]] = {}
+        self.publish_interval = PERFORMANCE_CONFIG['STREAM_PUBLISH_MS'] / 1000
+        self.publisher: Optional[threading.Thread] = None
+
+        self.stats = {
+            'published': 0,
+            'unchanged': 0,
+            'connections': 0,
+            'rejected': 0,
+            'frames_sent': 0,
+            'heartbeats': 0
+        }
 
-            for session in self.active_sessions.values():
-                if current_time - session['last_activity'] < PERFORMANCE_CONFIG[
-                        'SESSION_TIMEOUT_SEC']:
-                    active += 1
-                total_requests += session['request_count']
+    def publish(self, event: str, data: Dict) -> bool:
+        """Публикация события; False - состояние не изменилось"""
+        payload = PerformanceUtils.compress_json_response(data)
+        with self.condition:
+            if self.last_payload.get(event) == payload:
+                self.stats['unchanged'] += 1
+                return False
+            self.sequence += 1
+            frame = f"id: {self.sequence}\nevent: {event}\ndata: {payload}\n\n"
+            self.latest[event] = (self.sequence, frame.encode())
+            self.last_payload[event] = payload
+            self.stats['published'] += 1
+            self.condition.notify_all()
+
+        for loop in list(self.loop_events):
+            try:
+                loop.call_soon_threadsafe(self._wake_loop, loop)
+            except RuntimeError:
+                self.loop_events.pop(loop, None)  # Цикл уже закрыт
+        return True
+
+    def _frames_after(self, last_id: int) -> Tuple[int, List[bytes]]:
+        """Последние кадры новее last_id (под self.condition)"""
+        frames = sorted(item for item in self.latest.values()
+                        if item[0] > last_id)
+        if not frames:
+            return last_id, []
+        return frames[-1][0], [frame for _, frame in frames]
+
+    def add_source(self, event: str, source: Callable[[], Dict]):
+        """Источник состояния, опрашиваемый фоновым публикатором"""
+        self.sources[event] = source
+        if self.publisher is None:
+            self.publisher = threading.Thread(target=self._run_publisher,
+                                              daemon=True)
+            self.publisher.start()
+
+    def _run_publisher(self):
+        while True:
+            for event, source in list(self.sources.items()):
+                try:
+                    self.publish(event, source())
+                except Exception as e:
+                    logger.error(f"❌ Ошибка публикации события {event}: {e}")
+            time.sleep(self.publish_interval)
+
+    def _join(self, last_event_id: int) -> Optional[int]:
+        """Занять место подписчика; None - лимит подключений"""
+        with self.condition:
+            if self.subscribers >= self.max_clients:
+                self.stats['rejected'] += 1
+                return None
+            self.subscribers += 1
+            self.stats['connections'] += 1
+            if last_event_id > self.sequence:
+                return 0  # Идентификатор из будущего - сбросим
+            return last_event_id
+
+    def _leave(self):
+        with self.condition:
+            self.subscribers -= 1
 
+    @staticmethod
+    def _hello_frame() -> bytes:
+        hello = PerformanceUtils.compress_json_response(
+            {'server_time': time.time()})
+        return f"retry: 3000\nevent: hello\ndata: {hello}\n\n".encode()
+
+    def _wake_loop(self, loop: asyncio.AbstractEventLoop):
+        """Пробуждение асинхронных подписчиков цикла (в потоке цикла)"""
+        event = self.loop_events.get(loop)
+        if event is not None:
+            self.loop_events[loop] = asyncio.Event()
+            event.set()
+
+    def subscribe(self, last_event_id: int = 0):
+        """Генератор потока для одного клиента; None - лимит подключений"""
+        last_event_id = self._join(last_event_id)
+        if last_event_id is None:
+            return None
+
+        def generate():
+            last_id = last_event_id
+            try:
+                yield self._hello_frame()
+
+                while True:
+                    with self.condition:
+                        self.condition.wait_for(
+                            lambda: self.sequence > last_id,
+                            timeout=self.heartbeat_seconds)
+                        last_id, frames = self._frames_after(last_id)
+
+                    if frames:
+                        self.stats['frames_sent'] += len(frames)
+                        yield b''.join(frames)
+                    else:
+                        self.stats['heartbeats'] += 1
+                        yield b': ping\n\n'
+            finally:
+                self._leave()
+
+        return generate()
+
+    def subscribe_async(self, last_event_id: int = 0):
+        """Асинхронный генератор потока: ожидание без отдельного потока.
+
+        Все подписчики цикла событий ждут одно asyncio.Event, публикация
+        будит цикл одним call_soon_threadsafe.
+        """
+        last_event_id = self._join(last_event_id)
+        if last_event_id is None:
+            return None
+
+        async def generate():
+            loop = asyncio.get_running_loop()
+            last_id = last_event_id
+            try:
+                yield self._hello_frame()
+
+                while True:
+                    # Событие берем до проверки кадров - публикацию между ними не пропустим
+                    event = self.loop_events.get(loop)
+                    if event is None:
+                        event = self.loop_events[loop] = asyncio.Event()
+                    with self.condition:
+                        last_id, frames = self._frames_after(last_id)
+
+                    if frames:
+                        self.stats['frames_sent'] += len(frames)
+                        yield b''.join(frames)
+                        continue
+
+                    try:
+                        await asyncio.wait_for(event.wait(),
+                                               self.heartbeat_seconds)
+                    except asyncio.TimeoutError:
+                        self.stats['heartbeats'] += 1
+                        yield b': ping\n\n'
+            finally:
+                self._leave()
+
+        return generate()
+
+    def get_stats(self) -> Dict:
+        with self.condition:
             return {
-                'total_sessions': len(self.active_sessions),
-                'active_sessions': active,
-                'total_requests': total_requests,
-                'session_timeout': PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC']
+                **self.stats, 'subscribers': self.subscribers,
+                'last_event_id': self.sequence
             }
 
-    def check_session(self, user_id: str, device_id: str) -> Tuple[bool, str]:
-        """Проверка валидности сессии"""
-        session_key = f"{user_id}_{device_id}"
 
-        with self.session_lock:
-            if session_key not in self.active_sessions:
-                return False, "Сессия не найдена"
+# ИНИЦИАЛИЗАЦИЯ ХАБА SSE
+stream_hub = StreamHub(PERFORMANCE_CONFIG['STREAM_HEARTBEAT_SEC'],
+                       PERFORMANCE_CONFIG['STREAM_MAX_CLIENTS'])
 
-            session = self.active_sessions[session_key]
-            current_time = time.time()
 
-            if current_time - session['last_activity'] > PERFORMANCE_CONFIG[
-                    'SESSION_TIMEOUT_SEC']:
-                return False, "Сессия истекла"
+# ============================================================================
+# ФОРМАТЫ ОТВЕТОВ: JSON, MESSAGEPACK И ПОЗИЦИОННЫЕ МАССИВЫ
+# ============================================================================
+class PositionalSchema:
+    """Объект -> массив значений в порядке полей схемы.
+
+    Отсутствующее поле пакуется как null. Поля вне схемы идут последним
+    элементом-объектом, так что упаковка ничего не теряет. nested - схемы
+    вложенных объектов или элементов вложенных списков.
+    """
+
+    def __init__(self,
+                 name: str,
+                 fields: Tuple[str, ...],
+                 nested: Optional[Dict[str, 'PositionalSchema']] = None):
+        self.name = name
+        self.fields = fields
+        self.field_set = frozenset(fields)
+        self.nested = nested or {}
+        self.nested_index = tuple(
+            (fields.index(field), schema) for field, schema in self.nested.items())
+
+    def pack(self, data: Dict) -> List:
+        row = [data.get(field) for field in self.fields]
+        for index, schema in self.nested_index:
+            value = row[index]
+            if isinstance(value, list):
+                row[index] = [
+                    schema.pack(item) if isinstance(item, dict) else item
+                    for item in value
+                ]
+            elif isinstance(value, dict):
+                row[index] = schema.pack(value)
+
+        if data.keys() <= self.field_set:
+            return row
+        row.append({
+            field: value
+            for field, value in data.items() if field not in self.field_set
+        })
+        return row
 
-            return True, "Сессия активна"
+    def describe(self) -> Dict:
+        """Описание схемы для клиентов (/api/schema)"""
+        return {
+            'fields': list(self.fields),
+            'nested': {
+                field: schema.describe()
+                for field, schema in self.nested.items()
+            }
+        }
 
 
-# ИНИЦИАЛИЗАЦИЯ МЕНЕДЖЕРА СЕССИЙ
-session_manager = HighPerformanceSessionManager()
+class WireFormat:
+    """Сериализатор ответа: тип содержимого, кодировщик, упаковка по схеме"""
+
+    __slots__ = ('media_type', 'encode', 'positional')
+
+    def __init__(self, media_type: str, encode: Callable[[object], bytes],
+                 positional: bool):
+        self.media_type = media_type
+        self.encode = encode
+        self.positional = positional
+
+    def serialize(self, data: Dict,
+                  schema: Optional[PositionalSchema] = None) -> bytes:
+        if self.positional and schema is not None:
+            return self.encode(schema.pack(data))
+        return self.encode(data)
+
+
+def _encode_json(data) -> bytes:
+    return PerformanceUtils.compress_json_response(data).encode()
+
+
+def _encode_msgpack(data) -> bytes:
+    return msgpack.packb(data, use_bin_type=True)
+
+
+# Тип содержимого -> сериализатор; первый - формат по умолчанию (и для */*)
+WIRE_FORMATS: 'OrderedDict[str, WireFormat]' = OrderedDict()
+
+
+def register_wire_format(wire_format: WireFormat):
+    """Подключение сериализатора ответов"""
+    WIRE_FORMATS[wire_format.media_type] = wire_format
+    negotiate_wire_format.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def negotiate_wire_format(accept: Optional[str]) -> WireFormat:
+    """Формат ответа по заголовку Accept; без него - JSON"""
+    default = next(iter(WIRE_FORMATS))
+    if not accept:
+        return WIRE_FORMATS[default]
+    media_type = parse_accept_header(accept, MIMEAccept).best_match(
+        list(WIRE_FORMATS), default=default)
+    return WIRE_FORMATS[media_type]
+
+
+register_wire_format(WireFormat('application/json', _encode_json, False))
+register_wire_format(
+    WireFormat('application/vnd.sparkcoin.compact+json', _encode_json, True))
+if msgpack is not None:
+    register_wire_format(
+        WireFormat('application/msgpack', _encode_msgpack, False))
+    register_wire_format(
+        WireFormat('application/x-msgpack', _encode_msgpack, False))
+    register_wire_format(
+        WireFormat('application/vnd.sparkcoin.compact+msgpack',
+                   _encode_msgpack, True))
+
+# Позиционные схемы ответов (порядок полей - часть протокола, только дописываем)
+SYNC_RESPONSE_SCHEMA = PositionalSchema(
+    'sync', ('success', 'message', 'userId', 'username', 'balance',
+             'totalEarned', 'totalClicks', 'multisession', 'clickSpeed',
+             'mineSpeed', 'totalSpeed', 'level', 'referralCode', 'sessionValid',
+             'version', 'sessionLease', 'accruedAt'))
+LEADERBOARD_SCHEMA = PositionalSchema(
+    'leaderboard', ('success', 'leaderboard', 'type', 'updated'), {
+        'leaderboard':
+        PositionalSchema('leaderboard_entry',
+                         ('rank', 'userId', 'username', 'balance',
+                          'totalEarned', 'totalClicks', 'clickSpeed',
+                          'mineSpeed', 'totalSpeed', 'level'))
+    })
+_TEAM_SCHEMA = PositionalSchema('lottery_team', ('bets', 'total', 'players'))
+LOTTERY_STATUS_SCHEMA = PositionalSchema(
+    'lottery_status', ('success', 'lottery'), {
+        'lottery':
+        PositionalSchema('lottery',
+                         ('eagle', 'tails', 'total_pot', 'participants_count',
+                          'next_round', 'last_winner', 'timer'), {
+                              'eagle': _TEAM_SCHEMA,
+                              'tails': _TEAM_SCHEMA
+                          })
+    })
+WIRE_SCHEMAS = {
+    schema.name: schema
+    for schema in (SYNC_RESPONSE_SCHEMA, LEADERBOARD_SCHEMA,
+                   LOTTERY_STATUS_SCHEMA)
+}
 
 
 # ============================================================================
-# ВЫСОКОПРОИЗВОДИТЕЛЬНАЯ БАЗА ДАННЫХ
+# СНИМКИ ОТВЕТОВ: ГОТОВЫЕ БАЙТЫ, СЖАТЫЕ ВАРИАНТЫ И ETAG
 # ============================================================================
-class HighPerformanceDatabase:
-    """Оптимизированное подключение к SQLite для максимальной скорости"""
+class EncodedBody:
+    """Тело снимка в одном формате: байты, gzip/brotli и ETag"""
+
+    __slots__ = ('body', 'variants', 'etag')
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+
+        # Сжатые варианты - только для достаточно больших ответов
+        self.variants: Dict[str, bytes] = {}
+        if (PERFORMANCE_CONFIG['COMPRESS_RESPONSES']
+                and len(self.body) >= PERFORMANCE_CONFIG['COMPRESS_MIN_BYTES']):
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(self.body, quality=5)
+            self.variants['gzip'] = gzip.compress(self.body, compresslevel=6)
+
+
+class ResponseSnapshot:
+    """Ответ, сериализованный один раз на формат: JSON сразу, прочие - по запросу"""
+
+    __slots__ = ('data', 'schema', 'encoded')
+
+    def __init__(self, data: Dict, schema: Optional[PositionalSchema] = None):
+        self.data = data
+        self.schema = schema
+        self.encoded: Dict[str, EncodedBody] = {}
+        self.encode(WIRE_FORMATS['application/json'])
+
+    def encode(self, wire_format: WireFormat) -> EncodedBody:
+        """Тело в нужном формате (гонка двух потоков даст одинаковые байты)"""
+        encoded = self.encoded.get(wire_format.media_type)
+        if encoded is None:
+            encoded = EncodedBody(wire_format.serialize(self.data, self.schema))
+            self.encoded[wire_format.media_type] = encoded
+        return encoded
+
+    def to_response(self):
+        """Ответ Flask в формате из Accept; выбор сжатия и 304 - в after_request"""
+        wire_format = negotiate_wire_format(request.headers.get('Accept'))
+        encoded = self.encode(wire_format)
+        response = make_response(encoded.body)
+        response.mimetype = wire_format.media_type
+        response.vary.add('Accept')
+        g.response_snapshot = encoded
+        return response
 
-    def __init__(self, db_path='sparkcoin_high_perf.db'):
-        self.db_path = db_path
-        self.connection_pool = {}
-        self.pool_lock = threading.RLock()
-        self.max_connections = PERFORMANCE_CONFIG['MAX_CONCURRENT_DB']
+    @staticmethod
+    def negotiate(response):
+        """ETag/304 и нужный клиенту вариант сжатия для снимка"""
+        snapshot = g.response_snapshot
+        response.set_etag(snapshot.etag)
+        response.vary.add('Accept-Encoding')
 
-        # Инициализируем базу
-        self._init_database()
+        if request.if_none_match.contains(snapshot.etag):
+            response.status_code = 304
+            response.set_data(b'')
+            return response
 
-    def _get_connection(self) -> sqlite3.Connection:
-        """Получение соединения из пула (с учетом потокобезопасности)"""
-        thread_id = threading.get_ident()
-
-        with self.pool_lock:
-            if thread_id not in self.connection_pool:
-                # Создаем новое соединение если не превышен лимит
-                if len(self.connection_pool) >= self.max_connections:
-                    # Удаляем самое старое соединение
-                    oldest_thread = min(
-                        self.connection_pool.items(),
-                        key=lambda x: x[1].get('last_used', 0))[0]
-                    conn_data = self.connection_pool.pop(oldest_thread)
-                    conn_data['conn'].close()
-
-                conn = sqlite3.connect(
-                    self.db_path,
-                    timeout=PERFORMANCE_CONFIG['DB_TIMEOUT_MS'] / 1000,
-                    check_same_thread=False)
-                conn.row_factory = sqlite3.Row
-
-                # Оптимизация для высокой производительности
-                conn.execute(
-                    "PRAGMA journal_mode = WAL")  # Write-Ahead Logging
-                conn.execute("PRAGMA synchronous = NORMAL"
-                             )  # Баланс скорости и надежности
-                conn.execute("PRAGMA cache_size = -2000")  # 2MB кэша
-                conn.execute("PRAGMA mmap_size = 268435456")  # 256MB mmap
-                conn.execute(
-                    "PRAGMA temp_store = MEMORY")  # Временные таблицы в памяти
-                conn.execute("PRAGMA locking_mode = EXCLUSIVE"
-                             )  # Эксклюзивная блокировка
-                conn.execute("PRAGMA optimize")  # Автооптимизация
-
-                self.connection_pool[thread_id] = {
-                    'conn': conn,
-                    'last_used': time.time()
-                }
+        if snapshot.variants:
+            encoding = request.accept_encodings.best_match(
+                list(snapshot.variants))
+            if encoding:
+                response.set_data(snapshot.variants[encoding])
+                response.headers['Content-Encoding'] = encoding
 
-            # Обновляем время использования
-            self.connection_pool[thread_id]['last_used'] = time.time()
-            return self.connection_pool[thread_id]['conn']
+        return response
 
-    def _init_database(self):
-        """Оптимизированная инициализация структуры базы данных"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
 
-        try:
-            # ОПТИМИЗИРОВАННАЯ ТАБЛИЦА ИГРОКОВ
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS players_high_perf (
-                    user_id TEXT PRIMARY KEY,
-                    telegram_id TEXT UNIQUE,
-                    username TEXT NOT NULL,
-                    balance REAL DEFAULT 0.000000100 CHECK(balance >= 0),
-                    total_earned REAL DEFAULT 0.000000100,
-                    total_clicks INTEGER DEFAULT 0,
-                    upgrades TEXT DEFAULT '{}',
-                    click_speed REAL DEFAULT 0.000000001,
-                    mine_speed REAL DEFAULT 0.000000000,
-                    total_speed REAL GENERATED ALWAYS AS (click_speed + mine_speed) VIRTUAL,
-                    level INTEGER DEFAULT 1,
-                    experience INTEGER DEFAULT 0,
-                    referral_code TEXT UNIQUE,
-                    referred_by TEXT,
-                    referral_earnings REAL DEFAULT 0,
-                    referrals_count INTEGER DEFAULT 0,
-                    total_winnings REAL DEFAULT 0,
-                    total_losses REAL DEFAULT 0,
-                    total_bet REAL DEFAULT 0,
-                    transfers_sent REAL DEFAULT 0,
-                    transfers_received REAL DEFAULT 0,
-                    last_device_id TEXT,
-                    last_ip TEXT,
-                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+# ============================================================================
+# КЭШ HTTP-ОТВЕТОВ: КЛЮЧ ПО ЗАПРОСУ, SINGLE-FLIGHT И STALE-WHILE-REVALIDATE
+# ============================================================================
+class HTTPResponseCache:
+    """Снимки ответов GET по пути, нормализованной строке запроса и заголовкам"""
+
+    def __init__(self, max_entries: int, wait_timeout: float,
+                 refresh_threads: int):
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        # ключ -> (снимок, свежий до, допустим устаревшим до)
+        self.entries: 'OrderedDict[str, Tuple[ResponseSnapshot, float, float]]' = OrderedDict()
+        # ключ -> результат вычисления, которого ждут остальные запросы
+        self.inflight: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.refresher = ThreadPoolExecutor(max_workers=refresh_threads,
+                                            thread_name_prefix='cache-refresh')
+        self.stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'wait_timeouts': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'evictions': 0,
+            'degraded': 0
+        }
 
-                    -- Индексы для быстрого поиска
-                    INDEX idx_telegram_id (telegram_id),
-                    INDEX idx_balance (balance DESC),
-                    INDEX idx_total_speed (total_speed DESC),
-                    INDEX idx_last_activity (last_activity DESC),
-                    INDEX idx_referral_code (referral_code)
-                ) WITHOUT ROWID
-            ''')
+    @staticmethod
+    def make_key(query_params: Optional[Tuple[str, ...]],
+                 vary: Tuple[str, ...]) -> str:
+        """Путь + параметры в каноническом порядке + значения заголовков vary"""
+        params = [(name, value)
+                  for name, value in request.args.items(multi=True)
+                  if query_params is None or name in query_params]
+        # Стабильная сортировка по имени - порядок повторов сохраняется
+        params.sort(key=lambda item: item[0])
+        headers = '\x1f'.join(request.headers.get(name, '') for name in vary)
+        return f"{request.path}?{urlencode(params)}\x1e{headers}"
+
+    def fetch(self, key: str, compute: Callable, ttl: float, stale: float):
+        """Снимок из кэша или результат compute(), посчитанный одним потоком.
+
+        compute() возвращает ResponseSnapshot (его кэшируем) либо некэшируемый
+        результат маршрута (ошибку со статусом) - его получают и ждавшие того
+        же ключа запросы.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                snapshot, fresh_until, stale_until = entry
+                if now < fresh_until:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return snapshot
+                if now < stale_until:
+                    # Отдаем устаревший снимок, обновляем в фоне один раз
+                    self.entries.move_to_end(key)
+                    self.stats['stale_hits'] += 1
+                    if key not in self.inflight:
+                        flight = self.inflight[key] = Future()
+                        self.stats['refreshes'] += 1
+                        self.refresher.submit(self._refresh, key, flight,
+                                              compute, ttl, stale)
+                    return snapshot
+                # Просроченный снимок не удаляем: он - ответ по исчерпанному
+                # бюджету (last_snapshot), пока его не заменит новый
+
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Future()
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
 
-            # ОПТИМИЗИРОВАННАЯ ТАБЛИЦА СТАВОК
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS lottery_bets_high_perf (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    team TEXT CHECK(team IN ('eagle', 'tails')),
-                    amount REAL NOT NULL CHECK(amount > 0),
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        if leader:
+            return self._fill(key, flight, compute, ttl, stale)
 
-                    INDEX idx_user_team (user_id, team),
-                    INDEX idx_timestamp (timestamp DESC),
-                    FOREIGN KEY (user_id) REFERENCES players_high_perf(user_id) ON DELETE CASCADE
-                )
-            ''')
+        # Ждем не дольше бюджета запроса - дальше отвечает last_snapshot
+        deadline = request_deadline.get()
+        timeout = self.wait_timeout
+        if deadline is not None:
+            timeout = min(timeout, max(0.0, deadline - time.perf_counter()))
+        try:
+            return flight.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                self.stats['wait_timeouts'] += 1
+            if timeout < self.wait_timeout:
+                raise DeadlineExceeded('бюджет исчерпан в ожидании кэша')
+            # Вычисление зависло - не держим запрос, считаем сами без кэша
+            return compute()
+
+    def _fill(self, key: str, flight: Future, compute: Callable, ttl: float,
+              stale: float):
+        """Вычисление записи лидером: сохраняем снимок и будим ждущих"""
+        try:
+            result = compute()
+            # Ошибки (кортеж со статусом) не кэшируем
+            if isinstance(result, ResponseSnapshot):
+                self._store(key, result, ttl, stale)
+        except BaseException as e:
+            with self.lock:
+                self.inflight.pop(key, None)
+            flight.set_exception(e)
+            raise
 
-            # ОПТИМИЗИРОВАННАЯ ТАБЛИЦА ПЕРЕВОДОВ
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS transfers_high_perf (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    from_user_id TEXT NOT NULL,
-                    to_user_id TEXT NOT NULL,
-                    amount REAL NOT NULL CHECK(amount > 0),
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        with self.lock:
+            self.inflight.pop(key, None)
+        flight.set_result(result)
+        return result
 
-                    INDEX idx_from_user (from_user_id),
-                    INDEX idx_to_user (to_user_id),
-                    INDEX idx_transfer_time (timestamp DESC),
-                    FOREIGN KEY (from_user_id) REFERENCES players_high_perf(user_id),
-                    FOREIGN KEY (to_user_id) REFERENCES players_high_perf(user_id),
-                    CHECK (from_user_id != to_user_id)
-                )
-            ''')
+    def _refresh(self, key: str, flight: Future, compute: Callable,
+                 ttl: float, stale: float):
+        try:
+            self._fill(key, flight, compute, ttl, stale)
+        except Exception as e:
+            # Устаревший снимок дослужит до конца окна stale
+            with self.lock:
+                self.stats['refresh_errors'] += 1
+            logger.warning(f"⚠️ Фоновое обновление кэша {key}: {e}")
+
+    def _store(self, key: str, snapshot: 'ResponseSnapshot', ttl: float,
+               stale: float):
+        now = time.monotonic()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (snapshot, now + ttl, now + ttl + stale)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def last_snapshot(self, key: str) -> Optional['ResponseSnapshot']:
+        """Последний снимок ключа независимо от срока - деградированный ответ"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.stats['degraded'] += 1
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            served = (self.stats['hits'] + self.stats['stale_hits'] +
+                      self.stats['coalesced'])
+            lookups = served + self.stats['misses']
+            return {
+                **self.stats, 'entries': len(self.entries),
+                'inflight': len(self.inflight),
+                'max_entries': self.max_entries,
+                'hit_ratio': served / lookups if lookups else 0.0
+            }
 
-            conn.commit()
-            logger.info("✅ Высокопроизводительная БД инициализирована")
+    def shutdown(self):
+        self.refresher.shutdown(wait=False)
 
-        except Exception as e:
-            logger.error(f"❌ Ошибка инициализации БД: {e}")
-            conn.rollback()
-        finally:
-            # Не закрываем соединение, возвращаем в пул
-            pass
 
-    def execute_fast(self, query: str, params: tuple = ()) -> List[Dict]:
-        """Выполнение запроса с кэшированием"""
-        start_time = time.perf_counter()
+# ИНИЦИАЛИЗАЦИЯ КЭША ОТВЕТОВ
+response_cache = HTTPResponseCache(
+    max_entries=PERFORMANCE_CONFIG['MAX_CACHE_SIZE'],
+    wait_timeout=PERFORMANCE_CONFIG['CACHE_FLIGHT_WAIT_SEC'],
+    refresh_threads=PERFORMANCE_CONFIG['CACHE_REFRESH_THREADS'])
+atexit.register(response_cache.shutdown)
 
-        # Проверка кэша
-        cache_key = f"{query}_{params}"
-        if PERFORMANCE_CONFIG[
-                'ENABLE_QUERY_CACHE'] and cache_key in query_cache:
-            elapsed = time.perf_counter() - start_time
-            logger.debug(f"📦 Запрос из кэша: {elapsed*1000:.1f}ms")
-            return query_cache[cache_key]
 
-        conn = self._get_connection()
-        cursor = conn.cursor()
+# ============================================================================
+# КОНТРОЛЬ ДОПУСКА: КОРЗИНЫ ТОКЕНОВ, ЛИМИТЫ ОДНОВРЕМЕННОСТИ И СБРОС НАГРУЗКИ
+# ============================================================================
+# Классы маршрутов: деньги (переводы, ставки) - critical, остальное
+# отсекается раньше; маршруты вне списка (health, админка, SSE) не ограничены
+ADMISSION_ROUTES = {
+    '/api/transfer': 'critical',
+    '/api/lottery/bet': 'critical',
+    '/api/classic-lottery/bet': 'critical',
+    '/api/sync/delta': 'normal',
+    '/api/session/check': 'normal',
+    '/api/session/release': 'normal',
+    '/api/sync/unified': 'low',
+    '/api/leaderboard': 'low',
+    '/api/lottery/status': 'low',
+    '/api/classic-lottery/status': 'low',
+    '/api/schema': 'low'
+}
 
-        try:
-            cursor.execute(query, params)
 
-            if query.strip().upper().startswith('SELECT'):
-                results = [dict(row) for row in cursor.fetchall()]
-                # Кэшируем результат
-                if PERFORMANCE_CONFIG['ENABLE_QUERY_CACHE']:
-                    query_cache[cache_key] = results
-            else:
-                conn.commit()
-                results = {'affected_rows': cursor.rowcount}
+class TokenBuckets:
+    """Корзины токенов по ключу: rate токенов в секунду, не больше burst"""
+
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        # Вытесненная корзина просто начинается заново полной
+        self.buckets = cachetools.LRUCache(maxsize=max_keys)
+        self.lock = threading.Lock()
+
+    def take(self, key: str, now: float) -> float:
+        """Токен для key: 0 - взят, иначе секунд до следующего токена"""
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = [self.burst - 1, now]
+                return 0.0
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+
+class AdaptiveConcurrencyLimit:
+    """Лимит одновременных запросов по живой задержке (AIMD).
+
+    Каждые window ответов считается p95: выше цели - лимит умножается на
+    backoff, иначе растет на единицу, если в окне его использовали хотя бы
+    наполовину (простаивающий лимит не раздувается).
+    """
+
+    def __init__(self, target_ms: float, initial: int, minimum: int,
+                 maximum: int, window: int, backoff: float):
+        self.target_ms = target_ms
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.backoff = backoff
+
+        self.samples: List[float] = []
+        self.peak_inflight = 0
+        self.p95_ms = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'increases': 0, 'decreases': 0}
+
+    def record(self, latency: float, inflight: int):
+        """Задержка завершенного запроса и число запросов в работе"""
+        with self.lock:
+            self.samples.append(latency)
+            self.peak_inflight = max(self.peak_inflight, inflight)
+            if len(self.samples) < self.window:
+                return
+
+            samples = sorted(self.samples)
+            self.p95_ms = samples[int(len(samples) * 0.95)] * 1000
+            if self.p95_ms > self.target_ms:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self.stats['decreases'] += 1
+            elif self.peak_inflight >= self.limit / 2:
+                self.limit = min(self.maximum, self.limit + 1)
+                self.stats['increases'] += 1
+            self.samples = []
+            self.peak_inflight = 0
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats, 'limit': round(self.limit, 1),
+            'p95_ms': round(self.p95_ms, 2),
+            'target_ms': self.target_ms
+        }
 
-            elapsed = time.perf_counter() - start_time
-            if elapsed > 0.05:  # Логируем только медленные запросы
-                logger.warning(
-                    f"⚠️ Медленный запрос: {elapsed*1000:.1f}ms - {query[:50]}..."
-                )
 
-            return results
+class AdmissionController:
+    """Допуск запроса до обработчика: быстрый отказ вместо общей очереди.
 
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"❌ Ошибка БД: {e} - {query[:50]}...")
-            raise
+    Сначала корзины токенов игрока и IP (429), затем потолок класса и доля
+    общего адаптивного лимита (503). Класс critical адаптивным лимитом не
+    ограничен, но его запросы занимают общий лимит - под нагрузкой первыми
+    отсекаются синхронизации и статусы, а переводы и ставки проходят.
+    """
 
-    def execute_many_fast(self, query: str, params_list: List[tuple]) -> int:
-        """Массовое выполнение запросов"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+    def __init__(self):
+        self.ip_buckets = TokenBuckets(*PERFORMANCE_CONFIG['RATE_LIMIT_IP'],
+                                       PERFORMANCE_CONFIG['RATE_LIMIT_KEYS'])
+        self.user_buckets = TokenBuckets(
+            *PERFORMANCE_CONFIG['RATE_LIMIT_USER'],
+            PERFORMANCE_CONFIG['RATE_LIMIT_KEYS'])
+        self.classes = PERFORMANCE_CONFIG['ADMISSION_CLASSES']
+        self.limiter = AdaptiveConcurrencyLimit(
+            PERFORMANCE_CONFIG['MAX_RESPONSE_TIME_MS'],
+            *PERFORMANCE_CONFIG['ADMISSION_LIMIT'],
+            window=PERFORMANCE_CONFIG['ADMISSION_WINDOW'],
+            backoff=PERFORMANCE_CONFIG['ADMISSION_BACKOFF'])
+
+        self.inflight = {route_class: 0 for route_class in self.classes}
+        self.total_inflight = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            route_class: {'admitted': 0, 'rate_limited': 0, 'shed': 0}
+            for route_class in self.classes
+        }
 
-        try:
-            cursor.executemany(query, params_list)
-            conn.commit()
-            return cursor.rowcount
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"❌ Ошибка массового запроса: {e}")
-            raise
+    @staticmethod
+    def classify(path: str) -> Optional[str]:
+        """Класс маршрута по пути; None - без контроля допуска"""
+        while path:
+            route_class = ADMISSION_ROUTES.get(path)
+            if route_class is not None:
+                return route_class
+            path = path.rpartition('/')[0]
+        return None
+
+    def admit(self, route_class: str, ip_address: Optional[str],
+              user_id: Optional[str]) -> Tuple[bool, int, float]:
+        """(допущен, статус отказа, Retry-After в секундах).
+
+        Допущенный запрос обязательно завершается release().
+        """
+        stats = self.stats[route_class]
+        now = time.monotonic()
+        wait = max(
+            self.ip_buckets.take(ip_address, now) if ip_address else 0.0,
+            self.user_buckets.take(user_id, now) if user_id else 0.0)
+        if wait:
+            stats['rate_limited'] += 1
+            return False, 429, wait
+
+        class_limit, share = self.classes[route_class]
+        with self.lock:
+            if (self.inflight[route_class] >= class_limit
+                    or (share is not None and
+                        self.total_inflight >= self.limiter.limit * share)):
+                stats['shed'] += 1
+                return False, 503, PERFORMANCE_CONFIG[
+                    'ADMISSION_RETRY_AFTER_SEC']
+            self.inflight[route_class] += 1
+            self.total_inflight += 1
+        stats['admitted'] += 1
+        return True, 200, 0.0
+
+    def release(self, route_class: str, latency: float):
+        """Завершение допущенного запроса: замер для адаптивного лимита"""
+        with self.lock:
+            inflight = self.total_inflight
+            self.inflight[route_class] -= 1
+            self.total_inflight -= 1
+        self.limiter.record(latency, inflight)
+
+    @staticmethod
+    def denied_response(status: int, retry_after: float) -> Tuple[Dict, int, Dict]:
+        """Тело, статус и заголовки отказа (общие для Flask и ASGI)"""
+        retry_after = max(1, math.ceil(retry_after))
+        return {
+            'success': False,
+            'error': 'RATE_LIMITED' if status == 429 else 'OVERLOADED',
+            'retryAfter': retry_after
+        }, status, {'Retry-After': str(retry_after)}
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            inflight = dict(self.inflight)
+        return {
+            'inflight': inflight,
+            'classes': {
+                route_class: dict(stats)
+                for route_class, stats in self.stats.items()
+            },
+            'limiter': self.limiter.get_stats(),
+            'ip_buckets': len(self.ip_buckets),
+            'user_buckets': len(self.user_buckets)
+        }
 
 
-# ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ
-db = HighPerformanceDatabase()
+# ИНИЦИАЛИЗАЦИЯ КОНТРОЛЯ ДОПУСКА
+admission = AdmissionController()
 
 
 # ============================================================================
@@ -427,14 +5126,34 @@ class PerformanceUtils:
 
     @staticmethod
     def time_limit(timeout_ms: int):
-        """Декоратор для ограничения времени выполнения функции"""
+        """Декоратор бюджета маршрута: чтения из БД прерываются по дедлайну.
+
+        Исчерпанный бюджет - быстрый 503 с Retry-After вместо опоздавшего
+        ответа (кэшируемые маршруты отдают последний снимок еще раньше).
+        """
 
         def decorator(func):
 
             @wraps(func)
             def wrapper(*args, **kwargs):
                 start_time = time.perf_counter()
-                result = func(*args, **kwargs)
+                if not PERFORMANCE_CONFIG['DEADLINES_ENABLED']:
+                    result = func(*args, **kwargs)
+                else:
+                    try:
+                        with deadline_scope(timeout_ms):
+                            result = func(*args, **kwargs)
+                    except DeadlineExceeded as e:
+                        logger.warning(
+                            f"⏱️ {func.__name__}: бюджет {timeout_ms}ms "
+                            f"исчерпан - {e}")
+                        retry_after = PERFORMANCE_CONFIG[
+                            'DEADLINE_RETRY_AFTER_SEC']
+                        return {
+                            'success': False,
+                            'error': 'DEADLINE_EXCEEDED',
+                            'retryAfter': retry_after
+                        }, 503, {'Retry-After': str(retry_after)}
                 elapsed = time.perf_counter() - start_time
 
                 if elapsed * 1000 > timeout_ms:
@@ -449,28 +5168,93 @@ class PerformanceUtils:
         return decorator
 
     @staticmethod
-    def cache_response(ttl_seconds: int = 5):
-        """Декоратор для кэширования ответов API"""
+    def cache_response(ttl_seconds: float = PERFORMANCE_CONFIG['CACHE_TTL_SEC'],
+                       stale_seconds: float = 0,
+                       query_params: Optional[Tuple[str, ...]] = None,
+                       vary: Tuple[str, ...] = (),
+                       schema: Optional[PositionalSchema] = None):
+        """Декоратор для кэширования ответов GET в виде готовых снимков
+
+        ttl_seconds   - сколько снимок считается свежим;
+        stale_seconds - сколько еще отдавать устаревший снимок, обновляя его в фоне;
+        query_params  - параметры, влияющие на ответ (None - все);
+        vary          - заголовки запроса, влияющие на ответ;
+        schema        - позиционная схема для компактных форматов.
+        Формат ответа (Accept) ключ не меняет: снимок хранит тело в каждом формате.
+        """
 
         def decorator(func):
 
             @wraps(func)
             def wrapper(*args, **kwargs):
-                # Создаем ключ кэша на основе аргументов
-                cache_key = f"{func.__name__}_{str(args)}_{str(kwargs)}"
+                if request.method not in ('GET', 'HEAD'):
+                    return func(*args, **kwargs)
+
+                cache_key = response_cache.make_key(query_params, vary)
+                # Фоновое обновление идет вне запроса - в копии его окружения
+                environ = dict(request.environ)
+
+                def call():
+                    if has_request_context():
+                        return func(*args, **kwargs)
+                    with app.request_context(environ):
+                        return func(*args, **kwargs)
+
+                def compute():
+                    result = call()
+                    # Ошибки (кортеж со статусом) не кэшируем
+                    if isinstance(result, dict):
+                        return ResponseSnapshot(result, schema)
+                    return result
+
+                degraded = False
+                try:
+                    result = response_cache.fetch(cache_key, compute,
+                                                  ttl_seconds, stale_seconds)
+                except DeadlineExceeded:
+                    # Опоздавший ответ хуже старого: последний снимок, если есть
+                    result = response_cache.last_snapshot(cache_key)
+                    if result is None:
+                        raise
+                    degraded = True
+                if not isinstance(result, ResponseSnapshot):
+                    return result
+
+                response = result.to_response()
+                response.vary.update(vary)
+                if degraded:
+                    response.headers['Warning'] = '110 - "Response is Stale"'
+                return response
 
-                # Пробуем получить из кэша
-                if cache_key in response_cache:
-                    logger.debug(f"📦 Ответ из кэша: {func.__name__}")
-                    return response_cache[cache_key]
+            return wrapper
 
-                # Выполняем функцию
-                result = func(*args, **kwargs)
+        return decorator
+
+    @staticmethod
+    def negotiate_format(schema: Optional[PositionalSchema] = None):
+        """Декоратор некэшируемого маршрута: ответ в формате из Accept.
 
-                # Сохраняем в кэш
-                response_cache[cache_key] = result
+        Позиционная схема применяется только к успешным ответам (200).
+        """
 
-                return result
+        def decorator(func):
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                result = func(*args, **kwargs)
+                data, status = result if isinstance(result, tuple) else (result,
+                                                                         200)
+                if not isinstance(data, dict):
+                    return result
+
+                wire_format = negotiate_wire_format(
+                    request.headers.get('Accept'))
+                response = make_response(
+                    wire_format.serialize(data, schema if status == 200 else None),
+                    status)
+                response.mimetype = wire_format.media_type
+                response.vary.add('Accept')
+                return response
 
             return wrapper
 
@@ -524,29 +5308,95 @@ app.config['JSON_SORT_KEYS'] = False  # Не сортируем ключи дл
 def before_request():
     """Перед каждым запросом - замер времени"""
     g.start_time = time.perf_counter()
+    if forked_worker:
+        return jsonify({'success': False, 'error': 'SINGLE_PROCESS_ONLY'}), 503
 
     # Минимальное логирование для скорости
     if not PERFORMANCE_CONFIG['MINIMIZE_LOGGING']:
         logger.info(f"▶️ {request.method} {request.path}")
 
+    # Контроль допуска: отказ до разбора запроса обработчиком
+    route_class = admission.classify(request.path)
+    if (route_class is None or request.method == 'OPTIONS'
+            or not PERFORMANCE_CONFIG['ADMISSION_ENABLED']):
+        return None
+    data = request.get_json(silent=True) if request.is_json else None
+    admitted, status, retry_after = admission.admit(
+        route_class, request.remote_addr,
+        _admission_user_id(data, request.headers, request.view_args))
+    if not admitted:
+        body, status, headers = admission.denied_response(status, retry_after)
+        return jsonify(body), status, headers
+    g.admission_class = route_class
+    return None
+
+
+def _admission_user_id(data: Optional[Dict], headers,
+                       view_args: Optional[Dict]) -> Optional[str]:
+    """Игрок запроса для корзины токенов: тело, заголовок или путь"""
+    if isinstance(data, dict):
+        user_id = data.get('userId') or data.get('fromUserId')
+        if user_id:
+            return str(user_id)
+    user_id = headers.get('X-User-ID')
+    if user_id:
+        return user_id
+    if view_args and view_args.get('user_id'):
+        return str(view_args['user_id'])
+    return None
+
+
+@app.teardown_request
+def teardown_request(exc):
+    """Освобождение места в лимите допуска - и при исключении в обработчике"""
+    route_class = g.pop('admission_class', None)
+    if route_class is not None:
+        admission.release(route_class, time.perf_counter() - g.start_time)
+
+
+def _cors_headers(origin: str) -> Dict[str, str]:
+    """Заголовки CORS для разрешенного источника (общие для Flask и ASGI)"""
+    if origin not in ALLOWED_ORIGINS:
+        return {}
+    return {
+        'Access-Control-Allow-Origin': origin,
+        'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers':
+        'Content-Type, Authorization, X-Device-ID, X-User-ID, Idempotency-Key',
+        'Access-Control-Allow-Credentials': 'true',
+        'Access-Control-Max-Age': '86400'
+    }
+
 
 @app.after_request
 def after_request(response):
     """После каждого запроса - обработка CORS и замер времени"""
     # Обработка CORS
-    origin = request.headers.get('Origin', '')
-    if origin in ALLOWED_ORIGINS:
-        response.headers['Access-Control-Allow-Origin'] = origin
-        response.headers[
-            'Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        response.headers[
-            'Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Device-ID, X-User-ID'
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
-        response.headers['Access-Control-Max-Age'] = '86400'
+    response.headers.update(_cors_headers(request.headers.get('Origin', '')))
+
+    # Снимки из кэша: ETag/304 и готовый сжатый вариант
+    if 'response_snapshot' in g:
+        response = ResponseSnapshot.negotiate(response)
+    elif (PERFORMANCE_CONFIG['COMPRESS_RESPONSES']
+          and response.mimetype == 'application/json'
+          and not response.direct_passthrough
+          and 'Content-Encoding' not in response.headers
+          and response.content_length is not None
+          and response.content_length >= PERFORMANCE_CONFIG['COMPRESS_MIN_BYTES']
+          and request.accept_encodings['gzip']):
+        # Динамические ответы сжимаем на лету
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
 
     # Замер производительности
     elapsed = time.perf_counter() - g.start_time
     response.headers['X-Response-Time'] = f'{elapsed*1000:.1f}ms'
+    if PERFORMANCE_CONFIG['METRICS_ENABLED']:
+        metrics.observe_request(
+            request.method,
+            request.url_rule.rule if request.url_rule else 'unmatched',
+            response.status_code, elapsed)
     response.headers['X-Server-Performance'] = 'high-speed'
 
     # Логирование медленных запросов
@@ -559,7 +5409,7 @@ def after_request(response):
 
 @app.route('/api/health', methods=['GET', 'OPTIONS'])
 @perf_utils.time_limit(50)
-@perf_utils.cache_response(ttl_seconds=2)
+@perf_utils.cache_response(ttl_seconds=2, query_params=())
 def health_check():
     """Проверка здоровья сервера - ОЧЕНЬ БЫСТРАЯ"""
     session_stats = session_manager.get_session_stats()
@@ -578,27 +5428,143 @@ def health_check():
     }
 
 
+def _sync_values(fields: Dict) -> Dict:
+    """Колонки игрока из разобранной полной синхронизации"""
+    return {
+        column: fields[column]
+        for column in ('username', 'balance', 'total_earned', 'total_clicks')
+    }
+
+
+def _upsert_args(fields: Dict, ip_address: str) -> tuple:
+    """Аргументы upsert_player для нового игрока"""
+    return (fields['user_id'], fields['username'], fields['telegram_id'],
+            fields['balance'], fields['total_earned'], fields['total_clicks'],
+            fields['device_id'], ip_address, fields['upgrades'] or '{}')
+
+
+def _sync_player_write_behind(fields: Dict, ip_address: str) -> Dict:
+    """Синхронизация через буфер отложенной записи - ответ из памяти"""
+    player = _submit_synced_player(fields, ip_address)
+
+    if player is None:
+        # Игрока нет ни в памяти, ни в БД - пишем сразу одним UPSERT,
+        # строка из RETURNING становится состоянием в памяти
+        player = db.upsert_player(*_upsert_args(fields, ip_address))
+        return _remember_synced_player(player, fields['device_id'],
+                                       ip_address)
+
+    return player
+
+
+def _remember_synced_player(player: Dict, device_id: str,
+                            ip_address: str) -> Dict:
+    """Строка из RETURNING становится состоянием игрока в памяти"""
+    player.update({'last_device_id': device_id, 'last_ip': ip_address})
+    write_behind.remember(player)
+    leaderboard_index.update_player(player)
+    return player
+
+
+def _submit_synced_player(fields: Dict, ip_address: str) -> Optional[Dict]:
+    """Сверка с состоянием в памяти (при промахе - из БД) и постановка
+    изменений в очередь записи; None - игрока еще нет"""
+    outcome, player, _ = write_behind.apply_delta(fields['user_id'], None,
+                                                  _sync_values(fields),
+                                                  fields['device_id'],
+                                                  ip_address,
+                                                  fields['upgrades'])
+    if outcome == 'applied':
+        leaderboard_index.update_player(player)
+    return player
+
+
+def _sync_player_row(conn: sqlite3.Connection, fields: Dict,
+                     ip_address: str) -> Dict:
+    """Задание писателя для режима без буфера: запись, только если
+    синхронизация что-то изменила"""
+    outcome, player, _ = _apply_sync_delta(conn, fields['user_id'], None,
+                                           _sync_values(fields),
+                                           fields['upgrades'],
+                                           fields['device_id'], ip_address)
+    if outcome is None:
+        player = dict(
+            conn.execute(
+                HighPerformanceDatabase.PLAYER_UPSERT_RETURNING_QUERY,
+                HighPerformanceDatabase.player_params(
+                    *_upsert_args(fields, ip_address))).fetchone())
+    return player
+
+
+def _build_sync_response(user_data: Dict) -> Dict:
+    """Ответ синхронизации из строки игрока: баланс с майнингом на сейчас"""
+    now = now_ms()
+    user_data = accrue(dict(user_data), now)
+    return {
+        'success': True,
+        'message': 'Синхронизация успешна',
+        'userId': user_data['user_id'],
+        'username': user_data['username'],
+        'balance': from_nano(user_data['balance']),
+        'totalEarned': from_nano(user_data['total_earned']),
+        'totalClicks': int(user_data['total_clicks']),
+        'multisession': False,
+        'clickSpeed': from_nano(user_data.get('click_speed', 1)),
+        'mineSpeed': from_nano(user_data.get('mine_speed', 0)),
+        'totalSpeed': from_nano(user_data.get('total_speed', 1)),
+        'level': int(user_data.get('level', 1)),
+        'referralCode': user_data.get('referral_code', ''),
+        'sessionValid': True,
+        'version': user_data.get('version', 0),
+        'accruedAt': now
+    }
+
+
+def _parse_sync_request(data: Dict) -> Tuple[Optional[Dict], Optional[str]]:
+    """Валидация и разбор тела синхронизации: (поля, ошибка)"""
+    valid, error = perf_utils.validate_request_data(
+        data, ['userId', 'username', 'deviceId'])
+    if not valid:
+        return None, error
+
+    return {
+        'user_id': data['userId'],
+        'username': data['username'],
+        'device_id': data['deviceId'],
+        'telegram_id': data.get('telegramId'),
+        'balance': to_nano(data.get('balance', 0.000000100)),
+        'total_earned': to_nano(data.get('totalEarned', 0.000000100)),
+        'total_clicks': int(data.get('totalClicks', 0)),
+        'upgrades': normalize_upgrades(data.get('upgrades'))
+    }, None
+
+
+def _multisession_blocked(message: str) -> Tuple[Dict, int]:
+    return {
+        'success': False,
+        'error': 'MULTISESSION_BLOCKED',
+        'message': message,
+        'multisession': True
+    }, 403
+
+
 @app.route('/api/sync/unified', methods=['POST', 'OPTIONS'])
 @perf_utils.time_limit(100)
+@perf_utils.negotiate_format(SYNC_RESPONSE_SCHEMA)
 def sync_unified():
     """Высокопроизводительная синхронизация с блокировкой мультисессии"""
     try:
         data = request.get_json()
 
         # Быстрая валидация
-        valid, error = perf_utils.validate_request_data(
-            data, ['userId', 'username', 'deviceId'])
-        if not valid:
+        fields, error = _parse_sync_request(data)
+        if error:
             return {'success': False, 'error': error}, 400
 
         # Извлекаем данные
-        user_id = data['userId']
-        username = data['username']
-        device_id = data['deviceId']
-        telegram_id = data.get('telegramId')
-        balance = float(data.get('balance', 0.000000100))
-        total_earned = float(data.get('totalEarned', 0.000000100))
-        total_clicks = int(data.get('totalClicks', 0))
+        user_id = fields['user_id']
+        device_id = fields['device_id']
+        telegram_id = fields['telegram_id']
 
         # БЛОКИРОВКА МУЛЬТИСЕССИИ
         ip_address = request.remote_addr
@@ -612,151 +5578,251 @@ def sync_unified():
             telegram_id=telegram_id)
 
         if not allowed:
-            return {
-                'success': False,
-                'error': 'MULTISESSION_BLOCKED',
-                'message': message,
-                'multisession': True
-            }, 403
+            return _multisession_blocked(message)
 
         # БЫСТРАЯ СИНХРОНИЗАЦИЯ В БАЗЕ
         try:
-            # Проверяем существование пользователя
-            user_exists = db.execute_fast(
-                "SELECT user_id FROM players_high_perf WHERE user_id = ?",
-                (user_id, ))
-
-            if user_exists:
-                # Обновляем существующего пользователя
-                db.execute_fast(
-                    '''
-                    UPDATE players_high_perf SET
-                    username = ?, balance = ?, total_earned = ?, total_clicks = ?,
-                    last_activity = CURRENT_TIMESTAMP, last_device_id = ?, last_ip = ?
-                    WHERE user_id = ?
-                    ''', (username, balance, total_earned, total_clicks,
-                          device_id, ip_address, user_id))
+            if PERFORMANCE_CONFIG['WRITE_BEHIND_ENABLED']:
+                user_data = _sync_player_write_behind(fields, ip_address)
             else:
-                # Создаем нового пользователя
-                referral_code = f"REF-{uuid.uuid4().hex[:8].upper()}"
-
-                db.execute_fast(
-                    '''
-                    INSERT INTO players_high_perf 
-                    (user_id, username, telegram_id, balance, total_earned, total_clicks,
-                     referral_code, last_device_id, last_ip)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''',
-                    (user_id, username, telegram_id, balance, total_earned,
-                     total_clicks, referral_code, device_id, ip_address))
-
-            # Получаем обновленные данные
-            user_data = db.execute_fast(
-                '''
-                SELECT user_id, username, balance, total_earned, total_clicks,
-                       click_speed, mine_speed, total_speed, level, experience,
-                       referral_code, referrals_count, referral_earnings
-                FROM players_high_perf 
-                WHERE user_id = ?
-                ''', (user_id, ))[0] if user_exists else {
-                    'user_id': user_id,
-                    'username': username,
-                    'balance': balance,
-                    'total_earned': total_earned,
-                    'total_clicks': total_clicks,
-                    'click_speed': 0.000000001,
-                    'mine_speed': 0.000000000,
-                    'total_speed': 0.000000001,
-                    'level': 1,
-                    'experience': 0,
-                    'referral_code': referral_code,
-                    'referrals_count': 0,
-                    'referral_earnings': 0
-                }
-
-            return {
-                'success': True,
-                'message': 'Синхронизация успешна',
-                'userId': user_data['user_id'],
-                'username': user_data['username'],
-                'balance': float(user_data['balance']),
-                'totalEarned': float(user_data['total_earned']),
-                'totalClicks': int(user_data['total_clicks']),
-                'multisession': False,
-                'clickSpeed': float(user_data.get('click_speed', 0.000000001)),
-                'mineSpeed': float(user_data.get('mine_speed', 0.000000000)),
-                'totalSpeed': float(user_data.get('total_speed', 0.000000001)),
-                'level': int(user_data.get('level', 1)),
-                'referralCode': user_data.get('referral_code', ''),
-                'sessionValid': True
-            }
-
+                # Одно задание писателя: сверка со строкой и запись изменений
+                user_data = db.write(
+                    partial(_sync_player_row,
+                            fields=fields,
+                            ip_address=ip_address), 'players_high_perf')
+                leaderboard_index.update_player(user_data)
+
+            response = _build_sync_response(user_data)
+            response['sessionLease'] = session_leases.issue(
+                user_id, device_id)
+            return response
+
+        except DeadlineExceeded:
+            raise  # Ответ по бюджету формирует time_limit
         except Exception as db_error:
             logger.error(f"❌ Ошибка БД при синхронизации: {db_error}")
             return {'success': False, 'error': 'DATABASE_ERROR'}, 500
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка синхронизации: {e}")
         return {'success': False, 'error': 'SYNC_ERROR'}, 500
 
 
-@app.route('/api/lottery/status', methods=['GET', 'OPTIONS'])
+# ДЕЛЬТА-СИНХРОНИЗАЦИЯ: ТОЛЬКО ИЗМЕНЕННЫЕ ПОЛЯ ОТ ИЗВЕСТНОЙ ВЕРСИИ
+# Поле в JSON -> (колонка, разбор значения клиента, значение в ответе)
+SYNC_DELTA_FIELDS = {
+    'username': ('username', str, str),
+    'balance': ('balance', to_nano, from_nano),
+    'totalEarned': ('total_earned', to_nano, from_nano),
+    'totalClicks': ('total_clicks', int, int)
+}
+SYNC_DELTA_COLUMNS = {
+    column: (name, dump)
+    for name, (column, _, dump) in SYNC_DELTA_FIELDS.items()
+}
+
+
+def _parse_sync_delta(data: Dict) -> Tuple[Optional[Dict], Optional[str]]:
+    """Валидация и разбор тела дельта-синхронизации: (поля, ошибка)"""
+    valid, error = perf_utils.validate_request_data(data,
+                                                    ['userId', 'deviceId'])
+    if not valid:
+        return None, error
+
+    changes = data.get('changes') or {}
+    if not isinstance(changes, dict):
+        return None, "Некорректное значение: changes"
+    for name in changes:
+        if name not in SYNC_DELTA_FIELDS:
+            return None, f"Неизвестное поле: {name}"
+    valid, error = perf_utils.validate_request_data(changes, [])
+    if not valid:
+        return None, error
+
+    try:
+        base_version = int(data['baseVersion'])
+        parsed = {
+            SYNC_DELTA_FIELDS[name][0]: SYNC_DELTA_FIELDS[name][1](value)
+            for name, value in changes.items()
+        }
+    except (KeyError, TypeError, ValueError):
+        return None, "Некорректное значение: baseVersion"
+    if 'username' in parsed and not parsed['username']:
+        return None, "Отсутствует поле: username"
+
+    return {
+        'user_id': data['userId'],
+        'device_id': data['deviceId'],
+        'telegram_id': data.get('telegramId'),
+        'lease': data.get('lease'),
+        'base_version': base_version,
+        'changes': parsed,
+        'upgrades': normalize_upgrades(data.get('upgrades'))
+    }, None
+
+
+def _sync_fields_json(columns: Dict) -> Dict:
+    """Колонки игрока -> поля JSON дельта-протокола"""
+    return {
+        SYNC_DELTA_COLUMNS[column][0]: SYNC_DELTA_COLUMNS[column][1](value)
+        for column, value in columns.items()
+    }
+
+
+def _apply_sync_delta(conn: sqlite3.Connection, user_id: str,
+                      base_version: Optional[int], changes: Dict,
+                      upgrades: Optional[str], device_id: str,
+                      ip_address: str) -> Tuple[Optional[str], Optional[Dict], Dict]:
+    """Задание писателя для режима без буфера: compare-and-set по версии в БД"""
+    row = conn.execute(
+        f"SELECT {WriteBehindBuffer.PLAYER_FIELDS} FROM players_high_perf "
+        "WHERE user_id = ?", (user_id, )).fetchone()
+    if row is None:
+        return None, None, {}
+
+    player = dict(row)
+    outcome, _, server_fields = WriteBehindBuffer.settle_sync(
+        player, base_version, changes, upgrades, now_ms())
+    if outcome != 'applied':
+        return outcome, player, server_fields
+
+    # Строка прочитана в этом же задании писателя - версия из нее растет на 1
+    player['version'] += 1
+    player.update({
+        'last_device_id': device_id,
+        'last_ip': ip_address,
+        'last_activity': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    })
+    row = conn.execute(HighPerformanceDatabase.PLAYER_UPSERT_RETURNING_QUERY,
+                       WriteBehindBuffer._to_params(player)).fetchone()
+    return 'applied', dict(row), server_fields
+
+
+@app.route('/api/sync/delta', methods=['POST', 'OPTIONS'])
 @perf_utils.time_limit(50)
-@perf_utils.cache_response(ttl_seconds=1)
-def lottery_status():
-    """Быстрый статус лотереи"""
+def sync_delta():
+    """Дельта-синхронизация: изменившиеся поля и версия, от которой они считались.
+
+    Пустая дельта при действующей аренде - проверка версии в памяти без
+    обращения к хранилищу сессий и без записи в БД.
+    """
     try:
-        # Используем синхронизированный таймер
-        lottery_timer = 60 - (int(time.time()) % 60)
+        fields, error = _parse_sync_delta(request.get_json())
+        if error:
+            return {'success': False, 'error': error}, 400
 
-        # Быстрая статистика
-        stats = db.execute_fast('''
-            SELECT 
-                team,
-                COUNT(*) as bet_count,
-                SUM(amount) as total_amount,
-                COUNT(DISTINCT user_id) as unique_players
-            FROM lottery_bets_high_perf 
-            WHERE timestamp > datetime('now', '-5 minutes')
-            GROUP BY team
-        ''')
+        user_id = fields['user_id']
+        device_id = fields['device_id']
+        ip_address = request.remote_addr
 
-        eagle_stats = next((s for s in stats if s['team'] == 'eagle'), {
-            'bet_count': 0,
-            'total_amount': 0,
-            'unique_players': 0
-        })
-        tails_stats = next((s for s in stats if s['team'] == 'tails'), {
-            'bet_count': 0,
-            'total_amount': 0,
-            'unique_players': 0
-        })
+        # БЛОКИРОВКА МУЛЬТИСЕССИИ: хранилище - только при продлении аренды
+        lease = None
+        if not session_leases.is_fresh(user_id, device_id, fields['lease']):
+            allowed, message = session_manager.register_session(
+                user_id=user_id,
+                device_id=device_id,
+                ip_address=ip_address,
+                user_agent=request.headers.get('User-Agent', '')[:100],
+                telegram_id=fields['telegram_id'])
+            if not allowed:
+                return _multisession_blocked(message)
+            lease = session_leases.issue(user_id, device_id)
 
-        return {
-            'success': True,
-            'lottery': {
-                'eagle': {
-                    'bets': int(eagle_stats['bet_count']),
-                    'total': float(eagle_stats['total_amount']),
-                    'players': int(eagle_stats['unique_players'])
-                },
-                'tails': {
-                    'bets': int(tails_stats['bet_count']),
-                    'total': float(tails_stats['total_amount']),
-                    'players': int(tails_stats['unique_players'])
-                },
-                'timer':
-                lottery_timer,
-                'total_pot':
-                float(eagle_stats['total_amount'] +
-                      tails_stats['total_amount']),
-                'participants_count':
-                int(eagle_stats['unique_players'] +
-                    tails_stats['unique_players']),
-                'next_round':
-                int(time.time()) + lottery_timer
-            }
+        try:
+            if PERFORMANCE_CONFIG['WRITE_BEHIND_ENABLED']:
+                outcome, player, server_fields = write_behind.apply_delta(
+                    user_id, fields['base_version'], fields['changes'],
+                    device_id, ip_address, fields['upgrades'])
+            else:
+                outcome, player, server_fields = db.write(
+                    partial(_apply_sync_delta,
+                            user_id=user_id,
+                            base_version=fields['base_version'],
+                            changes=fields['changes'],
+                            upgrades=fields['upgrades'],
+                            device_id=device_id,
+                            ip_address=ip_address), 'players_high_perf')
+        except DeadlineExceeded:
+            raise  # Ответ по бюджету формирует time_limit
+        except Exception as db_error:
+            logger.error(f"❌ Ошибка БД при дельта-синхронизации: {db_error}")
+            return {'success': False, 'error': 'DATABASE_ERROR'}, 500
+
+        if outcome is None:
+            # Игрока еще нет - клиент присылает полное состояние
+            return {'success': False, 'error': 'FULL_SYNC_REQUIRED'}, 404
+
+        if outcome == 'applied':
+            leaderboard_index.update_player(player)
+
+        response = {
+            'success': outcome != 'conflict',
+            'version': player['version']
         }
+        if outcome == 'conflict':
+            response['error'] = 'VERSION_CONFLICT'
+        else:
+            response['applied'] = outcome == 'applied'
+        if server_fields:
+            response['fields'] = _sync_fields_json(server_fields)
+        if lease is not None:
+            response['sessionLease'] = lease
+        return (response, 409) if outcome == 'conflict' else response
+
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка дельта-синхронизации: {e}")
+        return {'success': False, 'error': 'SYNC_ERROR'}, 500
+
+
+def _team_lottery_state() -> Dict:
+    """Состояние командной лотереи без таймера (общая часть статуса и потока)"""
+    # Статистика за 5 минут из скользящего окна в памяти - O(1)
+    stats = lottery_window.snapshot()
+    eagle_stats = stats['eagle']
+    tails_stats = stats['tails']
+    round_seconds = PERFORMANCE_CONFIG['LOTTERY_ROUND_SEC']
+
+    return {
+        'eagle': {
+            'bets': int(eagle_stats['bet_count']),
+            'total': from_nano(eagle_stats['total_amount']),
+            'players': int(eagle_stats['unique_players'])
+        },
+        'tails': {
+            'bets': int(tails_stats['bet_count']),
+            'total': from_nano(tails_stats['total_amount']),
+            'players': int(tails_stats['unique_players'])
+        },
+        'total_pot':
+        from_nano(eagle_stats['total_amount'] + tails_stats['total_amount']),
+        'participants_count':
+        int(eagle_stats['unique_players'] + tails_stats['unique_players']),
+        'next_round':
+        (int(time.time()) // round_seconds + 1) * round_seconds,
+        'last_winner':
+        lottery_engine.last_result
+    }
+
+
+@app.route('/api/lottery/status', methods=['GET', 'OPTIONS'])
+@perf_utils.time_limit(50)
+@perf_utils.cache_response(ttl_seconds=1,
+                           stale_seconds=1,
+                           query_params=(),
+                           schema=LOTTERY_STATUS_SCHEMA)
+def lottery_status():
+    """Быстрый статус лотереи"""
+    # Используем синхронизированный таймер
+    lottery_timer = 60 - (int(time.time()) % 60)
+
+    try:
+        lottery = _team_lottery_state()
+        lottery['timer'] = lottery_timer
+        return {'success': True, 'lottery': lottery}
     except Exception as e:
         logger.error(f"❌ Ошибка статуса лотереи: {e}")
         return {
@@ -779,55 +5845,128 @@ def lottery_status():
         }
 
 
+def _parse_last_event_id(value: Optional[str]) -> int:
+    """Last-Event-ID из заголовка или параметра; мусор - с начала"""
+    try:
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+
+@app.route('/api/stream/lottery', methods=['GET'])
+def lottery_stream():
+    """Поток SSE: состояние обеих лотерей при каждом изменении"""
+    stream = stream_hub.subscribe(
+        _parse_last_event_id(
+            request.headers.get('Last-Event-ID')
+            or request.args.get('lastEventId')))
+    if stream is None:
+        response = jsonify({'success': False, 'error': 'TOO_MANY_STREAMS'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+
+    return Response(stream,
+                    mimetype='text/event-stream',
+                    headers={
+                        'Cache-Control': 'no-cache',
+                        'X-Accel-Buffering': 'no'
+                    })
+
+
+# Таймер клиент считает сам по next_round/ends_at - кадры меняются только
+# при новых ставках и розыгрышах
+stream_hub.add_source('lottery', _team_lottery_state)
+stream_hub.add_source(
+    'classic', lambda: {
+        key: value
+        for key, value in classic_lottery.status().items() if key != 'timer'
+    })
+
+
+@app.route('/api/lottery/bet', methods=['POST', 'OPTIONS'])
+@perf_utils.time_limit(50)
+def lottery_bet():
+    """Прием ставки командной лотереи - без обращения к БД на горячем пути"""
+    try:
+        data = request.get_json()
+
+        valid, error = perf_utils.validate_request_data(
+            data, ['userId', 'amount', 'team'])
+        if not valid:
+            return {'success': False, 'error': error}, 400
+
+        amount = to_nano(data['amount'])
+        if amount <= 0:
+            return {'success': False, 'error': 'Некорректная сумма ставки'}, 400
+
+        accepted, message, result = lottery_engine.place_bet(
+            data['userId'], data['team'], amount)
+        if not accepted:
+            return {'success': False, 'error': message}, 400
+
+        result['newBalance'] = from_nano(result['newBalance'])
+        return {'success': True, 'message': message, **result}
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка ставки лотереи: {e}")
+        return {'success': False, 'error': 'BET_ERROR'}, 500
+
+
+@app.route('/api/classic-lottery/status', methods=['GET', 'OPTIONS'])
+@perf_utils.time_limit(50)
+@perf_utils.cache_response(ttl_seconds=1, stale_seconds=1, query_params=())
+def classic_lottery_status():
+    """Статус классической лотереи из состояния раунда в памяти"""
+    return {'success': True, 'lottery': classic_lottery.status()}
+
+
+@app.route('/api/classic-lottery/bet', methods=['POST', 'OPTIONS'])
+@perf_utils.time_limit(50)
+def classic_lottery_bet():
+    """Ставка в классической лотерее"""
+    try:
+        data = request.get_json()
+
+        valid, error = perf_utils.validate_request_data(
+            data, ['userId', 'amount'])
+        if not valid:
+            return {'success': False, 'error': error}, 400
+
+        amount = to_nano(data['amount'])
+        if amount <= 0:
+            return {'success': False, 'error': 'Некорректная сумма ставки'}, 400
+
+        accepted, message, result = classic_lottery.place_bet(
+            data['userId'], amount)
+        if not accepted:
+            return {'success': False, 'error': message}, 400
+
+        result['newBalance'] = from_nano(result['newBalance'])
+        result['totalPot'] = from_nano(result['totalPot'])
+        return {'success': True, 'message': message, **result}
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка ставки классической лотереи: {e}")
+        return {'success': False, 'error': 'BET_ERROR'}, 500
+
+
 @app.route('/api/leaderboard', methods=['GET', 'OPTIONS'])
 @perf_utils.time_limit(80)
-@perf_utils.cache_response(ttl_seconds=3)
+@perf_utils.cache_response(ttl_seconds=3,
+                           stale_seconds=10,
+                           query_params=('type', 'limit'),
+                           schema=LEADERBOARD_SCHEMA)
 def leaderboard():
     """Быстрый рейтинг игроков"""
     leaderboard_type = request.args.get('type', 'balance')
     limit = int(request.args.get('limit', 20))
 
-    if leaderboard_type == 'balance':
-        query = '''
-            SELECT user_id, username, balance, total_earned, total_clicks,
-                   click_speed, mine_speed, total_speed, level
-            FROM players_high_perf 
-            ORDER BY balance DESC 
-            LIMIT ?
-        '''
-    elif leaderboard_type == 'speed':
-        query = '''
-            SELECT user_id, username, balance, total_earned, total_clicks,
-                   click_speed, mine_speed, total_speed, level
-            FROM players_high_perf 
-            ORDER BY total_speed DESC 
-            LIMIT ?
-        '''
-    else:
-        query = '''
-            SELECT user_id, username, balance, total_earned, total_clicks,
-                   click_speed, mine_speed, total_speed, level
-            FROM players_high_perf 
-            ORDER BY total_earned DESC 
-            LIMIT ?
-        '''
-
-    players = db.execute_fast(query, (limit, ))
-
-    leaderboard_data = []
-    for rank, player in enumerate(players, 1):
-        leaderboard_data.append({
-            'rank': rank,
-            'userId': player['user_id'],
-            'username': player['username'],
-            'balance': float(player['balance']),
-            'totalEarned': float(player['total_earned']),
-            'totalClicks': int(player['total_clicks']),
-            'clickSpeed': float(player['click_speed']),
-            'mineSpeed': float(player['mine_speed']),
-            'totalSpeed': float(player['total_speed']),
-            'level': int(player['level'])
-        })
+    # Топ-K из индекса в памяти вместо ORDER BY ... LIMIT по таблице
+    leaderboard_data = [
+        _leaderboard_entry(rank, player)
+        for rank, player in leaderboard_index.top(leaderboard_type, limit)
+    ]
 
     return {
         'success': True,
@@ -837,6 +5976,60 @@ def leaderboard():
     }
 
 
+@app.route('/api/leaderboard/rank/<user_id>', methods=['GET', 'OPTIONS'])
+@perf_utils.time_limit(30)
+def leaderboard_rank(user_id):
+    """Место игрока в рейтинге и его соседи"""
+    leaderboard_type = request.args.get('type', 'balance')
+    neighbors = min(int(request.args.get('neighbors', 2)), 50)
+
+    result = leaderboard_index.rank(leaderboard_type, user_id, neighbors)
+    if result is None:
+        return {'success': False, 'error': 'Игрок не найден'}, 404
+
+    rank, total, around = result
+    return {
+        'success': True,
+        'userId': user_id,
+        'type': leaderboard_type,
+        'rank': rank,
+        'total': total,
+        'neighbors': [_leaderboard_entry(r, player) for r, player in around],
+        'updated': datetime.utcnow().isoformat() + 'Z'
+    }
+
+
+def _leaderboard_entry(rank: int, player: Dict) -> Dict:
+    """Строка рейтинга для ответа API (с майнингом на сейчас)"""
+    player = accrue(dict(player), now_ms())
+    return {
+        'rank': rank,
+        'userId': player['user_id'],
+        'username': player['username'],
+        'balance': from_nano(player['balance']),
+        'totalEarned': from_nano(player['total_earned']),
+        'totalClicks': int(player['total_clicks']),
+        'clickSpeed': from_nano(player['click_speed']),
+        'mineSpeed': from_nano(player['mine_speed']),
+        'totalSpeed': from_nano(player['total_speed']),
+        'level': int(player['level'])
+    }
+
+
+@app.route('/api/schema', methods=['GET', 'OPTIONS'])
+@perf_utils.cache_response(ttl_seconds=3600, query_params=())
+def wire_schema():
+    """Форматы ответов и позиционные схемы для компактных клиентов"""
+    return {
+        'success': True,
+        'formats': list(WIRE_FORMATS),
+        'schemas': {
+            name: schema.describe()
+            for name, schema in WIRE_SCHEMAS.items()
+        }
+    }
+
+
 @app.route('/api/transfer', methods=['POST', 'OPTIONS'])
 @perf_utils.time_limit(100)
 def transfer():
@@ -852,7 +6045,7 @@ def transfer():
 
         from_user_id = data['fromUserId']
         to_user_id = data['toUserId']
-        amount = float(data['amount'])
+        amount = to_nano(data['amount'])
         from_username = data['fromUsername']
         to_username = data.get('toUsername', 'Получатель')
 
@@ -862,84 +6055,66 @@ def transfer():
         if from_user_id == to_user_id:
             return {'success': False, 'error': 'Нельзя переводить себе'}, 400
 
-        # БЫСТРАЯ ПРОВЕРКА И ПЕРЕВОД В ТРАНЗАКЦИИ
-        try:
-            # Используем транзакцию для атомарности
-            conn = db._get_connection()
-            cursor = conn.cursor()
-
-            # Проверяем баланс отправителя
-            cursor.execute(
-                "SELECT balance FROM players_high_perf WHERE user_id = ?",
-                (from_user_id, ))
-            sender = cursor.fetchone()
-
-            if not sender:
-                return {
-                    'success': False,
-                    'error': 'Отправитель не найден'
-                }, 404
-
-            if sender['balance'] < amount:
-                return {'success': False, 'error': 'Недостаточно средств'}, 400
-
-            # Проверяем получателя
-            cursor.execute(
-                "SELECT user_id FROM players_high_perf WHERE user_id = ?",
-                (to_user_id, ))
-            receiver = cursor.fetchone()
-
-            if not receiver:
-                # Создаем получателя если не существует
-                cursor.execute(
-                    '''
-                    INSERT INTO players_high_perf (user_id, username, balance)
-                    VALUES (?, ?, ?)
-                    ''', (to_user_id, to_username, amount))
-            else:
-                # Обновляем баланс получателя
-                cursor.execute(
-                    "UPDATE players_high_perf SET balance = balance + ? WHERE user_id = ?",
-                    (amount, to_user_id))
-
-            # Обновляем баланс отправителя
-            cursor.execute(
-                "UPDATE players_high_perf SET balance = balance - ? WHERE user_id = ?",
-                (amount, from_user_id))
-
-            # Записываем перевод
-            cursor.execute(
-                '''
-                INSERT INTO transfers_high_perf (from_user_id, to_user_id, amount)
-                VALUES (?, ?, ?)
-                ''', (from_user_id, to_user_id, amount))
-
-            conn.commit()
-
-            # Получаем новый баланс отправителя
-            cursor.execute(
-                "SELECT balance FROM players_high_perf WHERE user_id = ?",
-                (from_user_id, ))
-            new_balance = cursor.fetchone()['balance']
+        # Повтор запроса с тем же ключом вернет исходный перевод
+        idempotency_key = (request.headers.get('Idempotency-Key')
+                           or data.get('idempotencyKey'))
+        if idempotency_key is not None and not 0 < len(
+                str(idempotency_key)) <= 128:
+            return {
+                'success': False,
+                'error': 'Неверный ключ идемпотентности'
+            }, 400
 
+        future = transfer_engine.submit(
+            from_user_id, to_user_id, amount, to_username,
+            str(idempotency_key) if idempotency_key is not None else None)
+        try:
+            result = future.result(
+                timeout=PERFORMANCE_CONFIG['DB_WRITE_TIMEOUT_SEC'])
+        except FutureTimeoutError:
+            # Перевод остается в очереди и еще может примениться: клиент
+            # повторяет запрос с тем же ключом и получает итог
+            logger.warning(f"⏳ Перевод {from_user_id} еще не применен")
+            return {'success': False, 'error': 'TRANSFER_PENDING'}, 504
+
+        if not result['ok']:
             return {
-                'success': True,
-                'message': 'Перевод выполнен',
-                'newBalance': float(new_balance),
-                'transactionId': cursor.lastrowid,
-                'timestamp': datetime.utcnow().isoformat() + 'Z'
-            }
+                'success': False,
+                'error': result['error']
+            }, result['status']
 
-        except Exception as db_error:
-            conn.rollback()
-            logger.error(f"❌ Ошибка БД при переводе: {db_error}")
-            return {'success': False, 'error': 'TRANSFER_ERROR'}, 500
+        return {
+            'success': True,
+            'message': 'Перевод выполнен',
+            'newBalance': from_nano(result['newBalance']),
+            'transactionId': result['transactionId'],
+            'replayed': result['replayed'],
+            'timestamp': datetime.utcnow().isoformat() + 'Z'
+        }
 
     except Exception as e:
         logger.error(f"❌ Ошибка перевода: {e}")
         return {'success': False, 'error': 'Ошибка перевода'}, 500
 
 
+def _session_check_response(valid: bool, message: str,
+                            lease: Optional[str]) -> Dict:
+    if valid:
+        return {
+            'success': True,
+            'valid': True,
+            'message': message,
+            'multisession': False,
+            'lease': lease
+        }
+    return {
+        'success': False,
+        'valid': False,
+        'message': message,
+        'multisession': True if 'активная' in message.lower() else False
+    }
+
+
 @app.route('/api/session/check', methods=['POST', 'OPTIONS'])
 @perf_utils.time_limit(30)
 def check_session():
@@ -953,83 +6128,597 @@ def check_session():
         if not user_id or not device_id:
             return {'success': False, 'error': 'Missing parameters'}, 400
 
-        # Проверяем сессию
-        valid, message = session_manager.check_session(user_id, device_id)
-
-        if valid:
-            # Обновляем активность
-            session_manager.update_activity(user_id, device_id)
-
-            return {
-                'success': True,
-                'valid': True,
-                'message': message,
-                'multisession': False
-            }
-        else:
-            return {
-                'success': False,
-                'valid': False,
-                'message': message,
-                'multisession':
-                True if 'активная' in message.lower() else False
-            }
+        # Проверяем аренду (без блокировок) или сессию в хранилище
+        return _session_check_response(*session_leases.heartbeat(
+            user_id, device_id, data.get('lease')))
 
     except Exception as e:
         logger.error(f"❌ Ошибка проверки сессии: {e}")
         return {'success': False, 'error': 'SESSION_CHECK_ERROR'}, 500
 
 
+@app.route('/api/session/release', methods=['POST', 'OPTIONS'])
+@perf_utils.time_limit(30)
+def release_session():
+    """Освобождение сессии при закрытии клиента (только по своей аренде)"""
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+
+        user_id = data.get('userId')
+        device_id = data.get('deviceId')
+
+        if not user_id or not device_id:
+            return {'success': False, 'error': 'Missing parameters'}, 400
+
+        if session_leases.verify(user_id, device_id,
+                                 data.get('lease')) is None:
+            return {'success': False, 'error': 'INVALID_LEASE'}, 403
+
+        released = session_manager.release_session(user_id, device_id)
+        return {'success': True, 'released': released}
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка освобождения сессии: {e}")
+        return {'success': False, 'error': 'SESSION_RELEASE_ERROR'}, 500
+
+
+# Последняя сводка по БД для ответа админки по исчерпанному бюджету
+last_database_stats: Dict = {}
+
+
 @app.route('/api/admin/performance', methods=['GET'])
 @perf_utils.time_limit(50)
 def performance_stats():
     """Статистика производительности"""
     session_stats = session_manager.get_session_stats()
 
-    # Статистика кэша
+    # Статистика кэша: доля попаданий по настоящим счетчикам обоих кэшей
+    response_stats = response_cache.get_stats()
+    query_stats = query_cache.get_stats()
+    served = (response_stats['hits'] + response_stats['stale_hits'] +
+              response_stats['coalesced'] + query_stats['hits'])
+    lookups = served + response_stats['misses'] + query_stats['misses']
     cache_stats = {
-        'response_cache_size':
-        len(response_cache),
-        'query_cache_size':
-        len(query_cache),
-        'cache_hit_ratio':
-        len(response_cache) / max(1,
-                                  len(response_cache) + len(query_cache))
+        'response_cache_size': len(response_cache),
+        'query_cache_size': len(query_cache),
+        'cache_hit_ratio': served / lookups if lookups else 0.0
     }
 
-    # Статистика БД
-    db_stats = db.execute_fast('''
-        SELECT 
-            COUNT(*) as total_players,
-            SUM(balance) as total_balance,
-            AVG(total_speed) as avg_speed,
-            MAX(balance) as max_balance
-        FROM players_high_perf
-    ''')[0]
+    # Статистика БД: агрегат по всей таблице; не уложился в бюджет -
+    # последняя удавшаяся сводка с пометкой degraded
+    try:
+        db_stats = db.execute_fast('''
+            SELECT 
+                COUNT(*) as total_players,
+                SUM(balance) as total_balance,
+                AVG(total_speed) as avg_speed,
+                MAX(balance) as max_balance
+            FROM players_high_perf
+        ''')[0]
+    except DeadlineExceeded:
+        database_stats = {**last_database_stats, 'degraded': True}
+    else:
+        database_stats = {
+            'total_players': int(db_stats['total_players']),
+            'total_balance': from_nano(db_stats['total_balance']),
+            'average_speed': from_nano(db_stats['avg_speed']),
+            'max_balance': from_nano(db_stats['max_balance'])
+        }
+        last_database_stats.update(database_stats)
 
     return {
         'success': True,
         'performance': {
             'config': PERFORMANCE_CONFIG,
             'sessions': session_stats,
+            'session_leases': session_leases.get_stats(),
             'cache': cache_stats,
-            'database': {
-                'total_players': int(db_stats['total_players']),
-                'total_balance': float(db_stats['total_balance'] or 0),
-                'average_speed': float(db_stats['avg_speed'] or 0),
-                'max_balance': float(db_stats['max_balance'] or 0)
-            },
+            'response_cache': response_stats,
+            'query_cache': query_stats,
+            'write_behind': write_behind.get_stats(),
+            'lottery': lottery_engine.get_stats(),
+            'classic_lottery': classic_lottery.get_stats(),
+            'stream': stream_hub.get_stats(),
+            'transfers': transfer_engine.get_stats(),
+            'admission': admission.get_stats(),
+            'slow_queries': slow_queries.get_stats(),
+            'database_pool': db.get_pool_stats(),
+            'database': database_stats,
             'server_time': datetime.utcnow().isoformat() + 'Z',
-            'uptime_seconds': int(time.time() - start_time)
+            'uptime_seconds': int(time.time() - metrics.started_at)
         }
     }
 
 
+def _runtime_metric_families() -> List[Tuple]:
+    """Счетчики кэшей и датчики сессий, пулов и допуска для /api/admin/metrics"""
+    response_stats = response_cache.get_stats()
+    query_stats = query_cache.get_stats()
+    readers = db.readers.get_stats()
+    writer = db.writer.get_stats()
+    admission_stats = admission.get_stats()
+    slow_stats = slow_queries.get_stats()
+    return [
+        ('sparkcoin_cache_requests_total', 'counter',
+         'Обращения к кэшам по результату', [
+             ({'cache': 'response', 'result': result}, response_stats[result])
+             for result in ('hits', 'stale_hits', 'coalesced', 'misses')
+         ] + [({'cache': 'query', 'result': result}, query_stats[result])
+              for result in ('hits', 'misses')]),
+        ('sparkcoin_cache_entries', 'gauge', 'Записей в кэшах',
+         [({'cache': 'response'}, response_stats['entries']),
+          ({'cache': 'query'}, query_stats['entries'])]),
+        ('sparkcoin_sessions', 'gauge', 'Сессии игроков',
+         [({'state': 'active'},
+           session_manager.get_session_stats()['active_sessions'])]),
+        ('sparkcoin_db_reader_pool_connections', 'gauge',
+         'Соединения пула читателей',
+         [({'state': 'in_use'}, readers['in_use']),
+          ({'state': 'idle'}, readers['idle']),
+          ({'state': 'waiting'}, readers['waiting'])]),
+        ('sparkcoin_db_reader_pool_waits_total', 'counter',
+         'Ожидания свободного читателя',
+         [({'result': 'waited'}, readers['waits']),
+          ({'result': 'timeout'}, readers['timeouts'])]),
+        ('sparkcoin_db_reader_pool_wait_seconds_total', 'counter',
+         'Суммарное ожидание читателя',
+         [({}, readers['total_wait_ms'] / 1000)]),
+        ('sparkcoin_db_writer_queue_depth', 'gauge',
+         'Заданий в очереди писателя', [({}, writer['queue_depth'])]),
+        ('sparkcoin_db_writer_wait_seconds_total', 'counter',
+         'Суммарное ожидание заданий писателя в очереди',
+         [({}, writer['total_wait_ms'] / 1000)]),
+        ('sparkcoin_admission_limit', 'gauge',
+         'Адаптивный лимит одновременных запросов',
+         [({}, admission_stats['limiter']['limit'])]),
+        ('sparkcoin_slow_queries_total', 'counter',
+         'Запросы SQL в журнале медленных запросов',
+         [({'kind': kind}, slow_stats[kind])
+          for kind in ('slow', 'sampled')]),
+        ('sparkcoin_admission_rejected_total', 'counter',
+         'Отказы контроля допуска', [
+             ({'class': route_class, 'reason': reason}, stats[reason])
+             for route_class, stats in admission_stats['classes'].items()
+             for reason in ('rate_limited', 'shed')
+         ]),
+    ]
+
+
+@app.route('/api/admin/slow-queries', methods=['GET'])
+def slow_query_log():
+    """Журнал медленных запросов: отпечатки с планами и последние записи"""
+    try:
+        limit = min(int(request.args.get('limit', 100)),
+                    PERFORMANCE_CONFIG['SLOW_QUERY_LOG_SIZE'])
+    except ValueError:
+        return {'success': False, 'error': 'Неверный limit'}, 400
+
+    report = slow_queries.report(limit)
+    return {
+        'success': True,
+        'stats': slow_queries.get_stats(),
+        'fullScans': [
+            item['fingerprint'] for item in report['fingerprints']
+            if item['fullScans']
+        ],
+        **report
+    }
+
+
+@app.route('/api/admin/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus: p50/p90/p99/p999 и счетчики"""
+    return Response(metrics.render(_runtime_metric_families()),
+                    mimetype='text/plain; version=0.0.4')
+
+
+# ============================================================================
+# ASGI-РЕЖИМ: ДЛИННЫЕ СОЕДИНЕНИЯ НА ASYNCIO, ОСТАЛЬНОЕ - FLASK В ПУЛЕ ПОТОКОВ
+# ============================================================================
+class AsgiRequest:
+    """Минимальный HTTP-запрос ASGI для нативных асинхронных маршрутов"""
+
+    __slots__ = ('method', 'path', 'query', 'headers', 'body', 'remote_addr')
+
+    def __init__(self, scope: Dict, body: bytes):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        self.headers = {
+            name.decode('latin-1').lower(): value.decode('latin-1')
+            for name, value in scope.get('headers', [])
+        }
+        self.body = body
+        client = scope.get('client')
+        self.remote_addr = client[0] if client else None
+
+    def get_json(self) -> Dict:
+        try:
+            data = json.loads(self.body or b'{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def arg(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        values = self.query.get(name)
+        return values[0] if values else default
+
+
+class AsgiStream:
+    """Потоковый ответ нативного маршрута (SSE)"""
+
+    __slots__ = ('chunks', 'mimetype')
+
+    def __init__(self, chunks, mimetype: str = 'text/event-stream'):
+        self.chunks = chunks
+        self.mimetype = mimetype
+
+
+class AsyncServingApp:
+    """ASGI-приложение для тех же маршрутов.
+
+    Heartbeat сессий, синхронизация и поток SSE обслуживаются нативно на
+    asyncio - простаивающее соединение не держит поток. Остальные маршруты
+    Flask выполняются в ограниченном пуле потоков через мост WSGI.
+    Запуск: uvicorn bot:asgi_app (или любой другой ASGI-сервер).
+    """
+
+    def __init__(self, wsgi_app, max_threads: int):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_threads,
+                                           thread_name_prefix='asgi-wsgi')
+        self.routes: Dict[Tuple[str, str], Callable] = {}
+        self.schemas: Dict[str, PositionalSchema] = {}
+        self.stats = {'native_requests': 0, 'wsgi_requests': 0,
+                      'open_streams': 0}
+
+    def route(self,
+              path: str,
+              methods: List[str],
+              schema: Optional[PositionalSchema] = None):
+        """Регистрация нативного асинхронного маршрута"""
+
+        def decorator(handler):
+            for method in methods:
+                self.routes[(method, path)] = handler
+            if schema is not None:
+                self.schemas[path] = schema
+            return handler
+
+        return decorator
+
+    async def __call__(self, scope: Dict, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        if forked_worker:
+            payload = b'{"success":false,"error":"SINGLE_PROCESS_ONLY"}'
+            await self._send_response(send, 503, {
+                'Content-Type': 'application/json',
+                'Content-Length': str(len(payload))
+            }, payload)
+            return
+
+        body = await self._read_body(receive)
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            self.stats['wsgi_requests'] += 1
+            await self._call_wsgi(scope, body, send)
+            return
+
+        self.stats['native_requests'] += 1
+        start_time = time.perf_counter()
+        request_data = AsgiRequest(scope, body)
+        headers = _cors_headers(request_data.headers.get('origin', ''))
+
+        # Контроль допуска (маршруты моста WSGI проходят его в хуках Flask)
+        route_class = (admission.classify(scope['path'])
+                       if PERFORMANCE_CONFIG['ADMISSION_ENABLED'] else None)
+        if route_class is not None:
+            admitted, status, retry_after = admission.admit(
+                route_class, request_data.remote_addr,
+                _admission_user_id(request_data.get_json(),
+                                   {'X-User-ID': request_data.headers.get(
+                                       'x-user-id')}, None))
+            if not admitted:
+                data, status, denied_headers = admission.denied_response(
+                    status, retry_after)
+                wire_format = negotiate_wire_format(
+                    request_data.headers.get('accept'))
+                payload = wire_format.serialize(data, None)
+                headers.update(denied_headers)
+                headers.update({'Content-Type': wire_format.media_type,
+                                'Content-Length': str(len(payload))})
+                await self._send_response(send, status, headers, payload)
+                if PERFORMANCE_CONFIG['METRICS_ENABLED']:
+                    metrics.observe_request(scope['method'], scope['path'],
+                                            status,
+                                            time.perf_counter() - start_time)
+                return
+
+        try:
+            result = await handler(request_data)
+        except Exception as e:
+            logger.error(f"❌ Ошибка асинхронного маршрута {scope['path']}: {e}")
+            result = {'success': False, 'error': 'INTERNAL_ERROR'}, 500
+        finally:
+            if route_class is not None:
+                admission.release(route_class,
+                                  time.perf_counter() - start_time)
+
+        if isinstance(result, AsgiStream):
+            await self._send_stream(result, headers, receive, send)
+            return
+
+        data, status = result if isinstance(result, tuple) else (result, 200)
+        wire_format = negotiate_wire_format(request_data.headers.get('accept'))
+        payload = wire_format.serialize(
+            data, self.schemas.get(scope['path']) if status == 200 else None)
+        elapsed = time.perf_counter() - start_time
+        headers.update({
+            'Content-Type': wire_format.media_type,
+            'Vary': 'Accept',
+            'Content-Length': str(len(payload)),
+            'X-Response-Time': f'{elapsed*1000:.1f}ms',
+            'X-Server-Performance': 'high-speed'
+        })
+        if status == 503:
+            headers['Retry-After'] = '30'
+        await self._send_response(send, status, headers, payload)
+        if PERFORMANCE_CONFIG['METRICS_ENABLED']:
+            metrics.observe_request(scope['method'], scope['path'], status,
+                                    elapsed)
+
+        if elapsed * 1000 > PERFORMANCE_CONFIG['MAX_RESPONSE_TIME_MS']:
+            logger.warning(
+                f"⚠️ Медленный ответ: {elapsed*1000:.1f}ms - {scope['path']}")
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] != 'http.request':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    @staticmethod
+    async def _send_response(send, status: int, headers: Dict[str, str],
+                             payload: bytes):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def _send_stream(self, stream: AsgiStream, headers: Dict[str, str],
+                           receive, send):
+        headers.update({
+            'Content-Type': stream.mimetype,
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers.items()]
+        })
+
+        async def wait_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        disconnected = asyncio.ensure_future(wait_disconnect())
+        chunks = stream.chunks.__aiter__()
+        self.stats['open_streams'] += 1
+        try:
+            while True:
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait({next_chunk, disconnected},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not next_chunk.done():
+                    # Клиент отключился: прерываем ожидание внутри генератора
+                    next_chunk.cancel()
+                    await asyncio.wait({next_chunk})
+                    break
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True
+                })
+        except OSError:
+            pass  # Клиент ушел во время отправки
+        finally:
+            self.stats['open_streams'] -= 1
+            disconnected.cancel()
+            await stream.chunks.aclose()
+
+    async def _call_wsgi(self, scope: Dict, body: bytes, send):
+        loop = asyncio.get_running_loop()
+        status, headers, payload = await loop.run_in_executor(
+            self.executor, self._run_wsgi, scope, body)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers]
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    def _run_wsgi(self, scope: Dict, body: bytes) -> Tuple[int, List, bytes]:
+        """Вызов Flask в потоке пула с окружением WSGI из scope"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in scope.get('headers', []):
+            key = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if key == 'CONTENT_LENGTH':
+                continue
+            if key != 'CONTENT_TYPE':
+                key = 'HTTP_' + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = response_headers
+            return lambda data: None
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            payload = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], payload
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+# ИНИЦИАЛИЗАЦИЯ ASGI-ПРИЛОЖЕНИЯ
+asgi_app = AsyncServingApp(app, PERFORMANCE_CONFIG['ASGI_WSGI_THREADS'])
+
+
+async def _session_store_call(func: Callable, *args):
+    """Вызов хранилища сессий из цикла событий: SQLite - в пуле потоков"""
+    if isinstance(session_manager, SQLiteSessionManager):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, func, *args)
+    return func(*args)
+
+
+@asgi_app.route('/api/session/check', methods=['POST'])
+async def asgi_check_session(request_data: AsgiRequest):
+    """Heartbeat сессии без блокировки цикла событий"""
+    data = request_data.get_json()
+    user_id = data.get('userId')
+    device_id = data.get('deviceId')
+
+    if not user_id or not device_id:
+        return {'success': False, 'error': 'Missing parameters'}, 400
+
+    return _session_check_response(*await session_leases.heartbeat_async(
+        user_id, device_id, data.get('lease')))
+
+
+@asgi_app.route('/api/sync/unified',
+                methods=['POST'],
+                schema=SYNC_RESPONSE_SCHEMA)
+async def asgi_sync_unified(request_data: AsgiRequest):
+    """Синхронизация: состояние из памяти, первая запись - через aiosqlite"""
+    fields, error = _parse_sync_request(request_data.get_json())
+    if error:
+        return {'success': False, 'error': error}, 400
+
+    user_id = fields['user_id']
+    device_id = fields['device_id']
+    ip_address = request_data.remote_addr
+    user_agent = request_data.headers.get('user-agent', '')[:100]
+
+    allowed, message = await _session_store_call(
+        session_manager.register_session, user_id, device_id, ip_address,
+        user_agent, fields['telegram_id'])
+    if not allowed:
+        return _multisession_blocked(message)
+
+    try:
+        loop = asyncio.get_running_loop()
+        if not PERFORMANCE_CONFIG['WRITE_BEHIND_ENABLED']:
+            job = partial(_sync_player_row,
+                          fields=fields,
+                          ip_address=ip_address)
+            if PERFORMANCE_CONFIG['USE_ASYNC_DB']:
+                player = await async_db.write(job, 'players_high_perf')
+            else:
+                player = await loop.run_in_executor(
+                    None, db.write, job, 'players_high_perf')
+            leaderboard_index.update_player(player)
+        elif write_behind.get_player(user_id) is not None:
+            # Состояние в памяти - сверка без обращения к БД
+            player = _submit_synced_player(fields, ip_address)
+        else:
+            player = await loop.run_in_executor(None, _submit_synced_player,
+                                                fields, ip_address)
+            if player is None:
+                upsert_args = _upsert_args(fields, ip_address)
+                if PERFORMANCE_CONFIG['USE_ASYNC_DB']:
+                    player = await async_db.upsert_player(*upsert_args)
+                else:
+                    player = await loop.run_in_executor(
+                        None, db.upsert_player, *upsert_args)
+                _remember_synced_player(player, device_id, ip_address)
+
+        response = _build_sync_response(player)
+        response['sessionLease'] = await _session_store_call(
+            session_leases.issue, user_id, device_id)
+        return response
+
+    except Exception as db_error:
+        logger.error(f"❌ Ошибка БД при синхронизации: {db_error}")
+        return {'success': False, 'error': 'DATABASE_ERROR'}, 500
+
+
+@asgi_app.route('/api/stream/lottery', methods=['GET'])
+async def asgi_lottery_stream(request_data: AsgiRequest):
+    """Поток SSE: подписчик - корутина, а не поток"""
+    stream = stream_hub.subscribe_async(
+        _parse_last_event_id(
+            request_data.headers.get('last-event-id')
+            or request_data.arg('lastEventId')))
+    if stream is None:
+        return {'success': False, 'error': 'TOO_MANY_STREAMS'}, 503
+    return AsgiStream(stream)
+
+
 # ============================================================================
 # ЗАПУСК СЕРВЕРА
 # ============================================================================
 if __name__ == "__main__":
-    start_time = time.time()
+    try:
+        process_lock = acquire_process_lock(DATABASE_PATH)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
 
     print("🚀 ЗАПУСК ВЫСОКОПРОИЗВОДИТЕЛЬНОГО API СЕРВЕРА...")
     print(f"⚙️ Конфигурация производительности:")
@@ -1043,22 +6732,50 @@ if __name__ == "__main__":
         f"   • Кэширование: {'ВКЛ' if PERFORMANCE_CONFIG['ENABLE_QUERY_CACHE'] else 'ВЫКЛ'}"
     )
     print(f"   • Максимум сессий: {PERFORMANCE_CONFIG['MAX_CONCURRENT_DB']}")
+    print(
+        f"   • Отложенная запись: {'ВКЛ' if PERFORMANCE_CONFIG['WRITE_BEHIND_ENABLED'] else 'ВЫКЛ'} (задержка <{PERFORMANCE_CONFIG['WRITE_BEHIND_FLUSH_MS']}ms)"
+    )
     print()
     print("🛡️  Защита от мультисессии: АКТИВНА")
     print("   • Жесткая блокировка одновременных сессий")
     print("   • Автоматическая очистка устаревших сессий")
     print("   • Контроль по user_id + device_id + IP")
+    print(f"   • Хранилище сессий: {PERFORMANCE_CONFIG['SESSION_BACKEND']}")
+    print("   • Один процесс на БД: несколько воркеров не поддерживаются")
+    print(f"   • Режим сервера: {PERFORMANCE_CONFIG['SERVING_MODE']}")
+    if PERFORMANCE_CONFIG['SERVING_MODE'] == 'asgi':
+        print("   • asyncio: heartbeat, синхронизация и SSE без потока на "
+              "соединение")
     print()
     print("🌐 Доступные эндпоинты:")
     print("   • GET  /api/health           - Проверка здоровья (<50ms)")
     print("   • POST /api/sync/unified     - Синхронизация (<100ms)")
+    print("   • POST /api/sync/delta       - Дельта-синхронизация (<50ms)")
     print("   • GET  /api/lottery/status   - Статус лотереи (<50ms)")
+    print("   • POST /api/lottery/bet      - Ставка в лотерее (<50ms)")
+    print("   • GET  /api/classic-lottery/status - Классическая лотерея (<50ms)")
+    print("   • POST /api/classic-lottery/bet    - Ставка в классической (<50ms)")
+    print("   • GET  /api/stream/lottery   - Поток SSE лотерей")
     print("   • GET  /api/leaderboard      - Рейтинг (<80ms)")
+    print("   • GET  /api/leaderboard/rank/<id> - Место игрока (<30ms)")
+    print("   • GET  /api/schema           - Форматы ответов и позиционные схемы")
     print("   • POST /api/transfer         - Перевод (<100ms)")
     print("   • POST /api/session/check    - Проверка сессии (<30ms)")
+    print("   • POST /api/session/release  - Освобождение сессии (<30ms)")
+    print("   • GET  /api/admin/metrics    - Метрики Prometheus (p50-p999)")
+    print("   • GET  /api/admin/slow-queries - Медленные запросы и их планы")
     print()
     print("✅ Сервер оптимизирован для максимальной производительности!")
     print("🎯 Цель: отклик <120ms, блокировка мультисессии: 100%")
 
     # Запуск сервера с оптимизациями
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    if PERFORMANCE_CONFIG['SERVING_MODE'] == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            print("❌ Для ASGI-режима нужен ASGI-сервер: pip install uvicorn "
+                  "(или hypercorn bot:asgi_app)")
+            sys.exit(1)
+        uvicorn.run(asgi_app, host='0.0.0.0', port=5000, log_level='warning')
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
@@ -8,7 +8,6 @@ let CURRENT_LANG = 'ru';
 // ========== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ==========
 window.apiConnected = false;
 window.isOnline = navigator.onLine;
-window.accumulatedIncome = 0;
 window.lastClickTime = 0;
 window.antiCheatBlocked = false;
 window.clickTimes = [];
@@ -265,10 +264,102 @@ async function loadUpgradesData(userId) {
     }
 }
 
+// ========== ДЕЛЬТА-СИНХРОНИЗАЦИЯ ==========
+// Последнее подтвержденное сервером состояние: изменения считаются от него
+let syncBase = null;
+const SYNC_DELTA_FIELDS = ['username', 'balance', 'totalEarned', 'totalClicks'];
+
+function readSyncField(field) {
+    const value = window.userData[field];
+    return field === 'username' ? value : Number(value);
+}
+
+function collectSyncChanges() {
+    const changes = {};
+    for (const field of SYNC_DELTA_FIELDS) {
+        const value = readSyncField(field);
+        if (value !== syncBase.values[field]) {
+            changes[field] = value;
+        }
+    }
+    return changes;
+}
+
+// Изменения сервера (перевод, выигрыш) переносим поверх локальных: числа - разницей
+function applyServerFields(fields) {
+    for (const [field, value] of Object.entries(fields)) {
+        if (typeof value === 'number') {
+            window.userData[field] = readSyncField(field) + value - syncBase.values[field];
+        } else {
+            window.userData[field] = value;
+        }
+        syncBase.values[field] = value;
+    }
+    updateUI();
+}
+
+// true - готово, 'retry' - конфликт версий разрешен, 'full' - нужно полное состояние
+async function syncDelta() {
+    const changes = collectSyncChanges();
+    const payload = {
+        userId: window.userData.userId,
+        deviceId: generateDeviceId(),
+        telegramId: window.userData.telegramId,
+        baseVersion: syncBase.version,
+        changes: changes,
+        lease: syncBase.lease
+    };
+    // Уровни улучшений - только после покупки: по ним сервер считает майнинг
+    const upgrades = JSON.stringify(getUpgradesForSync());
+    if (upgrades !== syncBase.upgrades) {
+        payload.upgrades = getUpgradesForSync();
+    }
+    
+    const result = await window.apiSyncDelta(payload);
+    if (!result) return false;
+    
+    const { status, data } = result;
+    if (data.sessionLease) {
+        syncBase.lease = data.sessionLease;
+    }
+    if (status === 200 && data.success) {
+        Object.assign(syncBase.values, changes);
+        syncBase.upgrades = upgrades;
+        if (data.fields) applyServerFields(data.fields);
+        syncBase.version = data.version;
+        return true;
+    }
+    if (status === 409 && data.error === 'VERSION_CONFLICT') {
+        applyServerFields(data.fields || {});
+        syncBase.version = data.version;
+        return 'retry';
+    }
+    if (status === 403) return false;
+    
+    syncBase = null;
+    return 'full';
+}
+
 // ========== ОПТИМИЗИРОВАННАЯ СИНХРОНИЗАЦИЯ ==========
 async function syncToServer(retryCount = 0) {
     if (!window.userData) return false;
     
+    if (syncBase) {
+        try {
+            let outcome = await syncDelta();
+            if (outcome === 'retry') {
+                outcome = await syncDelta();
+            }
+            if (outcome === true) {
+                window.lastSyncTime = Date.now();
+                return true;
+            }
+            if (outcome !== 'full') return false;
+        } catch (error) {
+            return false;
+        }
+    }
+    
     try {
         const syncData = {
             userId: window.userData.userId,
@@ -294,6 +385,26 @@ async function syncToServer(retryCount = 0) {
                 saveUserData();
             }
             
+            // Дальше синхронизируемся дельтами от этой версии
+            if (typeof response.version === 'number' && !response.offline) {
+                syncBase = {
+                    version: response.version,
+                    lease: response.sessionLease,
+                    upgrades: JSON.stringify(syncData.upgrades),
+                    values: {
+                        username: syncData.username,
+                        balance: syncData.balance,
+                        totalEarned: syncData.totalEarned,
+                        totalClicks: Number(syncData.totalClicks)
+                    }
+                };
+                // Баланс с майнингом, начисленным сервером
+                applyServerFields({
+                    balance: response.balance,
+                    totalEarned: response.totalEarned
+                });
+            }
+            
             if (response.bestBalance && response.bestBalance > window.userData.balance) {
                 window.userData.balance = response.bestBalance;
                 updateUI();
@@ -312,6 +423,20 @@ async function syncToServer(retryCount = 0) {
     return false;
 }
 
+// Освобождаем сессию при закрытии, чтобы другое устройство не ждало конца аренды.
+// Ключ - та же пара userId/deviceId, под которой сессию зарегистрировала синхронизация
+function releaseServerSession() {
+    if (!syncBase || !syncBase.lease || !window.userData || !navigator.sendBeacon) return;
+    
+    navigator.sendBeacon(`${window.CONFIG.API_BASE_URL}/api/session/release`, JSON.stringify({
+        userId: window.userData.userId,
+        deviceId: generateDeviceId(),
+        lease: syncBase.lease
+    }));
+}
+
+window.addEventListener('pagehide', releaseServerSession);
+
 function getUpgradesForSync() {
     const upgradesData = {};
     if (window.upgrades) {
@@ -542,22 +667,28 @@ function updateShopUI() {
 }
 
 // ========== ПАССИВНЫЙ ДОХОД И СОХРАНЕНИЕ ==========
+// Майнинг начисляет сервер: здесь только отображение, на сервер он не отправляется
 function startPassiveIncome() {
     if (window.incomeInterval) clearInterval(window.incomeInterval);
+    let lastTick = Date.now();
     
     window.incomeInterval = setInterval(() => {
+        // По прошедшему времени: фоновая вкладка тикает реже
+        const now = Date.now();
+        const seconds = (now - lastTick) / 1000;
+        lastTick = now;
+        
         if (window.userData && window.isDataLoaded) {
-            const miningSpeed = calculateMiningSpeed();
-            if (miningSpeed > 0) {
-                window.userData.balance = parseFloat(window.userData.balance) + miningSpeed;
-                window.userData.totalEarned = parseFloat(window.userData.totalEarned) + miningSpeed;
-                updateUI();
-                
-                window.accumulatedIncome += miningSpeed;
-                if (window.accumulatedIncome >= 0.000000100) {
-                    saveUserData();
-                    window.accumulatedIncome = 0;
+            const mined = calculateMiningSpeed() * seconds;
+            if (mined > 0) {
+                window.userData.balance = parseFloat(window.userData.balance) + mined;
+                window.userData.totalEarned = parseFloat(window.userData.totalEarned) + mined;
+                // Намайненное не изменение клиента - сдвигаем и базу синхронизации
+                if (syncBase) {
+                    syncBase.values.balance += mined;
+                    syncBase.values.totalEarned += mined;
                 }
+                updateUI();
             }
         }
     }, CONFIG.INCOME_INTERVAL);
@@ -35,6 +35,10 @@ let lotteryUpdateInterval;
 let classicLotteryInterval;
 let lastLotteryUpdate = 0;
 let lastClassicUpdate = 0;
+let lotteryStream = null;
+let lotteryStreamDisabled = false;
+let lotteryStreamTimer;
+let serverTimeOffset = 0;
 
 // ========== ЛОКАЛИЗАЦИЯ ИГР ==========
 const GAME_LOCALIZATION = {
@@ -193,14 +197,7 @@ async function loadLotteryStatus() {
         const data = await apiRequest('/api/lottery/status');
         
         if (data && data.success && data.lottery) {
-            lotteryData.eagle = data.lottery.eagle || [];
-            lotteryData.tails = data.lottery.tails || [];
-            lotteryData.last_winner = data.lottery.last_winner || null;
-            lotteryData.timer = data.lottery.timer || 60;
-            lotteryData.total_eagle = data.lottery.total_eagle || 0;
-            lotteryData.total_tails = data.lottery.total_tails || 0;
-            lotteryData.participants_count = data.lottery.participants_count || 0;
-            
+            applyLotteryStatus(data.lottery);
             lastLotteryUpdate = now;
         }
         updateLotteryUI();
@@ -209,6 +206,17 @@ async function loadLotteryStatus() {
     }
 }
 
+function applyLotteryStatus(lottery) {
+    lotteryData.eagle = lottery.eagle || [];
+    lotteryData.tails = lottery.tails || [];
+    lotteryData.last_winner = lottery.last_winner || null;
+    lotteryData.timer = lottery.timer || 60;
+    lotteryData.next_round = lottery.next_round || null;
+    lotteryData.total_eagle = lottery.total_eagle || 0;
+    lotteryData.total_tails = lottery.total_tails || 0;
+    lotteryData.participants_count = lottery.participants_count || 0;
+}
+
 async function placeLotteryBet(team, amount) {
     if (!window.userData) {
         showNotification(getGameText('noUserData'), 'error');
@@ -361,12 +369,78 @@ function startLotteryAutoUpdate() {
     clearInterval(lotteryUpdateInterval);
     
     loadLotteryStatus();
+    if (startLotteryStream()) return;
     
     lotteryUpdateInterval = setInterval(() => {
         loadLotteryStatus();
     }, 3000);
 }
 
+// ========== ПОТОК ОБНОВЛЕНИЙ ЛОТЕРЕЙ (SSE) ==========
+function startLotteryStream() {
+    if (lotteryStream) return true;
+    if (lotteryStreamDisabled || typeof EventSource === 'undefined' || !window.CONFIG) return false;
+    
+    // Переподключение и Last-Event-ID браузер берет на себя
+    lotteryStream = new EventSource(`${window.CONFIG.API_BASE_URL}/api/stream/lottery`);
+    
+    lotteryStream.addEventListener('hello', (event) => {
+        const data = JSON.parse(event.data);
+        serverTimeOffset = data.server_time * 1000 - Date.now();
+    });
+    
+    lotteryStream.addEventListener('lottery', (event) => {
+        applyLotteryStatus(JSON.parse(event.data));
+        updateStreamTimers();
+        updateLotteryUI();
+    });
+    
+    lotteryStream.addEventListener('classic', (event) => {
+        applyClassicLottery(JSON.parse(event.data));
+        updateStreamTimers();
+        updateClassicLotteryUI();
+    });
+    
+    lotteryStream.onerror = () => {
+        // Сервер закрыл поток окончательно - возвращаемся к опросу
+        if (lotteryStream && lotteryStream.readyState === EventSource.CLOSED) {
+            stopLotteryStream();
+            lotteryStreamDisabled = true;
+            startLotteryAutoUpdate();
+            startClassicLotteryUpdate();
+        }
+    };
+    
+    // Таймеры в потоке не приходят - считаем их по времени окончания раунда
+    clearInterval(lotteryStreamTimer);
+    lotteryStreamTimer = setInterval(() => {
+        updateStreamTimers();
+        updateLotteryUI();
+        updateClassicLotteryUI();
+    }, 1000);
+    
+    return true;
+}
+
+function stopLotteryStream() {
+    if (lotteryStream) {
+        lotteryStream.close();
+        lotteryStream = null;
+    }
+    clearInterval(lotteryStreamTimer);
+}
+
+function updateStreamTimers() {
+    const serverNow = (Date.now() + serverTimeOffset) / 1000;
+    
+    if (lotteryData.next_round) {
+        lotteryData.timer = Math.max(0, Math.ceil(lotteryData.next_round - serverNow));
+    }
+    if (classicLotteryData.ends_at) {
+        classicLotteryData.timer = Math.max(0, Math.ceil(classicLotteryData.ends_at - serverNow));
+    }
+}
+
 function selectTeam(team) {
     selectedTeam = team;
     document.querySelectorAll('.team-button').forEach(btn => btn.classList.remove('active'));
@@ -426,12 +500,7 @@ async function loadClassicLottery() {
         const data = await apiRequest('/api/classic-lottery/status');
         
         if (data && data.success && data.lottery) {
-            classicLotteryData.bets = data.lottery.bets || [];
-            classicLotteryData.total_pot = data.lottery.total_pot || 0;
-            classicLotteryData.timer = data.lottery.timer || 120;
-            classicLotteryData.participants_count = data.lottery.participants_count || 0;
-            classicLotteryData.history = data.lottery.history || [];
-            
+            applyClassicLottery(data.lottery);
             lastClassicUpdate = now;
         }
         updateClassicLotteryUI();
@@ -440,6 +509,15 @@ async function loadClassicLottery() {
     }
 }
 
+function applyClassicLottery(lottery) {
+    classicLotteryData.bets = lottery.bets || [];
+    classicLotteryData.total_pot = lottery.total_pot || 0;
+    classicLotteryData.timer = lottery.timer || 120;
+    classicLotteryData.ends_at = lottery.ends_at || null;
+    classicLotteryData.participants_count = lottery.participants_count || 0;
+    classicLotteryData.history = lottery.history || [];
+}
+
 async function playClassicLottery() {
     const betInput = document.getElementById('classicBet');
     if (!betInput) return;
@@ -557,6 +635,7 @@ function startClassicLotteryUpdate() {
     clearInterval(classicLotteryInterval);
     
     loadClassicLottery();
+    if (lotteryStream) return;
     
     classicLotteryInterval = setInterval(() => {
         loadClassicLottery();
@@ -637,6 +716,21 @@ async function updateLeaderboard() {
             `;
         });
         
+        // Своя позиция, если игрок не попал в топ
+        if (userId && !data.leaderboard.some(player => player && player.userId === userId)) {
+            const position = await apiRequest(`/api/leaderboard/rank/${encodeURIComponent(userId)}?type=balance&neighbors=0`);
+            const me = position && position.success && position.neighbors && position.neighbors[0];
+            if (me) {
+                newHTML += `
+                    <div class="leader-item current-player">
+                        <div class="leader-rank">${position.rank} ${getGameText('place')}</div>
+                        <div class="leader-name current-player">${me.username || getGameText('player')} 👑</div>
+                        <div class="leader-balance">${(me.balance || 0).toFixed(9)} S</div>
+                    </div>
+                `;
+            }
+        }
+        
         leaderboard.innerHTML = newHTML;
     } catch (error) {
         const leaderboard = document.getElementById('leaderboard');
@@ -0,0 +1,364 @@
+# migrate_nano.py - ОНЛАЙН-МИГРАЦИЯ ДЕНЕЖНЫХ СТОЛБЦОВ В ЦЕЛЫЕ НАНО-ЕДИНИЦЫ
+#
+# Запуск:  python migrate_nano.py [sparkcoin_high_perf.db] [--batch 2000]
+#                                 [--pause-ms 20] [--wait-sec 600]
+#                                 [--drop-legacy]
+#
+# Порядок:
+#   1. Старая версия сервера работает во время копирования: изменения ее
+#      строк зеркалируются триггерами в теневые таблицы, копирование идет
+#      короткими транзакциями.
+#   2. После копирования миграция ждет остановки старого сервера (до
+#      --wait-sec): его REAL-записи в подмененные таблицы легли бы как
+#      нано-единицы. Подмена берет эксклюзивную блокировку БД и не начнется,
+#      пока БД открыта другим процессом.
+#   3. Подмена таблиц - одна короткая транзакция, после нее запускается
+#      новая версия сервера.
+# Прерванную миграцию можно запустить повторно - она продолжится.
+import re
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+NANO = 1_000_000_000
+# PRAGMA user_version базы с целочисленными суммами
+SCHEMA_VERSION = 1
+
+SHADOW_SUFFIX = '__nano'
+LEGACY_SUFFIX = '__legacy'
+
+
+class DatabaseBusy(RuntimeError):
+    """БД открыта другим процессом (старым сервером) - подменять нельзя"""
+
+
+class TableSpec:
+    """Таблица для миграции: денежные столбцы, ключ и особые выражения"""
+
+    def __init__(self,
+                 name: str,
+                 key: Tuple[str, ...],
+                 money: Tuple[str, ...],
+                 overrides: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.key = key
+        self.money = money
+        # Столбец -> выражение SQL от строки-источника ({row} - ее префикс)
+        self.overrides = overrides or {}
+
+
+TABLES = (
+    TableSpec('players_high_perf', ('user_id', ),
+              ('balance', 'total_earned', 'click_speed', 'mine_speed',
+               'total_speed', 'referral_earnings', 'total_winnings',
+               'total_losses', 'total_bet', 'transfers_sent',
+               'transfers_received')),
+    TableSpec('lottery_bets_high_perf', ('id', ), ('amount', )),
+    TableSpec('transfers_high_perf', ('id', ), ('amount', )),
+    TableSpec('lottery_rounds_high_perf', ('round_id', ), ('total_pot', )),
+    TableSpec('classic_lottery_bets_high_perf', ('round_id', 'seq'),
+              ('amount', )),
+    # Снимки открытых раундов хранят ставки в S - сбрасываем их, и раунд
+    # восстановится из журнала ставок целиком
+    TableSpec('classic_lottery_rounds_high_perf', ('round_id', ),
+              ('total_pot', 'prize'), {
+                  'state': "CASE WHEN {row}status = 'open' THEN NULL "
+                           "ELSE {row}state END",
+                  'last_seq': "CASE WHEN {row}status = 'open' THEN 0 "
+                              "ELSE {row}last_seq END"
+              }),
+)
+
+
+class NanoUnitMigration:
+    """Перевод REAL-сумм в INTEGER нано-единицы: тень, триггеры, подмена"""
+
+    def __init__(self, db_path: str, batch_size: int = 2000,
+                 pause_seconds: float = 0.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        # Переименование не должно переписывать ссылки других таблиц
+        self.conn.execute("PRAGMA legacy_alter_table = ON")
+
+    def close(self):
+        self.conn.close()
+
+    def _columns(self, table: str) -> List[sqlite3.Row]:
+        return self.conn.execute(f"PRAGMA table_xinfo({table})").fetchall()
+
+    def needed(self) -> bool:
+        """Старая схема: версия 0 и REAL-баланс игроков"""
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return False
+        return any(column['name'] == 'balance' and column['type'] == 'REAL'
+                   for column in self._columns('players_high_perf'))
+
+    def _tables(self) -> List[TableSpec]:
+        return [spec for spec in TABLES if self._columns(spec.name)]
+
+    # ------------------------------------------------------------------
+    # ТЕНЕВЫЕ ТАБЛИЦЫ И ТРИГГЕРЫ
+    # ------------------------------------------------------------------
+    def _shadow_ddl(self, spec: TableSpec) -> str:
+        """DDL исходной таблицы с INTEGER-суммами под теневым именем"""
+        sql = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (spec.name, )).fetchone()[0]
+        sql = re.sub(rf'\b{spec.name}\b', spec.name + SHADOW_SUFFIX, sql,
+                     count=1)
+        sql = sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1)
+
+        def to_integer(match: re.Match) -> str:
+            default = match.group(3)
+            if default is None:
+                return match.group(1) + 'INTEGER'
+            return (f"{match.group(1)}INTEGER DEFAULT "
+                    f"{round(float(default) * NANO)}")
+
+        for column in spec.money:
+            sql = re.sub(rf'(\b{column}\s+)REAL\b(\s+DEFAULT\s+([0-9.]+))?',
+                         to_integer, sql)
+        return sql
+
+    def _copy_columns(self, spec: TableSpec) -> List[str]:
+        # Вычисляемые столбцы (hidden 2 и 3) не копируются
+        return [
+            column['name'] for column in self._columns(spec.name)
+            if column['hidden'] == 0
+        ]
+
+    def _expressions(self, spec: TableSpec, row: str = '') -> List[str]:
+        expressions = []
+        for column in self._copy_columns(spec):
+            if column in spec.overrides:
+                expressions.append(spec.overrides[column].format(row=row))
+            elif column in spec.money:
+                value = f"CAST(ROUND({row}{column} * {NANO}) AS INTEGER)"
+                if column == 'amount':
+                    value = f"MAX(1, {value})"  # CHECK(amount > 0)
+                expressions.append(value)
+            else:
+                expressions.append(f"{row}{column}")
+        return expressions
+
+    def _key_match(self, spec: TableSpec, row: str) -> str:
+        return ' AND '.join(f"{column} = {row}.{column}" for column in spec.key)
+
+    def prepare(self, spec: TableSpec):
+        """Теневая таблица и триггеры, зеркалирующие изменения источника"""
+        shadow = spec.name + SHADOW_SUFFIX
+        columns = ', '.join(self._copy_columns(spec))
+        upsert = (f"INSERT OR REPLACE INTO {shadow} ({columns}) "
+                  f"VALUES ({', '.join(self._expressions(spec, 'NEW.'))});")
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(self._shadow_ddl(spec))
+            self.conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {shadow}_insert
+                AFTER INSERT ON {spec.name} BEGIN {upsert} END''')
+            self.conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {shadow}_update
+                AFTER UPDATE ON {spec.name} BEGIN
+                    DELETE FROM {shadow} WHERE {self._key_match(spec, 'OLD')};
+                    {upsert}
+                END''')
+            self.conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {shadow}_delete
+                AFTER DELETE ON {spec.name} BEGIN
+                    DELETE FROM {shadow} WHERE {self._key_match(spec, 'OLD')};
+                END''')
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    # ------------------------------------------------------------------
+    # КОПИРОВАНИЕ КОРОТКИМИ ТРАНЗАКЦИЯМИ
+    # ------------------------------------------------------------------
+    def backfill(self, spec: TableSpec) -> int:
+        """Копирование строк пачками по ключу; строки, уже отраженные
+        триггером, новее - их не трогаем (INSERT OR IGNORE)"""
+        shadow = spec.name + SHADOW_SUFFIX
+        key = ', '.join(spec.key)
+        placeholders = ', '.join('?' * len(spec.key))
+        insert = (
+            f"INSERT OR IGNORE INTO {shadow} ({', '.join(self._copy_columns(spec))}) "
+            f"SELECT {', '.join(self._expressions(spec))} FROM {spec.name} "
+            f"WHERE ({key}) {{}} ({placeholders}) AND ({key}) <= ({placeholders})")
+        insert_first, insert_next = insert.format('>='), insert.format('>')
+
+        select_next = (f"SELECT {key} FROM {spec.name} "
+                       f"WHERE ({key}) > ({placeholders}) ORDER BY {key} LIMIT ?")
+
+        last_key: Optional[tuple] = None
+        copied = 0
+        while True:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if last_key is None:
+                    # Первая пачка: нижней границы нет
+                    keys = self.conn.execute(
+                        f"SELECT {key} FROM {spec.name} ORDER BY {key} LIMIT ?",
+                        (self.batch_size, )).fetchall()
+                    if keys:
+                        self.conn.execute(insert_first, (*keys[0], *keys[-1]))
+                else:
+                    keys = self.conn.execute(
+                        select_next, (*last_key, self.batch_size)).fetchall()
+                    if keys:
+                        self.conn.execute(insert_next, (*last_key, *keys[-1]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+            if not keys:
+                return copied
+            copied += len(keys)
+            last_key = tuple(keys[-1])
+            if self.pause_seconds:
+                time.sleep(self.pause_seconds)  # Окно для записей сервера
+
+    # ------------------------------------------------------------------
+    # ПОДМЕНА ТАБЛИЦ
+    # ------------------------------------------------------------------
+    def _lock_exclusive(self):
+        """Эксклюзивная транзакция в режиме EXCLUSIVE: в WAL она невозможна,
+        пока БД держит открытой любое другое соединение, даже простаивающее"""
+        self.conn.execute("PRAGMA locking_mode = EXCLUSIVE")
+        # Соединения старого сервера не закроются за время ожидания занятости
+        self.conn.execute("PRAGMA busy_timeout = 1000")
+        try:
+            self.conn.execute("BEGIN EXCLUSIVE")
+        except sqlite3.OperationalError as e:
+            self._unlock()
+            raise DatabaseBusy(
+                f"БД {self.db_path} открыта другим процессом - остановите "
+                f"старый сервер перед подменой таблиц") from e
+
+    def _unlock(self):
+        self.conn.execute("PRAGMA locking_mode = NORMAL")
+        self.conn.execute("PRAGMA busy_timeout = 30000")
+
+    def swap(self, specs: List[TableSpec], drop_legacy: bool):
+        """Одна короткая транзакция: теневые таблицы занимают место исходных.
+
+        Только при единственном соединении с БД: старый сервер, оставшийся
+        после подмены, писал бы REAL-суммы в целочисленные столбцы.
+        """
+        self._lock_exclusive()
+        try:
+            for spec in specs:
+                shadow = spec.name + SHADOW_SUFFIX
+                source_rows = self.conn.execute(
+                    f"SELECT COUNT(*) FROM {spec.name}").fetchone()[0]
+                shadow_rows = self.conn.execute(
+                    f"SELECT COUNT(*) FROM {shadow}").fetchone()[0]
+                if source_rows != shadow_rows:
+                    raise RuntimeError(
+                        f"{spec.name}: {source_rows} строк, в тени {shadow_rows}")
+
+                for action in ('insert', 'update', 'delete'):
+                    self.conn.execute(f"DROP TRIGGER IF EXISTS {shadow}_{action}")
+
+                indexes = self.conn.execute(
+                    "SELECT name, sql FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                    (spec.name, )).fetchall()
+                for index in indexes:
+                    self.conn.execute(f"DROP INDEX {index['name']}")
+
+                self.conn.execute(f"DROP TABLE IF EXISTS {spec.name}{LEGACY_SUFFIX}")
+                self.conn.execute(
+                    f"ALTER TABLE {spec.name} RENAME TO {spec.name}{LEGACY_SUFFIX}")
+                self.conn.execute(f"ALTER TABLE {shadow} RENAME TO {spec.name}")
+                for index in indexes:
+                    self.conn.execute(index['sql'])
+                if drop_legacy:
+                    self.conn.execute(f"DROP TABLE {spec.name}{LEGACY_SUFFIX}")
+
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._unlock()
+
+    def swap_when_free(self, specs: List[TableSpec], drop_legacy: bool,
+                       wait_seconds: float):
+        """Подмена, как только другие процессы закроют БД (не дольше
+        wait_seconds)"""
+        deadline = time.monotonic() + wait_seconds
+        waiting = False
+        while True:
+            try:
+                return self.swap(specs, drop_legacy)
+            except DatabaseBusy:
+                if time.monotonic() >= deadline:
+                    raise
+                if not waiting:
+                    logger.info("⏳ Копирование завершено - остановите старый "
+                                "сервер, подмена начнется сразу после этого")
+                    waiting = True
+                time.sleep(1)
+
+    def run(self, drop_legacy: bool = False,
+            wait_seconds: float = 0) -> Dict[str, int]:
+        """Полная миграция; возвращает число скопированных строк по таблицам"""
+        start_time = time.perf_counter()
+        specs = self._tables()
+        for spec in specs:
+            self.prepare(spec)
+
+        copied = {}
+        for spec in specs:
+            copied[spec.name] = self.backfill(spec)
+            logger.info(f"💱 {spec.name}: скопировано {copied[spec.name]} строк")
+
+        self.swap_when_free(specs, drop_legacy, wait_seconds)
+        logger.info(f"💱 Суммы переведены в нано-единицы за "
+                    f"{time.perf_counter() - start_time:.1f}s")
+        return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Онлайн-миграция сумм Sparkcoin в целые нано-единицы')
+    parser.add_argument('db_path', nargs='?', default='sparkcoin_high_perf.db')
+    parser.add_argument('--batch', type=int, default=2000)
+    parser.add_argument('--pause-ms', type=float, default=20)
+    parser.add_argument('--wait-sec', type=float, default=600,
+                        help='сколько ждать остановки старого сервера')
+    parser.add_argument('--drop-legacy', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    migration = NanoUnitMigration(args.db_path, args.batch,
+                                  args.pause_ms / 1000)
+    try:
+        if not migration.needed():
+            print("✅ База уже хранит суммы в нано-единицах")
+            return
+        try:
+            migration.run(args.drop_legacy, args.wait_sec)
+        except DatabaseBusy as e:
+            print(f"❌ {e}. Копия сохранена - запустите миграцию повторно")
+            return 1
+        print("✅ Миграция завершена - запустите сервер новой версией")
+    finally:
+        migration.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
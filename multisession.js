@@ -8,6 +8,7 @@ class HardSessionBlocker {
         this.lastActivityKey = 'sparkcoin_last_activity_hard';
         this.checkInterval = null;
         this.isBlocked = false;
+        this.lease = null;
     }
 
     // Генерируем SUPER-уникальный ID устройства
@@ -64,26 +65,35 @@ class HardSessionBlocker {
         return true;
     }
 
-    // Проверка сессии на сервере
+    // Проверка сессии на сервере: та же пара userId/deviceId, под которой
+    // сессию регистрирует синхронизация (core.js), иначе устройство блокирует само себя
     async checkServerSession(telegramId, deviceId) {
-        try {
-            const response = await fetch('https://b9339c3b-8a22-434d-b97a-a426ac75c328-00-2vzfhw3hnozb6.sisko.replit.dev/api/session/check', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    telegramId: telegramId,
-                    deviceId: deviceId,
-                    username: this.getTelegramUsername()
-                })
-            });
-            
-            if (response.ok) {
-                return await response.json();
+        const userId = window.userData?.userId;
+        if (userId && typeof window.generateDeviceId === 'function') {
+            try {
+                const response = await fetch('https://b9339c3b-8a22-434d-b97a-a426ac75c328-00-2vzfhw3hnozb6.sisko.replit.dev/api/session/check', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({
+                        userId: userId,
+                        telegramId: telegramId,
+                        deviceId: window.generateDeviceId(),
+                        username: this.getTelegramUsername(),
+                        lease: this.lease
+                    })
+                });
+                
+                if (response.ok) {
+                    const data = await response.json();
+                    // Подписанная аренда: пока она действует, сервер не трогает хранилище сессий
+                    if (data.lease) this.lease = data.lease;
+                    return data;
+                }
+            } catch (error) {
+                console.log('📴 Сервер проверки сессий недоступен');
             }
-        } catch (error) {
-            console.log('📴 Сервер проверки сессий недоступен');
         }
         
         // Fallback: локальная проверка
@@ -0,0 +1,47 @@
+import os
+import sys
+import logging
+import tempfile
+
+import pytest
+
+# bot.py создает БД и фоновые потоки при импорте - работаем во временной папке
+WORK_DIR = tempfile.mkdtemp(prefix='sparkcoin_tests_')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(WORK_DIR)
+
+import bot  # noqa: E402
+
+bot.logger.setLevel(logging.ERROR)
+# Все запросы тестового клиента идут с одного адреса
+bot.PERFORMANCE_CONFIG['ADMISSION_ENABLED'] = False
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Отдельная БД для теста"""
+    return bot.HighPerformanceDatabase(str(tmp_path / 'test.db'))
+
+
+@pytest.fixture
+def ledger(database):
+    buffer = bot.WriteBehindBuffer(database)
+    yield buffer
+    buffer.shutdown()
+
+
+def add_players(database, balances):
+    """Игроки с балансами в нано-единицах: {user_id: balance}"""
+    database.execute_many_fast(
+        "INSERT INTO players_high_perf (user_id, username, balance) VALUES (?, ?, ?)",
+        [(user_id, user_id, balance) for user_id, balance in balances.items()])
+
+
+def balances(database, *user_ids):
+    placeholders = ', '.join('?' * len(user_ids))
+    with database.reader() as conn:
+        return {
+            row['user_id']: row['balance'] for row in conn.execute(
+                f"SELECT user_id, balance FROM players_high_perf "
+                f"WHERE user_id IN ({placeholders})", user_ids)
+        }
@@ -0,0 +1,73 @@
+import pytest
+
+import bot
+from conftest import add_players, balances
+
+NANO = bot.NANO
+
+
+@pytest.fixture
+def engine(database, ledger):
+    add_players(database, {'alice': 10 * NANO, 'bob': 10 * NANO})
+    engine = bot.ClassicLotteryEngine(database, ledger)
+    # Раунды разыгрывает тест, а не фоновый поток
+    engine.stop_event.set()
+    engine.thread.join()
+    yield engine
+    engine.shutdown()
+
+
+def close_round(engine):
+    """Ставки alice и bob в раунде, который уже ждет розыгрыша"""
+    engine.place_bet('alice', NANO)
+    engine.place_bet('bob', 3 * NANO)
+    with engine.lock:
+        round_state = engine.current
+        engine.closed.append(round_state)
+        engine.current = bot.ClassicRound(round_state.round_id + 1,
+                                          engine.recent_size)
+    return round_state
+
+
+def test_round_is_paid_once(engine, database, ledger):
+    round_state = close_round(engine)
+    engine.flush()
+
+    engine._settle(round_state)
+    # Повтор после сбоя или перезапуска не проходит захват раунда
+    engine._settle(round_state)
+
+    assert engine.stats['rounds_settled'] == 1
+    assert engine.stats['rounds_skipped'] == 1
+    ledger.flush()
+    assert sum(balances(database, 'alice', 'bob').values()) == 20 * NANO
+    assert {user_id: ledger.load_player(user_id)['balance']
+            for user_id in ('alice', 'bob')} == balances(database, 'alice', 'bob')
+    with database.reader() as conn:
+        row = conn.execute(
+            "SELECT status, total_pot FROM classic_lottery_rounds_high_perf "
+            "WHERE round_id = ?", (round_state.round_id, )).fetchone()
+    assert tuple(row) == ('settled', 4 * NANO)
+
+
+def test_failed_settlement_stays_queued(engine, database, ledger, monkeypatch):
+    round_state = close_round(engine)
+    settle = engine._settle
+
+    def failing_settle(state):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(engine, '_settle', failing_settle)
+    engine.settle_closed()
+    assert engine.closed == [round_state]
+    with database.reader() as conn:
+        assert conn.execute(
+            "SELECT COUNT(*) FROM classic_lottery_rounds_high_perf "
+            "WHERE status = 'settled'").fetchone()[0] == 0
+
+    monkeypatch.setattr(engine, '_settle', settle)
+    engine.settle_closed()
+    assert engine.closed == []
+    assert engine.stats['rounds_settled'] == 1
+    ledger.flush()
+    assert sum(balances(database, 'alice', 'bob').values()) == 20 * NANO
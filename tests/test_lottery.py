@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+import bot
+from conftest import add_players, balances
+
+NANO = bot.NANO
+
+
+@pytest.fixture
+def engine(database, ledger):
+    add_players(database, {'alice': 10 * NANO, 'bob': 10 * NANO,
+                           'carol': 10 * NANO})
+    engine = bot.TeamLotteryEngine(database, ledger,
+                                   bot.LotteryWindowAggregator())
+    # Граница раунда не должна пройти посреди теста
+    engine.round_seconds = 24 * 3600
+    yield engine
+    engine.shutdown()
+
+
+def test_round_is_settled_once_from_database(engine, database, ledger):
+    engine.place_bet('alice', 'eagle', NANO)
+    engine.place_bet('bob', 'tails', 2 * NANO)
+    engine.place_bet('carol', 'eagle', 3)
+    round_id = engine.round_of(time.time())
+    engine.flush()
+
+    engine._settle(round_id)
+    # Второй владелец (повтор или другой процесс) не проходит захват раунда
+    engine._settle(round_id)
+
+    assert engine.stats['rounds_settled'] == 1
+    with database.reader() as conn:
+        row = conn.execute(
+            "SELECT total_pot, bets_count FROM lottery_rounds_high_perf "
+            "WHERE round_id = ?", (round_id, )).fetchone()
+    assert tuple(row) == (3 * NANO + 3, 3)
+
+    ledger.flush()
+    assert sum(balances(database, 'alice', 'bob', 'carol').values()) == 30 * NANO
+    assert {user_id: ledger.load_player(user_id)['balance']
+            for user_id in ('alice', 'bob', 'carol')} == balances(
+                database, 'alice', 'bob', 'carol')
+
+
+def test_settlement_ignores_bets_missing_from_database(engine, database):
+    engine.place_bet('alice', 'eagle', NANO)
+    round_id = engine.round_of(time.time())
+    engine.flush()
+    # Ставка есть только в памяти процесса, в журнал она не попала
+    engine.place_bet('bob', 'tails', NANO)
+    with engine.lock:
+        engine.queue.clear()
+
+    engine._settle(round_id)
+
+    assert engine.last_result['total_pot'] == 1.0
+    assert engine.last_result['team'] == 'eagle'
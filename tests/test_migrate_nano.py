@@ -0,0 +1,150 @@
+import sqlite3
+
+import pytest
+
+import bot
+import migrate_nano
+from migrate_nano import NanoUnitMigration, NANO
+
+# Схема до перевода сумм в нано-единицы (REAL в S)
+LEGACY_SCHEMA = '''
+    CREATE TABLE players_high_perf (
+        user_id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        balance REAL DEFAULT 0.000000100 CHECK(balance >= 0),
+        total_earned REAL DEFAULT 0.000000100,
+        total_clicks INTEGER DEFAULT 0
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_balance ON players_high_perf (balance DESC);
+
+    CREATE TABLE transfers_high_perf (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_user_id TEXT NOT NULL,
+        to_user_id TEXT NOT NULL,
+        amount REAL NOT NULL CHECK(amount > 0)
+    );
+'''
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany(
+        "INSERT INTO players_high_perf (user_id, username, balance, total_earned) "
+        "VALUES (?, ?, ?, ?)",
+        [(f'user_{n}', f'user_{n}', n * 0.1, n * 0.25) for n in range(25)])
+    conn.executemany(
+        "INSERT INTO transfers_high_perf (from_user_id, to_user_id, amount) "
+        "VALUES (?, ?, ?)",
+        [('user_1', 'user_2', 0.3), ('user_2', 'user_3', 0.0000000001)])
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def migration(legacy_db):
+    migration = NanoUnitMigration(legacy_db, batch_size=10)
+    yield migration
+    migration.close()
+
+
+def rows(migration, query):
+    return [tuple(row) for row in migration.conn.execute(query)]
+
+
+def test_run_converts_money_columns_to_nano_units(migration):
+    assert migration.needed()
+
+    copied = migration.run()
+
+    assert copied == {'players_high_perf': 25, 'transfers_high_perf': 2}
+    assert not migration.needed()
+    assert rows(migration, "SELECT balance, total_earned, typeof(balance) "
+                "FROM players_high_perf WHERE user_id = 'user_3'") == [
+                    (300_000_000, 750_000_000, 'integer')]
+    # Сумма меньше нано-единицы не нарушает CHECK(amount > 0)
+    assert rows(migration, "SELECT amount FROM transfers_high_perf "
+                "ORDER BY id") == [(300_000_000, ), (1, )]
+    # Индексы пересозданы на новой таблице, значения по умолчанию - в нано
+    assert rows(migration, "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = 'players_high_perf' AND sql IS NOT NULL") == [
+                    ('idx_balance', )]
+    migration.conn.execute(
+        "INSERT INTO players_high_perf (user_id, username) VALUES ('new', 'new')")
+    assert rows(migration, "SELECT balance FROM players_high_perf "
+                "WHERE user_id = 'new'") == [(100, )]
+
+
+def test_triggers_mirror_writes_made_during_copy(migration):
+    specs = migration._tables()
+    for spec in specs:
+        migration.prepare(spec)
+    migration.backfill(specs[0])
+
+    # Старый сервер продолжает писать REAL-суммы после копирования
+    migration.conn.execute(
+        "UPDATE players_high_perf SET balance = 2.5 WHERE user_id = 'user_4'")
+    migration.conn.execute("DELETE FROM players_high_perf WHERE user_id = 'user_5'")
+    migration.conn.execute(
+        "INSERT INTO players_high_perf (user_id, username, balance) "
+        "VALUES ('late', 'late', 0.000000007)")
+    for spec in specs[1:]:
+        migration.backfill(spec)
+    migration.swap(specs, drop_legacy=True)
+
+    assert rows(migration, "SELECT user_id, balance FROM players_high_perf "
+                "WHERE user_id IN ('user_4', 'user_5', 'late') ORDER BY user_id") == [
+                    ('late', 7), ('user_4', int(2.5 * NANO))]
+
+
+def test_swap_rejects_shadow_with_different_row_count(migration):
+    specs = migration._tables()
+    for spec in specs:
+        migration.prepare(spec)
+        migration.backfill(spec)
+    migration.conn.execute(
+        "DELETE FROM players_high_perf__nano WHERE user_id = 'user_7'")
+
+    with pytest.raises(RuntimeError, match='25 строк, в тени 24'):
+        migration.swap(specs, drop_legacy=False)
+
+    # Подмена откатилась целиком: исходная таблица и версия схемы на месте
+    assert migration.needed()
+    assert rows(migration, "SELECT typeof(balance) FROM players_high_perf "
+                "WHERE user_id = 'user_1'") == [('real', )]
+
+
+def test_swap_refuses_while_database_is_open_elsewhere(migration, legacy_db):
+    specs = migration._tables()
+    for spec in specs:
+        migration.prepare(spec)
+        migration.backfill(spec)
+
+    # Простаивающее соединение старого сервера
+    server = sqlite3.connect(legacy_db)
+    server.execute("SELECT COUNT(*) FROM players_high_perf").fetchone()
+    try:
+        with pytest.raises(migrate_nano.DatabaseBusy):
+            migration.swap(specs, drop_legacy=False)
+        assert migration.needed()
+    finally:
+        server.close()
+
+    migration.swap(specs, drop_legacy=False)
+    assert not migration.needed()
+
+
+def test_server_refuses_database_that_needs_migration(legacy_db):
+    with pytest.raises(RuntimeError, match='migrate_nano.py'):
+        bot.HighPerformanceDatabase(legacy_db)
+
+    # База не тронута - миграция по-прежнему нужна
+    migration = NanoUnitMigration(legacy_db)
+    try:
+        assert migration.needed()
+    finally:
+        migration.close()
@@ -0,0 +1,58 @@
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize('value, units', [
+    (1, 1_000_000_000),
+    ('0.5', 500_000_000),
+    (0.000000001, 1),
+    (0.0000000014, 1),  # Ниже половины нано-единицы - вниз
+    (0.0000000016, 2),  # Выше половины - вверх
+    (0.1 + 0.2, 300_000_000),  # Ошибка представления float не переживает округление
+    (1e-10, 0),
+])
+def test_to_nano_rounds_to_nearest_unit(value, units):
+    assert bot.to_nano(value) == units
+
+
+@pytest.mark.parametrize('units', [0, 1, 999_999_999, 123_456_789_012])
+def test_from_nano_round_trips(units):
+    assert bot.to_nano(bot.from_nano(units)) == units
+
+
+def test_from_nano_treats_missing_as_zero():
+    assert bot.from_nano(None) == 0.0
+
+
+def test_pari_mutuel_remainder_goes_to_largest_stake():
+    stakes = {
+        'a': {'eagle': 1, 'tails': 0},
+        'b': {'eagle': 2, 'tails': 0},
+        'c': {'eagle': 0, 'tails': 4},
+    }
+
+    payouts = bot.TeamLotteryEngine.pari_mutuel_payouts(stakes, 'eagle', 7)
+
+    # 7 * 1 // 3 = 2 и 7 * 2 // 3 = 4; остаток 1 - крупнейшей ставке
+    assert payouts == {'a': 2, 'b': 5}
+
+
+def test_pari_mutuel_distributes_whole_pot():
+    stakes = {
+        f'user_{n}': {'eagle': n + 1, 'tails': 3 * n}
+        for n in range(37)
+    }
+    pot = sum(sum(player.values()) for player in stakes.values())
+    winning_total = sum(player['tails'] for player in stakes.values())
+    shares = {
+        user_id: player['tails'] * pot // winning_total
+        for user_id, player in stakes.items() if player['tails']
+    }
+
+    payouts = bot.TeamLotteryEngine.pari_mutuel_payouts(stakes, 'tails', pot)
+
+    assert sum(payouts.values()) == pot
+    assert payouts == {
+        **shares, 'user_36': shares['user_36'] + pot - sum(shares.values())
+    }
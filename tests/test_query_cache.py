@@ -0,0 +1,32 @@
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize('query, tables', [
+    ("SELECT * FROM players_high_perf WHERE user_id = ?",
+     ('players_high_perf', )),
+    # Неявное соединение: таблицы списка через запятую, с псевдонимами
+    ("SELECT * FROM players_high_perf p, transfers_high_perf AS t "
+     "WHERE p.user_id = t.from_user_id",
+     ('players_high_perf', 'transfers_high_perf')),
+    ("SELECT * FROM a, b, c JOIN d ON c.id = d.id", ('a', 'b', 'c', 'd')),
+    ("SELECT * FROM a JOIN b ON a.id = b.id", ('a', 'b')),
+    # Запятые после имени таблицы, но вне списка FROM - не таблицы
+    ("INSERT INTO a (x, y) VALUES (?, ?)", ('a', )),
+    ("UPDATE a SET x = 1, y = 2", ('a', )),
+    ("SELECT x, y FROM a ORDER BY x, y", ('a', )),
+    ("SELECT * FROM a WHERE x IN (1, 2)", ('a', )),
+])
+def test_tables_of_finds_every_table(query, tables):
+    assert bot.TableTaggedQueryCache.tables_of(query) == tables
+
+
+def test_write_to_implicitly_joined_table_invalidates_entry():
+    cache = bot.TableTaggedQueryCache(max_bytes=1 << 20, ttl_seconds=60)
+    query = "SELECT * FROM a, b WHERE a.id = b.id"
+    cache.put(query, [{'id': 1}], cache.snapshot(query))
+
+    cache.invalidate_tables('b')
+
+    assert cache.get(query) is None
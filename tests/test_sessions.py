@@ -0,0 +1,78 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def leases(request, tmp_path):
+    if request.param == 'sqlite':
+        manager = bot.SQLiteSessionManager(str(tmp_path / 'sessions.db'))
+    else:
+        manager = bot.HighPerformanceSessionManager(shard_count=4)
+    return bot.SessionLeaseManager(manager, b'test-secret')
+
+
+def register(leases, device_id):
+    allowed, _ = leases.manager.register_session('alice', device_id,
+                                                 '127.0.0.1', 'test')
+    return allowed
+
+
+def expire(leases, device_id):
+    """Сессия устройства неактивна и без аренды - ее можно перехватить"""
+    past = bot.time.time() - 10 * bot.PERFORMANCE_CONFIG['SESSION_TIMEOUT_SEC']
+    if isinstance(leases.manager, bot.SQLiteSessionManager):
+        leases.manager._get_connection().execute(
+            "UPDATE active_sessions SET last_activity = ?, lease_until = 0 "
+            "WHERE device_id = ?", (past, device_id))
+    else:
+        session = leases.manager._shard('alice').sessions['alice'][device_id]
+        session.last_activity = past
+        session.lease_until = 0
+
+
+def test_lease_verifies_for_its_session(leases):
+    assert register(leases, 'phone')
+    lease = leases.issue('alice', 'phone')
+
+    assert leases.verify('alice', 'phone', lease) is not None
+    assert leases.verify('alice', 'laptop', lease) is None
+    # Повторная регистрация того же устройства аренду не отзывает
+    assert register(leases, 'phone')
+    assert leases.verify('alice', 'phone', lease) is not None
+
+
+def test_release_revokes_lease(leases):
+    register(leases, 'phone')
+    lease = leases.issue('alice', 'phone')
+
+    assert leases.manager.release_session('alice', 'phone')
+    assert leases.verify('alice', 'phone', lease) is None
+
+    # Новая сессия того же устройства - новый nonce, старая аренда мертва
+    register(leases, 'phone')
+    assert leases.verify('alice', 'phone', lease) is None
+    assert leases.heartbeat('alice', 'phone', lease)[2] != lease
+
+
+def test_takeover_revokes_lease_of_previous_device(leases):
+    register(leases, 'phone')
+    lease = leases.issue('alice', 'phone')
+    expire(leases, 'phone')
+
+    assert register(leases, 'laptop')
+    assert leases.verify('alice', 'phone', lease) is None
+    assert not leases.is_fresh('alice', 'phone', lease)
+
+
+def test_lease_survives_nonce_cache_miss(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    leases = bot.SessionLeaseManager(bot.SQLiteSessionManager(path),
+                                     b'test-secret')
+    register(leases, 'phone')
+    lease = leases.issue('alice', 'phone')
+
+    # Перезапуск: кэш nonce пуст, сверка идет по таблице
+    restarted = bot.SessionLeaseManager(bot.SQLiteSessionManager(path),
+                                        b'test-secret')
+    assert restarted.verify('alice', 'phone', lease) is not None
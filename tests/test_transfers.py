@@ -0,0 +1,133 @@
+import pytest
+
+import bot
+from conftest import add_players, balances
+
+NANO = bot.NANO
+
+
+@pytest.fixture
+def engine(database, ledger):
+    add_players(database, {'alice': 10 * NANO, 'bob': 0})
+    engine = bot.TransferEngine(database, ledger)
+    yield engine
+    engine.shutdown()
+
+
+def transfer(engine, amount, key=None, to_user_id='bob'):
+    return engine.submit('alice', to_user_id, amount, to_user_id,
+                         key).result(timeout=5)
+
+
+def test_transfer_moves_balance(engine, database):
+    result = transfer(engine, 3 * NANO)
+
+    assert result['ok'] and not result['replayed']
+    assert result['newBalance'] == 7 * NANO
+    assert balances(database, 'alice', 'bob') == {
+        'alice': 7 * NANO, 'bob': 3 * NANO}
+
+
+def test_reused_key_replays_without_second_debit(engine, database):
+    first = transfer(engine, 2 * NANO, key='key-1')
+    replay = transfer(engine, 2 * NANO, key='key-1')
+
+    assert replay['replayed']
+    assert replay['transactionId'] == first['transactionId']
+    assert balances(database, 'alice', 'bob') == {
+        'alice': 8 * NANO, 'bob': 2 * NANO}
+
+
+def test_key_replays_from_database_after_restart(engine, database, ledger):
+    first = transfer(engine, 2 * NANO, key='key-1')
+    engine.shutdown()
+
+    # Новый движок: кэша ключей нет, повтор решает запись в БД
+    restarted = bot.TransferEngine(database, ledger)
+    try:
+        replay = transfer(restarted, 2 * NANO, key='key-1')
+    finally:
+        restarted.shutdown()
+
+    assert replay['ok'] and replay['replayed']
+    assert replay['transactionId'] == first['transactionId']
+    assert balances(database, 'alice')['alice'] == 8 * NANO
+
+
+def test_reused_key_with_other_parameters_conflicts(engine, database):
+    transfer(engine, 2 * NANO, key='key-1')
+
+    conflict = transfer(engine, 5 * NANO, key='key-1')
+
+    assert conflict == {
+        'ok': False,
+        'error': 'Ключ идемпотентности уже использован',
+        'status': 409
+    }
+    assert balances(database, 'alice', 'bob') == {
+        'alice': 8 * NANO, 'bob': 2 * NANO}
+
+
+def test_insufficient_funds_in_memory_changes_nothing(engine, database, ledger):
+    ledger.load_player('alice')
+
+    result = transfer(engine, 11 * NANO)
+
+    assert result['status'] == 400
+    assert balances(database, 'alice', 'bob') == {'alice': 10 * NANO, 'bob': 0}
+    assert ledger.load_player('alice')['balance'] == 10 * NANO
+
+
+def test_insufficient_funds_in_database_releases_reserve(engine, database, ledger):
+    # Память успела зарезервировать списание, а в БД денег уже нет
+    ledger.load_player('alice')
+    database.write(lambda conn: conn.execute(
+        "UPDATE players_high_perf SET balance = ? WHERE user_id = 'alice'",
+        (NANO, )))
+
+    result = transfer(engine, 5 * NANO)
+
+    assert result == {'ok': False, 'error': 'Недостаточно средств',
+                      'status': 400}
+    assert balances(database, 'alice', 'bob') == {'alice': NANO, 'bob': 0}
+    assert ledger.load_player('alice')['balance'] == 10 * NANO
+
+
+def test_failed_group_rolls_back_and_releases_reserves(engine, database, ledger,
+                                                       monkeypatch):
+    ledger.load_player('alice')
+
+    def failing_apply(conn, **kwargs):
+        conn.execute("UPDATE players_high_perf SET balance = 0")
+        raise RuntimeError('disk I/O error')
+
+    monkeypatch.setattr(engine, '_apply_group', failing_apply)
+    result = transfer(engine, 4 * NANO)
+
+    assert result == {'ok': False, 'error': 'TRANSFER_ERROR', 'status': 500}
+    ledger.flush()
+    assert balances(database, 'alice', 'bob') == {'alice': 10 * NANO, 'bob': 0}
+    assert ledger.load_player('alice')['balance'] == 10 * NANO
+
+
+def test_transfer_route_replays_and_rejects_reused_key():
+    add_players(bot.db, {'route_alice': 10 * NANO, 'route_bob': 0})
+    client = bot.app.test_client()
+    payload = {
+        'fromUserId': 'route_alice',
+        'toUserId': 'route_bob',
+        'amount': 1.5,
+        'fromUsername': 'route_alice'
+    }
+    headers = {'Idempotency-Key': 'route-key'}
+
+    first = client.post('/api/transfer', json=payload, headers=headers)
+    replay = client.post('/api/transfer', json=payload, headers=headers)
+    conflict = client.post('/api/transfer', json={**payload, 'amount': 2},
+                           headers=headers)
+
+    assert first.status_code == 200 and not first.get_json()['replayed']
+    assert replay.status_code == 200 and replay.get_json()['replayed']
+    assert replay.get_json()['transactionId'] == first.get_json()['transactionId']
+    assert conflict.status_code == 409
+    assert balances(bot.db, 'route_alice')['route_alice'] == int(8.5 * NANO)
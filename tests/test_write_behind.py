@@ -0,0 +1,63 @@
+import pytest
+
+import bot
+from conftest import add_players, balances
+
+NANO = bot.NANO
+
+
+@pytest.fixture
+def small_ledger(database, monkeypatch):
+    monkeypatch.setitem(bot.PERFORMANCE_CONFIG, 'WRITE_BEHIND_STATE_SIZE', 2)
+    # Фоновый поток не должен сбрасывать буфер посреди теста
+    monkeypatch.setitem(bot.PERFORMANCE_CONFIG, 'WRITE_BEHIND_FLUSH_MS', 3600000)
+    buffer = bot.WriteBehindBuffer(database)
+    yield buffer
+    buffer.shutdown()
+
+
+def test_evicted_player_keeps_pending_update(small_ledger, database):
+    add_players(database, {'alice': 10 * NANO, 'bob': 0, 'carol': 0})
+    small_ledger.adjust_balance('alice', 5 * NANO)
+
+    # alice вытеснена из LRU, пока ее запись еще не в БД
+    small_ledger.load_player('bob')
+    small_ledger.load_player('carol')
+    assert small_ledger.load_player('alice')['balance'] == 15 * NANO
+
+    small_ledger.adjust_balance('alice', NANO)
+    small_ledger.flush()
+    assert balances(database, 'alice')['alice'] == 16 * NANO
+
+
+def test_committed_credit_reaches_evicted_pending_player(small_ledger, database):
+    add_players(database, {'alice': 10 * NANO, 'bob': 0, 'carol': 0})
+    small_ledger.adjust_balance('alice', 5 * NANO)
+    small_ledger.load_player('bob')
+    small_ledger.load_player('carol')
+
+    # Выплата записана в БД в обход буфера и переносится в память
+    with small_ledger.flush_lock:
+        database.write(lambda conn: conn.execute(
+            "UPDATE players_high_perf SET balance = balance + ?, "
+            "version = version + 1 WHERE user_id = 'alice'", (NANO, )))
+        with small_ledger.lock:
+            small_ledger.apply_committed('alice', NANO, bot.now_ms())
+
+    small_ledger.flush()
+    assert balances(database, 'alice')['alice'] == 16 * NANO
+    assert small_ledger.load_player('alice')['balance'] == 16 * NANO
+
+
+def test_stale_row_does_not_overwrite_newer_version(ledger, database):
+    add_players(database, {'alice': 10 * NANO})
+    ledger.adjust_balance('alice', NANO)
+    # Два перевода записаны в БД, а в память не попали
+    for _ in range(2):
+        database.write(lambda conn: conn.execute(
+            "UPDATE players_high_perf SET balance = balance + ?, "
+            "version = version + 1 WHERE user_id = 'alice'", (NANO, )))
+
+    ledger.flush()
+
+    assert balances(database, 'alice')['alice'] == 12 * NANO
@@ -360,13 +360,12 @@ async function makeTransfer() {
     }
     
     try {
-        const data = await apiRequest('/api/transfer', {
-            method: 'POST',
-            body: JSON.stringify({
-                fromUserId: window.userData.userId,
-                toUserId: selectedTransferUser.userId,
-                amount: amount
-            })
+        const data = await window.apiTransfer({
+            fromUserId: window.userData.userId,
+            fromUsername: window.userData.username,
+            toUserId: selectedTransferUser.userId,
+            toUsername: selectedTransferUser.username,
+            amount: amount
         });
         
         if (data.success) {